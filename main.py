@@ -19,7 +19,8 @@ from pytz import timezone as pytz_timezone
 import logging
 from logging.handlers import RotatingFileHandler
 import traceback
-from typing import Optional, Dict, List
+import functools
+from typing import Optional, Dict, List, Tuple
 import shutil
 import yookassa
 from yookassa import Payment, Configuration
@@ -27,7 +28,18 @@ from yookassa.domain.notification import WebhookNotificationEventType, WebhookNo
 import uuid
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
+import threading
 from threading import Lock  # для потокобезопасности
+from contextlib import contextmanager
+from collections import OrderedDict, defaultdict, namedtuple, deque
+from array import array
+import heapq
+import zlib
+import json
+import html
+import ipaddress
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 
 # Загрузка переменных окружения
 from dotenv import load_dotenv
@@ -88,6 +100,9 @@ if not TOKEN:
 SUBSCRIPTION_PRICE = 69  # Одна цена: 69 рублей за месяц
 SUBSCRIPTION_DAYS = 30    # 30 дней подписка
 
+# Псевдотема "все вопросы сразу" в конце списка тем
+RANDOM_TOPIC = "🎲 Все темы (рандом)"
+
 # Ключи ЮKassa
 YOOKASSA_SHOP_ID = os.getenv('YOOKASSA_SHOP_ID')
 YOOKASSA_SECRET_KEY = os.getenv('YOOKASSA_SECRET_KEY')
@@ -103,6 +118,26 @@ if YOOKASSA_SHOP_ID and YOOKASSA_SECRET_KEY:
 else:
     logger.info("⚠️ ЮKassa не настроена (отсутствуют SHOP_ID или SECRET_KEY)")
 
+# Вебхук ЮKassa: включается флагом YOOKASSA_WEBHOOK_ENABLED=1 (по умолчанию - если задан порт);
+# порт 0 - свободный порт, выбранный системой
+YOOKASSA_WEBHOOK_ENABLED = os.getenv('YOOKASSA_WEBHOOK_ENABLED',
+                                     '1' if os.getenv('YOOKASSA_WEBHOOK_PORT') else '') == '1'
+try:
+    YOOKASSA_WEBHOOK_PORT = int(os.getenv('YOOKASSA_WEBHOOK_PORT') or 0)
+    if not 0 <= YOOKASSA_WEBHOOK_PORT <= 65535:
+        raise ValueError("порт вне диапазона 0-65535")
+except ValueError as e:
+    # Ошибка в необязательной настройке не должна останавливать бота
+    logger.info(f"⚠️ Некорректный YOOKASSA_WEBHOOK_PORT ({os.getenv('YOOKASSA_WEBHOOK_PORT')}): {e}. Вебхук отключен")
+    YOOKASSA_WEBHOOK_PORT = 0
+    YOOKASSA_WEBHOOK_ENABLED = False
+YOOKASSA_WEBHOOK_HOST = os.getenv('YOOKASSA_WEBHOOK_HOST', '0.0.0.0')
+YOOKASSA_WEBHOOK_PATH = os.getenv('YOOKASSA_WEBHOOK_PATH', '/yookassa/webhook')
+# Дополнительные доверенные адреса через запятую (например, 127.0.0.1 для локальной проверки)
+YOOKASSA_WEBHOOK_TRUSTED = os.getenv('YOOKASSA_WEBHOOK_TRUSTED', '')
+# За reverse proxy адрес отправителя берется из последнего элемента X-Forwarded-For
+YOOKASSA_WEBHOOK_BEHIND_PROXY = os.getenv('YOOKASSA_WEBHOOK_BEHIND_PROXY', '') == '1'
+
 bot = telebot.TeleBot(TOKEN)
 NOVOSIBIRSK_TZ = pytz_timezone('Asia/Novosibirsk')
 # Настройка для telebot
@@ -148,6 +183,20 @@ def validate_days(days):
     except (ValueError, TypeError):
         raise ValueError(f"Некорректное количество дней: {days}")
 
+def parse_db_datetime(value) -> Optional[datetime]:
+    """Разбор даты из БД (naive UTC строка) в aware datetime в UTC"""
+    if not value:
+        return None
+    try:
+        naive = datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        try:
+            # Старый формат без времени - действует до конца дня
+            naive = datetime.strptime(value, '%Y-%m-%d').replace(hour=23, minute=59, second=59)
+        except ValueError:
+            return None
+    return pytz.UTC.localize(naive)
+
 def answer_callback_safe(bot_instance, call_id, text=None, show_alert=False):
     """Безопасный ответ на callback query"""
     try:
@@ -180,79 +229,596 @@ def answer_callback_safe(bot_instance, call_id, text=None, show_alert=False):
         thread.daemon = True  # Поток завершится с основным
         thread.start()
 
+# ============================================================================
+# ИСХОДЯЩИЕ СООБЩЕНИЯ TELEGRAM
+# ============================================================================
+class OutboundDispatcher:
+    """Единый шлюз исходящих запросов к Telegram.
+
+    Методы отправки бота оборачиваются (install): перед запросом вызывающий поток ждет
+    токен в общем бюджете (сообщений в секунду) и в бюджете чата. Есть две полосы:
+    интерактивные ответы обслуживаются первыми, рассылка (контекст broadcast())
+    уступает им и не трогает резерв общего бюджета. Ответ 429 приостанавливает
+    отправку в этот чат на retry_after секунд, после чего запрос повторяется;
+    если за FLOOD_WINDOW секунд 429 пришел в FLOOD_CHATS разных чатов, это
+    общий флуд-контроль и пауза распространяется на все чаты.
+    """
+
+    FLOOD_WINDOW = 1.0
+    FLOOD_CHATS = 3
+
+    LANE_INTERACTIVE = 0
+    LANE_BROADCAST = 1
+
+    # Метод бота -> позиция chat_id среди позиционных аргументов
+    THROTTLED_METHODS = {
+        'send_message': 0,
+        'send_photo': 0,
+        'send_document': 0,
+        'send_video': 0,
+        'send_audio': 0,
+        'copy_message': 0,
+        'forward_message': 0,
+        'edit_message_text': 1,
+        'edit_message_caption': 1,
+        'edit_message_reply_markup': 0,
+    }
+
+    def __init__(self, global_per_second=25, broadcast_reserve=5, chat_burst=4, chat_per_second=1.0,
+                 group_per_minute=20, max_retries=3):
+        self.global_rate = float(global_per_second)
+        self.broadcast_reserve = broadcast_reserve
+        self.chat_burst = float(chat_burst)
+        self.chat_rate = chat_per_second
+        self.group_capacity = float(group_per_minute)
+        self.group_rate = group_per_minute / 60
+        self.max_retries = max_retries
+
+        self._global = [self.global_rate, time.monotonic()]  # [токены, время пополнения]
+        self._chats = {}  # chat_id -> [токены, время пополнения]
+        self._waiting = [0, 0]  # ожидающие потоки по полосам
+        self._paused_until = 0.0
+        self._chat_paused = {}  # chat_id -> пауза после 429 для этого чата
+        self._recent_floods = deque()  # (время, chat_id) недавних 429
+        self._cond = threading.Condition()
+        self._local = threading.local()
+        self.flood_waits = 0
+
+    def install(self, bot_instance):
+        """Подмена методов отправки экземпляра бота обертками с ограничением"""
+        for name, chat_pos in self.THROTTLED_METHODS.items():
+            original = getattr(bot_instance, name, None)
+            if original is None:
+                continue  # метода нет в этой версии pyTelegramBotAPI
+            setattr(bot_instance, name, self._wrap(original, chat_pos))
+
+    def _wrap(self, func, chat_pos):
+        @functools.wraps(func)
+        def throttled(*args, **kwargs):
+            chat_id = kwargs.get('chat_id', args[chat_pos] if len(args) > chat_pos else None)
+            return self.call(func, chat_id, *args, **kwargs)
+        return throttled
+
+    @contextmanager
+    def broadcast(self):
+        """Отправки внутри блока идут по низкоприоритетной полосе рассылки"""
+        previous = getattr(self._local, 'lane', self.LANE_INTERACTIVE)
+        self._local.lane = self.LANE_BROADCAST
+        try:
+            yield
+        finally:
+            self._local.lane = previous
+
+    def call(self, func, target_chat, *args, **kwargs):
+        """Выполнение запроса в пределах бюджета с повтором после 429"""
+        lane = getattr(self._local, 'lane', self.LANE_INTERACTIVE)
+        for attempt in range(self.max_retries + 1):
+            self._acquire(target_chat, lane)
+            try:
+                return func(*args, **kwargs)
+            except telebot.apihelper.ApiTelegramException as e:
+                if e.error_code != 429 or attempt == self.max_retries:
+                    raise
+                retry_after = (e.result_json or {}).get('parameters', {}).get('retry_after', 1)
+                self.pause(retry_after, target_chat)
+                logger.warning(f"⏳ Telegram 429 для чата {target_chat}: пауза {retry_after} с "
+                               f"(попытка {attempt + 1}/{self.max_retries})")
+
+    def pause(self, seconds, chat_id=None):
+        """Приостановка отправок в чат (retry_after из ответа 429); chat_id=None - во все чаты"""
+        with self._cond:
+            now = time.monotonic()
+            until = now + seconds
+            self.flood_waits += 1
+            if chat_id is not None:
+                self._chat_paused[chat_id] = max(self._chat_paused.get(chat_id, 0.0), until)
+                self._recent_floods.append((now, chat_id))
+                while self._recent_floods and self._recent_floods[0][0] < now - self.FLOOD_WINDOW:
+                    self._recent_floods.popleft()
+                if len({chat for _, chat in self._recent_floods}) < self.FLOOD_CHATS:
+                    return
+                logger.warning(f"⏳ Telegram 429 сразу в нескольких чатах: общая пауза {seconds} с")
+            self._paused_until = max(self._paused_until, until)
+
+    def _chat_limits(self, chat_id):
+        # Отрицательные id - группы и каналы, у них поминутный лимит.
+        # Строковый '@username' (telebot принимает и его) - всегда публичный канал или группа.
+        if chat_id is None:
+            return self.chat_burst, self.chat_rate
+        try:
+            is_group = int(chat_id) < 0
+        except (TypeError, ValueError):
+            is_group = True
+        if is_group:
+            return self.group_capacity, self.group_rate
+        return self.chat_burst, self.chat_rate
+
+    @staticmethod
+    def _refill(bucket, capacity, rate, now):
+        bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+
+    def _wait_time(self, chat_id, lane, now) -> float:
+        """Сколько ждать до отправки (0 - можно сейчас); вызывается под self._cond"""
+        if self._paused_until > now:
+            return self._paused_until - now
+        if lane == self.LANE_BROADCAST and self._waiting[self.LANE_INTERACTIVE]:
+            return 0.05
+        chat_paused = self._chat_paused.get(chat_id) if chat_id is not None else None
+        if chat_paused is not None:
+            if chat_paused > now:
+                return chat_paused - now
+            del self._chat_paused[chat_id]
+
+        self._refill(self._global, self.global_rate, self.global_rate, now)
+        needed = 1.0 + (self.broadcast_reserve if lane == self.LANE_BROADCAST else 0)
+        if self._global[0] < needed:
+            return (needed - self._global[0]) / self.global_rate
+
+        if chat_id is not None:
+            capacity, rate = self._chat_limits(chat_id)
+            bucket = self._chats.setdefault(chat_id, [capacity, now])
+            self._refill(bucket, capacity, rate, now)
+            if bucket[0] < 1.0:
+                return (1.0 - bucket[0]) / rate
+        return 0.0
+
+    def _acquire(self, chat_id, lane):
+        with self._cond:
+            self._waiting[lane] += 1
+            try:
+                while True:
+                    wait = self._wait_time(chat_id, lane, time.monotonic())
+                    if wait <= 0:
+                        break
+                    self._cond.wait(wait)
+
+                self._global[0] -= 1.0
+                if chat_id is not None:
+                    self._chats[chat_id][0] -= 1.0
+            finally:
+                self._waiting[lane] -= 1
+            self._cond.notify_all()
+
+    def sweep_idle(self) -> int:
+        """Удаление полностью восстановившихся бюджетов чатов"""
+        now = time.monotonic()
+        with self._cond:
+            idle = []
+            for chat_id, (tokens, updated) in self._chats.items():
+                capacity, rate = self._chat_limits(chat_id)
+                if tokens + (now - updated) * rate >= capacity:
+                    idle.append(chat_id)
+            for chat_id in idle:
+                del self._chats[chat_id]
+            for chat_id in [chat for chat, until in self._chat_paused.items() if until <= now]:
+                del self._chat_paused[chat_id]
+        return len(idle)
+
+class ProgressReporter:
+    """Статус длительной операции в одном сообщении администратора.
+
+    update() только запоминает последний текст и сразу возвращает управление; фоновый
+    поток раз в interval_seconds редактирует сообщение, если текст изменился с прошлой
+    правки. finish() останавливает поток и выводит итоговый текст.
+    """
+
+    def __init__(self, chat_id: int, message_id: Optional[int] = None, interval_seconds: float = 3.0,
+                 parse_mode: Optional[str] = 'HTML'):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.interval = interval_seconds
+        self.parse_mode = parse_mode
+        self._pending = None
+        self._shown = None
+        self._lock = Lock()
+        self._done = threading.Event()
+        self._thread = None
+
+    def start(self, text: str) -> Optional[int]:
+        """Показ начального текста (новым сообщением, если message_id не задан) и запуск потока"""
+        try:
+            if self.message_id is None:
+                self.message_id = bot.send_message(self.chat_id, text, parse_mode=self.parse_mode).message_id
+                self._shown = text
+            else:
+                self._edit(text)
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось показать статус операции: {e}")
+
+        self._thread = threading.Thread(target=self._loop, name=f'progress-{self.chat_id}', daemon=True)
+        self._thread.start()
+        return self.message_id
+
+    def update(self, text: str):
+        with self._lock:
+            self._pending = text
+
+    def finish(self, text: str, reply_markup=None):
+        """Итоговый текст выводится сразу, минуя интервал"""
+        self._done.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(self.interval + 1)
+        self._edit(text, reply_markup=reply_markup)
+
+    def _loop(self):
+        while not self._done.wait(self.interval):
+            with self._lock:
+                text, self._pending = self._pending, None
+            if text is not None:
+                self._edit(text)
+
+    def _edit(self, text: str, reply_markup=None):
+        if self.message_id is None or (text == self._shown and reply_markup is None):
+            return
+        try:
+            bot.edit_message_text(chat_id=self.chat_id, message_id=self.message_id, text=text,
+                                  parse_mode=self.parse_mode, reply_markup=reply_markup)
+            self._shown = text
+        except Exception as e:
+            logger.debug(f"Не удалось обновить статус операции: {e}")
+
 # ============================================================================
 # КЛАСС ДЛЯ УПРАВЛЕНИЯ ДАННЫМИ ПОЛЬЗОВАТЕЛЕЙ С TTL
 # ============================================================================
 class CacheManager:
-    """Менеджер кеширования для ускорения работы"""
+    """Потокобезопасный LRU-кеш с TTL, лимитом размера и статистикой.
 
-    def __init__(self, ttl_seconds=300):
-        self.cache = {}
+    Пространство имен ключа - префикс до первого '_' (user_123 -> user),
+    по нему ведутся счетчики попаданий/промахов/вытеснений.
+    """
+
+    def __init__(self, ttl_seconds=300, max_entries=10000):
+        self.cache = OrderedDict()  # key -> (value, expires_at), порядок = давность использования
         self.ttl = ttl_seconds
+        self.max_entries = max_entries
+        self._lock = Lock()
+        self._stats = defaultdict(lambda: {'hits': 0, 'misses': 0, 'evictions': 0, 'expired': 0})
 
-    def get(self, key):
-        """Получение значения из кеша"""
-        if key in self.cache:
-            value, timestamp = self.cache[key]
-            if time.time() - timestamp < self.ttl:
-                return value
-            else:
+    @staticmethod
+    def _namespace(key) -> str:
+        return str(key).split('_', 1)[0]
+
+    def get(self, key, default=None):
+        """Получение значения из кеша (default, если ключа нет или он просрочен)"""
+        with self._lock:
+            # defaultdict создает запись при первом обращении - только под блокировкой
+            stats = self._stats[self._namespace(key)]
+            entry = self.cache.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if time.time() < expires_at:
+                    self.cache.move_to_end(key)
+                    stats['hits'] += 1
+                    return value
                 del self.cache[key]  # Удаляем просроченный кеш
-        return None
+                stats['expired'] += 1
+            stats['misses'] += 1
+        return default
 
-    def set(self, key, value):
-        """Установка значения в кеш"""
-        self.cache[key] = (value, time.time())
+    def set(self, key, value, ttl=None):
+        """Установка значения в кеш (ttl - собственный срок жизни записи)"""
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self.cache[key] = (value, expires_at)
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.max_entries:
+                evicted_key, _ = self.cache.popitem(last=False)
+                self._stats[self._namespace(evicted_key)]['evictions'] += 1
 
     def delete(self, key):
         """Удаление значения из кеша"""
-        self.cache.pop(key, None)
+        with self._lock:
+            self.cache.pop(key, None)
+
+    def delete_prefix(self, prefix: str) -> int:
+        """Удаление всех ключей с заданным префиксом, возвращает число удаленных"""
+        with self._lock:
+            keys = [key for key in self.cache if str(key).startswith(prefix)]
+            for key in keys:
+                del self.cache[key]
+        return len(keys)
+
+    def sweep_expired(self) -> int:
+        """Активное удаление просроченных записей (вызывается планировщиком)"""
+        now = time.time()
+        with self._lock:
+            expired = [key for key, (_, expires_at) in self.cache.items() if expires_at <= now]
+            for key in expired:
+                del self.cache[key]
+                self._stats[self._namespace(key)]['expired'] += 1
+        return len(expired)
+
+    def get_stats(self) -> Dict[str, Dict[str, int]]:
+        """Статистика по пространствам имен: hits, misses, evictions, expired, size"""
+        with self._lock:
+            sizes = defaultdict(int)
+            for key in self.cache:
+                sizes[self._namespace(key)] += 1
+            stats = {}
+            for namespace in set(self._stats) | set(sizes):
+                stats[namespace] = dict(self._stats[namespace], size=sizes[namespace])
+        return stats
+
+    def __len__(self):
+        return len(self.cache)
 
     def clear(self):
         """Очистка кеша"""
-        self.cache.clear()
+        with self._lock:
+            self.cache.clear()
+
+
+class SubscriptionStatusCache:
+    """Кеш вердиктов о подписке, действительных до момента окончания подписки.
+
+    Активная подписка не может «сама» стать активнее, поэтому положительный
+    вердикт хранится ровно до subscription_end_date. Отрицательный вердикт
+    живет недолго (negative_ttl), т.к. оплата может прийти в любой момент.
+    Любая запись в подписку пользователя обязана вызвать invalidate().
+    """
+
+    NEVER_EXPIRES = float('inf')
+
+    def __init__(self, negative_ttl_seconds=60):
+        self._entries = {}  # telegram_id -> (is_active, is_admin, valid_until)
+        self._lock = Lock()
+        self.negative_ttl = negative_ttl_seconds
+
+    def get(self, telegram_id: int) -> Optional[Tuple[bool, bool]]:
+        """Вердикт (is_active, is_admin) или None, если его нужно пересчитать"""
+        entry = self._entries.get(telegram_id)
+        if entry is None:
+            return None
+        is_active, is_admin, valid_until = entry
+        if time.time() >= valid_until:
+            with self._lock:
+                # Удаляем только если запись не успели обновить
+                if self._entries.get(telegram_id) is entry:
+                    del self._entries[telegram_id]
+            return None
+        return is_active, is_admin
+
+    def remember(self, telegram_id: int, user: Optional[Dict]) -> Tuple[bool, bool]:
+        """Вычисление вердикта по строке пользователя и сохранение его в кеш"""
+        is_admin = bool(user and user.get('is_admin'))
+        is_active = False
+        if is_admin:
+            valid_until = self.NEVER_EXPIRES
+        else:
+            valid_until = time.time() + self.negative_ttl
+            end_ts = None
+            if user and user.get('subscription_paid'):
+                end_ts = user.get('subscription_end_ts')
+                if end_ts is None:
+                    end_aware = parse_db_datetime(user.get('subscription_end_date'))
+                    end_ts = end_aware.timestamp() if end_aware else None
+            if end_ts is not None:
+                if end_ts > time.time():
+                    is_active = True
+                    valid_until = end_ts
+
+        with self._lock:
+            self._entries[telegram_id] = (is_active, is_admin, valid_until)
+        return is_active, is_admin
+
+    def invalidate(self, telegram_id: int):
+        """Сброс вердикта после изменения подписки"""
+        with self._lock:
+            self._entries.pop(telegram_id, None)
+
+    def clear(self):
+        """Полная очистка (массовые изменения подписок)"""
+        with self._lock:
+            self._entries.clear()
+
+    def size(self) -> int:
+        return len(self._entries)
+
+class PaymentStatusCache:
+    """Статусы платежей ЮKassa для кнопки "проверить оплату".
+
+    Финальные статусы (succeeded, canceled) берутся из локальной таблицы
+    payments без обращения к ЮKassa. Остальные запрашиваются через fetch и
+    живут ttl секунд; одновременные проверки одного payment_id ждут один
+    общий запрос (single flight), ошибка запроса достается всем ожидающим.
+    """
+
+    TERMINAL_STATUSES = ('succeeded', 'canceled')
+    # Облегченная замена объекта ЮKassa для платежей, известных по БД
+    LocalPayment = namedtuple('LocalPayment', 'id status metadata')
+
+    class _Flight:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self, fetch, local_lookup, ttl_seconds=5, max_entries=1000):
+        self._fetch = fetch  # payment_id -> объект платежа ЮKassa
+        self._local_lookup = local_lookup  # payment_id -> строка payments или None
+        self.ttl = ttl_seconds
+        self.max_entries = max_entries
+        self._entries = {}  # payment_id -> (payment, expires_at)
+        self._inflight = {}  # payment_id -> _Flight
+        self._lock = Lock()
+        self.upstream_calls = 0
+        self.coalesced = 0
+
+    @classmethod
+    def is_local(cls, payment) -> bool:
+        """Статус взят из БД - записывать его обратно не нужно"""
+        return isinstance(payment, cls.LocalPayment)
+
+    def get(self, payment_id: str):
+        """Платеж со статусом: из БД, из кеша или одним общим запросом к ЮKassa"""
+        row = self._local_lookup(payment_id)
+        if row and row.get('status') in self.TERMINAL_STATUSES:
+            return self.LocalPayment(payment_id, row['status'], {'telegram_id': row.get('telegram_id')})
+
+        entry = self._entries.get(payment_id)
+        if entry is not None and entry[1] > time.time():
+            return entry[0]
+
+        with self._lock:
+            flight = self._inflight.get(payment_id)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[payment_id] = self._Flight()
+                self.upstream_calls += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = self._fetch(payment_id)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[payment_id]
+                if flight.error is None and flight.result is not None:
+                    self._store(payment_id, flight.result)
+            flight.done.set()
+
+    def _store(self, payment_id: str, payment):
+        """Сохранение под блокировкой с вытеснением устаревших записей"""
+        now = time.time()
+        if len(self._entries) >= self.max_entries:
+            for key in [k for k, (_, expires) in self._entries.items() if expires <= now]:
+                del self._entries[key]
+        self._entries[payment_id] = (payment, now + self.ttl)
+
+    def invalidate(self, payment_id: str):
+        """Сброс закешированного статуса (например, после уведомления ЮKassa)"""
+        with self._lock:
+            self._entries.pop(payment_id, None)
+
+    def size(self) -> int:
+        return len(self._entries)
 # ============================================================================
 # ЛИМИТЫ ЗАПРОСОВ
 # ============================================================================
 class RateLimiter:
-    def __init__(self, max_requests=10, per_seconds=60):
-        self.requests = {}
-        self.callback_requests = {}  # ОТДЕЛЬНО ДЛЯ CALLBACK
-        self.max_requests = max_requests
-        self.per_seconds = per_seconds
-        self.lock = Lock()
-
-    def check(self, user_id):
-        """Проверка лимита для сообщений"""
-        with self.lock:
-            return self._check_impl(user_id, self.requests)
+    """Token bucket: на пользователя и класс действий хранятся два числа - токены и время пополнения.
 
-    def check_callback(self, user_id):
-        """Проверка лимита для callback-запросов (более щадящий)"""
-        with self.lock:
-            return self._check_impl(user_id, self.callback_requests, max_reqs=20)  # 20 запросов в минуту
-
-    def _check_impl(self, user_id, storage, max_reqs=None):
-        """Общая реализация проверки"""
-        current_time = time.time()
-        max_allowed = max_reqs or self.max_requests
+    Ведро емкостью capacity пополняется со скоростью capacity / per_seconds токенов в секунду,
+    каждое действие тратит один токен. Проверка и память на ключ не зависят от числа запросов.
+    """
 
-        if user_id not in storage:
-            storage[user_id] = []
+    # Класс действия: (емкость всплеска, период полного пополнения в секундах).
+    # Любой callback дополнительно списывает токен из общего ведра 'callbacks'
+    # (20 в минуту, как и прежде), классы callback-ов - ограничения внутри него.
+    DEFAULT_LIMITS = {
+        'messages': (60, 60),   # текстовые сообщения вне команд
+        'callbacks': (20, 60),  # все callback-запросы вместе
+        'answers': (20, 60),    # ответы на вопросы и следующий вопрос
+        'menus': (20, 60),      # навигация по меню
+        'payments': (10, 60),   # создание и проверка платежей (запросы к ЮKassa)
+        'admin': (20, 60),      # админ-панель
+    }
+    CALLBACK_TOTAL = 'callbacks'
+
+    # Префиксы callback_data по классам (остальное - меню)
+    CALLBACK_ACTIONS = (
+        (('answer_', 'get_question', 'random_question', 'r_', 't_'), 'answers'),
+        (('pay_now', 'check_payment_', 'trial'), 'payments'),
+        (('admin_', 'back_to_admin', 'extend_', 'confirm_extend_', 'logs_', 'restart_',
+          'confirm_broadcast', 'edit_broadcast', 'cancel_broadcast', 'broadcast_active_only'), 'admin'),
+    )
 
-        # Очищаем старые запросы
-        storage[user_id] = [
-            req_time for req_time in storage[user_id]
-            if current_time - req_time < self.per_seconds
-        ]
+    def __init__(self, limits: Optional[Dict[str, Tuple[int, int]]] = None):
+        self.limits = dict(self.DEFAULT_LIMITS)
+        if limits:
+            self.limits.update(limits)
+        # action -> (емкость, токенов в секунду)
+        self._rates = {action: (float(capacity), capacity / per_seconds)
+                       for action, (capacity, per_seconds) in self.limits.items()}
+        # action -> {user_id: [токены, время последнего пополнения]}
+        self._buckets = {action: {} for action in self.limits}
+        self.lock = Lock()
 
-        # Проверяем лимит
-        if len(storage[user_id]) >= max_allowed:
-            return False
+    @classmethod
+    def action_for_callback(cls, data: str) -> str:
+        """Класс действия по callback_data"""
+        for prefixes, action in cls.CALLBACK_ACTIONS:
+            if data.startswith(prefixes):
+                return action
+        return 'menus'
+
+    def check(self, user_id, action: str = 'messages') -> bool:
+        """Списать токен; False, если ведро пусто"""
+        return self._take(user_id, (action,))
+
+    def check_callback(self, user_id, data: str = '') -> bool:
+        """Проверка лимита для callback-запросов: общее ведро и ведро класса действия"""
+        return self._take(user_id, (self.CALLBACK_TOTAL, self.action_for_callback(data or '')))
+
+    def _take(self, user_id, actions) -> bool:
+        """Списать по токену из каждого ведра, только если токен есть во всех"""
+        now = time.monotonic()
+        with self.lock:
+            refilled = []
+            for action in actions:
+                capacity, rate = self._rates[action]
+                bucket = self._buckets[action].setdefault(user_id, [capacity, now])
+                bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+                refilled.append(bucket)
+
+            if any(bucket[0] < 1.0 for bucket in refilled):
+                return False
+            for bucket in refilled:
+                bucket[0] -= 1.0
+            return True
 
-        # Добавляем новый запрос
-        storage[user_id].append(current_time)
-        return True
+    def sweep_idle(self) -> int:
+        """Удаление ведер, которые успели наполниться: они неотличимы от отсутствующих"""
+        now = time.monotonic()
+        removed = 0
+        with self.lock:
+            for action, buckets in self._buckets.items():
+                capacity, rate = self._rates[action]
+                idle = [user_id for user_id, (tokens, updated) in buckets.items()
+                        if tokens + (now - updated) * rate >= capacity]
+                for user_id in idle:
+                    del buckets[user_id]
+                removed += len(idle)
+
+        if removed:
+            logger.debug(f"🧹 Лимитер: удалено неактивных ключей {removed}")
+        return removed
+
+    def size(self) -> int:
+        with self.lock:
+            return sum(len(buckets) for buckets in self._buckets.values())
 # ============================================================================
 # КЕШИРОВАНИЕ ДАННЫХ
 # ============================================================================
@@ -267,6 +833,17 @@ class UserDataManager:
         self.ttl = ttl_minutes * 60  # в секундах
         self.last_cleanup = time.time()
         self.cleanup_interval = cleanup_interval_minutes * 60
+        # Долговременное хранение прогресса (подключается после создания БД)
+        self.progress_store = None
+        self._dirty_progress = {}  # user_id -> {темы, требующие записи}
+        self._dirty_lock = Lock()
+        # Сброс прогресса и его запись в БД не должны перекрываться:
+        # иначе flush_progress вернет в БД только что удаленные строки
+        self._flush_lock = Lock()
+
+    def attach_progress_store(self, progress_store):
+        """Подключение хранилища прогресса викторины"""
+        self.progress_store = progress_store
 
     def cleanup_old_data(self):
         """Очистка устаревших данных"""
@@ -277,9 +854,13 @@ class UserDataManager:
 
         logger.info("🧹 Запуск очистки устаревших данных пользователей...")
 
-        # Очищаем user_data
+        # Очищаем user_data (несохраненный прогресс дождется записи в БД)
+        with self._dirty_lock:
+            dirty_users = set(self._dirty_progress)
         to_remove = []
         for user_id, data in self.user_data.items():
+            if user_id in dirty_users:
+                continue
             if 'last_access' in data and current_time - data['last_access'] > self.ttl:
                 to_remove.append(user_id)
 
@@ -315,31 +896,42 @@ class UserDataManager:
         if user_id not in self.user_data:
             self.user_data[user_id] = {
                 'current_topic': None,
-                'current_question': None,
+                'current_question_id': None,  # ID вопроса в question_bank
                 'correct_answer': None,
                 'numbered_answers': {},
                 'answers_list': [],
                 'last_access': time.time(),
                 # НОВОЕ: инициализация структур для отслеживания вопросов
-                'answered_questions': {},  # {topic: [question_texts...]}
-                'session_questions': {},  # {topic: {question_text: answered_correctly}}
-                'current_question_topic': None
+                'answered_questions': {},  # {topic: QuestionBitset по ID вопросов темы}
+                'session_questions': {},  # {topic: {question_id: answered_correctly}}
+                'current_question_topic': None,
+                'progress_loaded': False
             }
         else:
             self.user_data[user_id]['last_access'] = time.time()
 
-        return self.user_data[user_id]
+        data = self.user_data[user_id]
+        # Прогресс подгружаем лениво: только когда есть банк вопросов для ключей
+        if not data.get('progress_loaded') and self.progress_store is not None and len(question_bank):
+            self._load_progress(user_id, data)
+        return data
 
     def update_user_data(self, user_id, **kwargs):
         """Обновление данных пользователя"""
         data = self.get_user_data(user_id)
         data.update(kwargs)
         data['last_access'] = time.time()
+        if 'current_topic' in kwargs:
+            self.mark_progress_dirty(user_id)
 
     def get_session_stats(self, user_id):
         """Получение статистики сессии"""
         self.cleanup_old_data()
 
+        if user_id not in self.session_stats:
+            # Сохраненная статистика сессии подгружается вместе с прогрессом
+            self.get_user_data(user_id)
+
         if user_id not in self.session_stats:
             self.session_stats[user_id] = {
                 'session_total': 0,
@@ -352,10 +944,16 @@ class UserDataManager:
         return self.session_stats[user_id]
 
     def clear_user_data(self, user_id):
-        """Очистка всех данных пользователя"""
-        for dict_name in [self.user_data, self.session_stats,
-                          self.broadcast_states, self.extend_states]:
-            dict_name.pop(user_id, None)
+        """Очистка всех данных пользователя (включая сохраненный прогресс)"""
+        with self._flush_lock:
+            for dict_name in [self.user_data, self.session_stats,
+                              self.broadcast_states, self.extend_states]:
+                dict_name.pop(user_id, None)
+
+            with self._dirty_lock:
+                self._dirty_progress.pop(user_id, None)
+            if self.progress_store is not None:
+                self.progress_store.delete(user_id)
 
     def get_memory_usage(self):
         """Оценка использования памяти"""
@@ -385,23 +983,65 @@ class UserDataManager:
         if 'answered_questions' not in data:
             data['answered_questions'] = {}
         if topic not in data['answered_questions']:
-            data['answered_questions'][topic] = []
+            offset, size = question_bank.range_for(topic)
+            data['answered_questions'][topic] = QuestionBitset(offset, size)
         return data['answered_questions'][topic]
 
-    def mark_question_answered(self, user_id, topic, question_text, is_correct):
+    def mark_question_answered(self, user_id, topic, question_id, is_correct):
         """Отметка вопроса как отвеченного"""
         session_questions = self.get_session_questions(user_id, topic)
 
         if is_correct:
-            # Если ответ правильный, добавляем в список отвеченных
-            answered_questions = self.get_answered_questions(user_id, topic)
-            if question_text not in answered_questions:
-                answered_questions.append(question_text)
+            # Если ответ правильный, добавляем в множество отвеченных
+            self.get_answered_questions(user_id, topic).add(question_id)
             # В сессии отмечаем как правильно отвеченный
-            session_questions[question_text] = True
+            session_questions[question_id] = True
         else:
             # Если ответ неправильный, отмечаем в сессии
-            session_questions[question_text] = False
+            session_questions[question_id] = False
+
+        sampler = self.get_user_data(user_id).get('topic_samplers', {}).get(topic)
+        if sampler is not None:
+            sampler.record(question_id, is_correct)
+        self.mark_progress_dirty(user_id, topic)
+
+    def get_topic_sampler(self, user_id, topic):
+        """Выборщик вопросов темы на текущую сессию (строится один раз)"""
+        data = self.get_user_data(user_id)
+        samplers = data.setdefault('topic_samplers', {})
+        sampler = samplers.get(topic)
+        if sampler is None:
+            sampler = TopicSampler(
+                question_bank.ids_for(topic),
+                self.get_answered_questions(user_id, topic),
+                self.get_session_questions(user_id, topic)
+            )
+            samplers[topic] = sampler
+        return sampler
+
+    def remap_question_ids(self, id_map, bank):
+        """Перевод ID вопросов после перезагрузки файла (старый ID -> новый ID в bank)"""
+        for data in list(self.user_data.values()):
+            for topic, answered in list(data.get('answered_questions', {}).items()):
+                offset, size = bank.range_for(topic)
+                remapped = QuestionBitset(offset, size)
+                for qid in answered:
+                    if qid in id_map:
+                        remapped.add(id_map[qid])
+                data['answered_questions'][topic] = remapped
+            for topic, session in list(data.get('session_questions', {}).items()):
+                data['session_questions'][topic] = {
+                    id_map[qid]: state for qid, state in session.items() if qid in id_map
+                }
+            # Выборщики содержат старые ID - построятся заново при следующем вопросе
+            data['topic_samplers'] = {}
+            current_id = data.get('current_question_id')
+            if current_id is not None:
+                data['current_question_id'] = id_map.get(current_id)
+                if data['current_question_id'] is None:
+                    # Вопрос исчез из файла - ответить на него уже нельзя
+                    data['numbered_answers'] = {}
+                    data['answers_list'] = []
 
     def clear_topic_session(self, user_id, topic):
         """Очистка сессии для темы"""
@@ -410,224 +1050,676 @@ class UserDataManager:
             data['session_questions'] = {}
         if topic in data['session_questions']:
             data['session_questions'][topic] = {}
-# ============================================================================
-# КЛАСС БАЗЫ ДАННЫХ
-# ============================================================================
-class Database:
-    def __init__(self, db_path: str = 'data/users.db'):
-            self.db_path = db_path
-            self.conn = None  # ВАЖНО: добавляем этот атрибут
-            self.create_data_directory()
-            self.init_database()
-            self.upgrade_database()
-            logger.info(f"✅ База данных инициализирована: {self.db_path}")
+        data.get('topic_samplers', {}).pop(topic, None)
+        self.mark_progress_dirty(user_id, topic)
 
-    def get_connection(self) -> sqlite3.Connection:
-        """Получение соединения с базой данных"""
-        # Простая версия - всегда возвращаем новое соединение
-        conn = sqlite3.connect(self.db_path)
+    # ДОЛГОВРЕМЕННОЕ ХРАНЕНИЕ ПРОГРЕССА
 
-        # Добавляем оптимизации для производительности
-        try:
-            conn.execute('PRAGMA journal_mode=WAL')
-            conn.execute('PRAGMA synchronous=NORMAL')
-            conn.execute('PRAGMA cache_size=10000')
-            conn.execute('PRAGMA temp_store=MEMORY')
-        except:
-            pass  # Игнорируем ошибки если не поддерживается
+    def _load_progress(self, user_id, data):
+        """Подгрузка сохраненного прогресса пользователя в память"""
+        data['progress_loaded'] = True
+        stored = self.progress_store.load(user_id)
+        if not stored:
+            return
 
-        return conn
-    def upgrade_database(self):
-        """Безопасное обновление схемы базы данных"""
-        try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
+        state = stored['state']
+        if state:
+            current_topic, session_total, session_correct = state
+            if current_topic and data.get('current_topic') is None and question_bank.ids_for(current_topic):
+                data['current_topic'] = current_topic
+                data['current_question_topic'] = current_topic
+            if user_id not in self.session_stats:
+                self.session_stats[user_id] = {
+                    'session_total': session_total,
+                    'session_correct': session_correct,
+                    'last_access': time.time()
+                }
+
+        for topic, (answered_keys, wrong_keys) in stored['topics'].items():
+            if not question_bank.ids_for(topic):
+                continue  # Темы больше нет в файле вопросов
+
+            offset, size = question_bank.range_for(topic)
+            answered = QuestionBitset(offset, size)
+            for key in answered_keys:
+                question_id = question_bank.id_by_key.get(key)
+                if question_id is not None:
+                    answered.add(question_id)
+            data['answered_questions'][topic] = answered
+
+            session = {}
+            for key in wrong_keys:
+                question_id = question_bank.id_by_key.get(key)
+                if question_id is not None and question_id not in answered:
+                    session[question_id] = False
+            data['session_questions'][topic] = session
+
+    def mark_progress_dirty(self, user_id, topic=None):
+        """Пометка прогресса для записи в БД (topic=None - только общее состояние)"""
+        if self.progress_store is None:
+            return
+        with self._dirty_lock:
+            topics = self._dirty_progress.setdefault(user_id, set())
+            if topic is not None:
+                topics.add(topic)
+
+    def flush_progress(self) -> int:
+        """Запись накопленных изменений прогресса в БД одной транзакцией"""
+        if self.progress_store is None:
+            return 0
+
+        with self._flush_lock:
+            return self._flush_progress_locked()
+
+    def _flush_progress_locked(self) -> int:
+        with self._dirty_lock:
+            dirty, self._dirty_progress = self._dirty_progress, {}
+        if not dirty:
+            return 0
+
+        state_rows = []
+        progress_rows = []
+        for user_id, topics in dirty.items():
+            data = self.user_data.get(user_id)
+            if data is None or not data.get('progress_loaded'):
+                continue
 
-            # Проверяем существование колонки безопасным способом
-            cursor.execute("PRAGMA table_info(users)")
-            columns = {column[1]: column for column in cursor.fetchall()}
+            stats = self.session_stats.get(user_id, {})
+            state_rows.append((
+                user_id,
+                data.get('current_topic'),
+                stats.get('session_total', 0),
+                stats.get('session_correct', 0)
+            ))
+
+            for topic in topics:
+                answered = data.get('answered_questions', {}).get(topic) or ()
+                session = dict(data.get('session_questions', {}).get(topic, {}))
+                answered_keys = [question_bank.questions[qid]['key'] for qid in answered]
+                wrong_keys = [
+                    question_bank.questions[qid]['key']
+                    for qid, answered_correctly in session.items() if not answered_correctly
+                ]
+                progress_rows.append((user_id, topic, answered_keys, wrong_keys))
+
+        if not self.progress_store.save(state_rows, progress_rows):
+            # Не удалось записать - вернем пометки, попробуем в следующий раз
+            with self._dirty_lock:
+                for user_id, topics in dirty.items():
+                    self._dirty_progress.setdefault(user_id, set()).update(topics)
+            return 0
+
+        return len(state_rows)
+# ============================================================================
+# ПУЛ СОЕДИНЕНИЙ SQLITE
+# ============================================================================
+class _PoolSlot:
+    """Долгоживущее соединение потока и глубина его вложенных заимствований"""
 
-            if 'subscription_purchased' not in columns:
-                # Проверяем версию SQLite
-                cursor.execute("SELECT sqlite_version()")
-                sqlite_version = cursor.fetchone()[0]
-                logger.info(f"🔄 SQLite версия: {sqlite_version}")
+    __slots__ = ('conn', 'depth', 'thread')
 
-                # Безопасное добавление колонки с обработкой ошибок
-                try:
-                    cursor.execute('''
-                    ALTER TABLE users 
-                    ADD COLUMN subscription_purchased BOOLEAN DEFAULT FALSE
-                    ''')
-                    conn.commit()
-                    logger.info("✅ Колонка subscription_purchased добавлена")
-                except sqlite3.OperationalError as e:
-                    if "duplicate column name" in str(e).lower():
-                        logger.info("ℹ️ Колонка subscription_purchased уже существует")
-                    else:
-                        raise
+    def __init__(self, conn, thread):
+        self.conn = conn
+        self.depth = 0
+        self.thread = thread
 
-            conn.close()
 
-        except sqlite3.Error as e:
-            logger.error(f"❌ Ошибка при обновлении базы данных: {e}")
+class PooledConnection:
+    """Соединение, выданное пулом: close() возвращает его в пул, а не закрывает.
 
-    def create_data_directory(self):
-        """Создание директории для данных"""
-        data_dir = os.path.dirname(self.db_path)
-        if not os.path.exists(data_dir):
-            os.makedirs(data_dir, exist_ok=True)
+    Вложенные заимствования в одном потоке получают то же соединение sqlite3.
+    Чтобы commit()/rollback() вложенного помощника не задевали открытую транзакцию
+    вызывающего кода, на глубине > 1 работа идет внутри SAVEPOINT: commit() - это
+    RELEASE (изменения остаются в транзакции внешнего владельца), rollback() - ROLLBACK TO,
+    а close() без commit() откатывает только свою точку сохранения.
+    Правило: вложенные соединения закрываются раньше внешнего (строго вложенно).
+    """
 
-    def init_database(self):
-        """Инициализация базы данных"""
+    def __init__(self, pool, slot, savepoint=None):
+        object.__setattr__(self, '_pool', pool)
+        object.__setattr__(self, '_slot', slot)
+        object.__setattr__(self, '_released', False)
+        object.__setattr__(self, '_savepoint', savepoint)
+        if savepoint:
+            slot.conn.execute(f"SAVEPOINT {savepoint}")
+
+    def __getattr__(self, name):
+        return getattr(self._slot.conn, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._slot.conn, name, value)
+
+    def commit(self):
+        """Фиксация; во вложенном заимствовании - только своей точки сохранения"""
+        if not self._savepoint:
+            return self._slot.conn.commit()
+        # Точка открывается заново: последующие изменения снова изолированы
+        self._slot.conn.execute(f"RELEASE {self._savepoint}")
+        self._slot.conn.execute(f"SAVEPOINT {self._savepoint}")
+
+    def rollback(self):
+        """Откат; во вложенном заимствовании - только до своей точки сохранения"""
+        if not self._savepoint:
+            return self._slot.conn.rollback()
+        self._slot.conn.execute(f"ROLLBACK TO {self._savepoint}")
+
+    def close(self):
+        """Возврат соединения в пул (повторный вызов безопасен)"""
+        if not self._released:
+            object.__setattr__(self, '_released', True)
+            if self._savepoint and self._slot.conn is not None:
+                try:
+                    # Незафиксированное вложенным кодом отбрасывается, как при прежнем close()
+                    self._slot.conn.execute(f"ROLLBACK TO {self._savepoint}")
+                    self._slot.conn.execute(f"RELEASE {self._savepoint}")
+                except sqlite3.Error as e:
+                    logger.warning(f"⚠️ Точка сохранения {self._savepoint} уже снята: {e}")
+            self._pool.release(self._slot)
+
+    def __del__(self):
+        # Страховка для веток, которые забыли вызвать close()
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            self.close()
+        except Exception:
+            pass
 
-            # Таблица пользователей
-            cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                telegram_id INTEGER PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                last_name TEXT,
-                subscription_paid BOOLEAN DEFAULT FALSE,
-                subscription_start_date TIMESTAMP,  -- Изменено на TIMESTAMP
-                subscription_end_date TIMESTAMP,    -- Изменено на TIMESTAMP
-                is_admin BOOLEAN DEFAULT FALSE,
-                is_trial_used BOOLEAN DEFAULT FALSE,
-                last_warning_date DATE,
-                registration_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-            ''')
 
-            # Таблица статистики
-            cursor.execute('''
-            CREATE TABLE IF NOT EXISTS statistics (
-                telegram_id INTEGER PRIMARY KEY,
-                total_answers INTEGER DEFAULT 0,
-                correct_answers INTEGER DEFAULT 0,
-                last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (telegram_id) REFERENCES users (telegram_id) ON DELETE CASCADE
-            )
-            ''')
+class ConnectionPool:
+    """Пул соединений SQLite: одно долгоживущее соединение на рабочий поток"""
 
-            # ТАБЛИЦА ПЛАТЕЖЕЙ - ИСПРАВЛЕННАЯ ВЕРСИЯ
-            cursor.execute('''
-            CREATE TABLE IF NOT EXISTS payments (
-                payment_id TEXT PRIMARY KEY,
-                telegram_id INTEGER NOT NULL,
-                amount REAL DEFAULT 69.00,
-                description TEXT,  -- ДОБАВЛЕНО ОПИСАНИЕ
-                status TEXT DEFAULT 'pending',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                paid_at TIMESTAMP,
-                is_processed BOOLEAN DEFAULT FALSE,
-                FOREIGN KEY (telegram_id) REFERENCES users (telegram_id) ON DELETE CASCADE
-            )
-            ''')
+    PRAGMAS = (
+        'PRAGMA journal_mode=WAL',
+        'PRAGMA synchronous=NORMAL',
+        'PRAGMA cache_size=10000',
+        'PRAGMA temp_store=MEMORY',
+    )
 
-            conn.commit()
-            conn.close()
+    def __init__(self, db_path: str, timeout: float = 30.0):
+        self.db_path = db_path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._slots = []
+        self._lock = Lock()
 
-        except sqlite3.Error as e:
-            logger.info(f"❌ Ошибка при создании базы данных: {e}")
+    def _open(self) -> sqlite3.Connection:
+        """Открытие соединения и однократная настройка PRAGMA"""
+        # check_same_thread=False нужен только для close_all() из другого потока:
+        # каждым соединением пользуется лишь поток-владелец
+        conn = sqlite3.connect(self.db_path, timeout=self.timeout, check_same_thread=False)
+        for pragma in self.PRAGMAS:
+            try:
+                conn.execute(pragma)
+            except sqlite3.Error:
+                pass  # Игнорируем ошибки если не поддерживается
+        return conn
 
+    def _prune_dead_slots(self):
+        """Закрытие соединений потоков, которые уже завершились"""
+        with self._lock:
+            dead = [slot for slot in self._slots if not slot.thread.is_alive()]
+            self._slots = [slot for slot in self._slots if slot.thread.is_alive()]
 
-    def add_user(self, telegram_id: int, username=None, first_name=None, last_name=None, is_admin=False) -> bool:
-        """Добавление пользователя"""
+        for slot in dead:
+            try:
+                if slot.conn is not None:
+                    slot.conn.close()
+            except sqlite3.Error:
+                pass
+            slot.conn = None
+
+    def acquire(self) -> PooledConnection:
+        """Взять соединение текущего потока (создается при первом обращении)"""
+        slot = getattr(self._local, 'slot', None)
+        if slot is None or slot.conn is None:
+            self._prune_dead_slots()
+            slot = _PoolSlot(self._open(), threading.current_thread())
+            self._local.slot = slot
+            with self._lock:
+                self._slots.append(slot)
+
+        if slot.depth == 0:
+            slot.conn.row_factory = None
+        slot.depth += 1
+        # Вложенное заимствование работает в своей точке сохранения (см. PooledConnection)
+        savepoint = f"pool_depth_{slot.depth}" if slot.depth > 1 else None
         try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
+            return PooledConnection(self, slot, savepoint)
+        except sqlite3.Error:
+            slot.depth -= 1
+            raise
+
+    def release(self, slot: _PoolSlot):
+        """Вернуть соединение: при последнем возврате откатываем незавершенную транзакцию"""
+        slot.depth = max(slot.depth - 1, 0)
+        if slot.depth > 0 or slot.conn is None:
+            return
 
-            cursor.execute('SELECT telegram_id FROM users WHERE telegram_id = ?', (telegram_id,))
-            if cursor.fetchone():
-                cursor.execute('''
-                UPDATE users 
-                SET username = ?, first_name = ?, last_name = ?, last_activity = CURRENT_TIMESTAMP
-                WHERE telegram_id = ?
-                ''', (username, first_name, last_name, telegram_id))
-            else:
-                cursor.execute('''
-                INSERT INTO users (telegram_id, username, first_name, last_name, is_admin, registration_date)
-                VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
-                ''', (telegram_id, username, first_name, last_name, is_admin))
+        try:
+            # Как и при прежнем conn.close(): незакоммиченные изменения отбрасываются
+            if slot.conn.in_transaction:
+                slot.conn.rollback()
+            slot.conn.row_factory = None
+        except sqlite3.Error as e:
+            logger.warning(f"⚠️ Соединение SQLite повреждено, будет открыто заново: {e}")
+            try:
+                slot.conn.close()
+            except sqlite3.Error:
+                pass
+            slot.conn = None
 
-            conn.commit()
+    @contextmanager
+    def connection(self):
+        """Контекстный менеджер: взять соединение и гарантированно вернуть его"""
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
             conn.close()
-            return True
 
-        except sqlite3.Error as e:
-            logger.info(f"❌ Ошибка при добавлении пользователя: {e}")
-            return False
+    def close_all(self):
+        """Закрытие всех соединений пула (при завершении работы)"""
+        with self._lock:
+            slots = self._slots
+            self._slots = []
 
-    def get_user(self, telegram_id: int) -> Optional[Dict]:
-        """Получение информации о пользователе с кешированием"""
-        cache_key = f"user_{telegram_id}"
+        for slot in slots:
+            try:
+                if slot.conn is not None:
+                    slot.conn.close()
+            except sqlite3.Error:
+                pass
+            slot.conn = None
 
-        # Пробуем получить из кеша
-        cached = cache.get(cache_key)
-        if cached is not None:
-            return cached
+        if slots:
+            logger.info(f"🔒 Закрыто соединений SQLite: {len(slots)}")
 
-        try:
-            conn = self.get_connection()
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
+# ============================================================================
+# КЛАСС БАЗЫ ДАННЫХ
+# ============================================================================
+# INSERT ... RETURNING появился в SQLite 3.35; на старых версиях дочитываем SELECT-ом
+SQLITE_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
 
-            cursor.execute('SELECT * FROM users WHERE telegram_id = ?', (telegram_id,))
-            row = cursor.fetchone()
-            conn.close()
 
-            if row:
-                result = dict(row)
-                cache.set(cache_key, result)
-                return result
+def epoch_sql(column: str, end_of_day: bool = False) -> str:
+    """SQL-выражение: naive UTC дата из TEXT-колонки -> Unix time.
 
-            cache.set(cache_key, None)
-            return None
+    end_of_day - для дат окончания: дата без времени означает 23:59:59 этого дня.
+    """
+    if not end_of_day:
+        return (f"CASE WHEN {column} IS NULL THEN NULL "
+                f"ELSE CAST(strftime('%s', {column}) AS INTEGER) END")
+    return (f"CASE WHEN {column} IS NULL THEN NULL "
+            f"WHEN length({column}) = 10 THEN CAST(strftime('%s', {column}) AS INTEGER) + 86399 "
+            f"ELSE CAST(strftime('%s', {column}) AS INTEGER) END")
+
+
+# Целочисленные копии дат (Unix time, UTC) для индексируемых сравнений.
+# TEXT-колонки остаются основными для записи, копии поддерживают триггеры.
+EPOCH_COLUMNS = {
+    'users': {
+        'subscription_start_ts': 'subscription_start_date',
+        'subscription_end_ts': 'subscription_end_date',
+    },
+    'payments': {
+        'created_ts': 'created_at',
+        'paid_ts': 'paid_at',
+    },
+}
+EPOCH_TABLE_KEYS = {'users': 'telegram_id', 'payments': 'payment_id'}
+# Колонки-окончания: дата без времени действует до конца дня
+EPOCH_END_OF_DAY = {'subscription_end_ts'}
 
-        except sqlite3.Error as e:
-            logger.info(f"❌ Ошибка при получении пользователя: {e}")
-            return None
 
-    def check_subscription(self, telegram_id: int) -> bool:
-        """Проверка подписки с корректной обработкой временных зон"""
-        try:
-            user = self.get_user(telegram_id)
-            if not user:
-                return False
+class Database:
+    # Упорядоченные шаги миграции схемы: (версия, описание, метод).
+    # Версия применённой схемы хранится в PRAGMA user_version. Шаги идемпотентны,
+    # поэтому базы, созданные до появления версий (user_version = 0), проходят их без ошибок.
+    # Новые изменения схемы добавляются только новым шагом в конец списка.
+    MIGRATIONS = (
+        (1, 'Базовые таблицы users, statistics, payments', '_migration_base_tables'),
+        (2, 'Колонка users.subscription_purchased', '_migration_subscription_purchased'),
+        (3, 'Таблицы прогресса викторины', '_migration_quiz_progress'),
+        (4, 'Целочисленные колонки дат', '_add_epoch_columns'),
+        (5, 'Индексы горячих запросов users и payments', '_migration_hot_query_indexes'),
+        (6, 'Задания массовой рассылки', '_migration_broadcast_jobs'),
+    )
 
-            if user.get('is_admin'):
-                return True
+    def __init__(self, db_path: str = 'data/users.db'):
+            self.db_path = db_path
+            self.pool = ConnectionPool(db_path)
+            self.write_buffer = WriteBehindBuffer(self)
+            self.create_data_directory()
+            if not self.migrate():
+                # На частично мигрированной схеме (нет колонок *_ts, триггеров) работать нельзя
+                self.pool.close_all()
+                raise RuntimeError(f"❌ Не удалось применить миграции схемы БД ({self.db_path})")
+            if not SQLITE_HAS_RETURNING:
+                logger.warning(f"⚠️ SQLite {sqlite3.sqlite_version} без RETURNING, UPSERT будет дочитываться SELECT-ом")
+            logger.info(f"✅ База данных инициализирована: {self.db_path}")
 
-            if not user.get('subscription_paid'):
-                return False
+    def get_connection(self) -> PooledConnection:
+        """Получение соединения из пула (conn.close() возвращает его в пул)"""
+        return self.pool.acquire()
+
+    def connection(self):
+        """Контекстный менеджер для заимствования соединения из пула"""
+        return self.pool.connection()
+
+    @staticmethod
+    def upsert_returning(cursor, sql: str, params: tuple, table: str, columns: str, telegram_id: int):
+        """UPSERT, возвращающий свежую строку одним оператором (telegram_id - ключ таблицы)"""
+        if SQLITE_HAS_RETURNING:
+            cursor.execute(f"{sql} RETURNING {columns}", params)
+            return cursor.fetchone()
+
+        cursor.execute(sql, params)
+        cursor.execute(f"SELECT {columns} FROM {table} WHERE telegram_id = ?", (telegram_id,))
+        return cursor.fetchone()
+
+    def close(self):
+        """Закрытие всех соединений с базой данных"""
+        self.write_buffer.stop()
+        self.pool.close_all()
+
+    @property
+    def schema_version(self) -> int:
+        """Последняя версия схемы, известная коду"""
+        return self.MIGRATIONS[-1][0]
+
+    def get_user_version(self) -> int:
+        """Версия схемы, записанная в файле базы (PRAGMA user_version)"""
+        conn = self.get_connection()
+        try:
+            return conn.execute("PRAGMA user_version").fetchone()[0]
+        finally:
+            conn.close()
 
-            end_date_str = user.get('subscription_end_date')
-            if not end_date_str:
-                return False
+    def migrate(self) -> bool:
+        """Применение недостающих шагов миграции, каждый в отдельной транзакции"""
+        current = self.get_user_version()
+        pending = [step for step in self.MIGRATIONS if step[0] > current]
 
-            # ВСЕГДА ХРАНИМ В UTC И РАБОТАЕМ С UTC
-            try:
-                # Парсим как naive
-                end_naive = datetime.strptime(end_date_str, '%Y-%m-%d %H:%M:%S')
-            except ValueError:
+        if not pending:
+            if current > self.schema_version:
+                logger.warning(f"⚠️ Версия схемы БД ({current}) новее кода ({self.schema_version})")
+            else:
+                logger.info(f"✅ Схема БД актуальна (версия {current})")
+            return True
+
+        logger.info(f"🔄 Миграция схемы БД: версия {current} -> {self.schema_version}")
+        conn = self.get_connection()
+        try:
+            cursor = conn.cursor()
+            for version, description, method in pending:
                 try:
-                    end_naive = datetime.strptime(end_date_str, '%Y-%m-%d')
-                    # Добавляем время 23:59:59 для совместимости
-                    end_naive = end_naive.replace(hour=23, minute=59, second=59)
-                except ValueError:
+                    # IMMEDIATE: параллельный процесс не начнет ту же миграцию между проверкой и записью
+                    cursor.execute("BEGIN IMMEDIATE")
+                    getattr(self, method)(cursor)
+                    # PRAGMA user_version транзакционна: версия фиксируется вместе с изменениями
+                    cursor.execute(f"PRAGMA user_version = {int(version)}")
+                    conn.commit()
+                    logger.info(f"✅ Миграция {version}: {description}")
+                except sqlite3.Error as e:
+                    conn.rollback()
+                    logger.error(f"❌ Ошибка миграции {version} ({description}): {e}")
+                    logger.error(traceback.format_exc())
                     return False
+            return True
+        finally:
+            conn.close()
 
-            # Предполагаем, что в БД время в UTC, и делаем его aware
-            end_aware = pytz.UTC.localize(end_naive)
-            now_aware = datetime.now(pytz.UTC)
+    def _migration_base_tables(self, cursor):
+        """Таблицы пользователей, статистики и платежей"""
+        # Таблица пользователей
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            telegram_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            subscription_paid BOOLEAN DEFAULT FALSE,
+            subscription_start_date TIMESTAMP,  -- Изменено на TIMESTAMP
+            subscription_end_date TIMESTAMP,    -- Изменено на TIMESTAMP
+            is_admin BOOLEAN DEFAULT FALSE,
+            is_trial_used BOOLEAN DEFAULT FALSE,
+            last_warning_date DATE,
+            registration_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
 
-            return end_aware > now_aware
+        # Таблица статистики
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS statistics (
+            telegram_id INTEGER PRIMARY KEY,
+            total_answers INTEGER DEFAULT 0,
+            correct_answers INTEGER DEFAULT 0,
+            last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (telegram_id) REFERENCES users (telegram_id) ON DELETE CASCADE
+        )
+        ''')
 
-        except Exception as e:
+        # ТАБЛИЦА ПЛАТЕЖЕЙ - ИСПРАВЛЕННАЯ ВЕРСИЯ
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS payments (
+            payment_id TEXT PRIMARY KEY,
+            telegram_id INTEGER NOT NULL,
+            amount REAL DEFAULT 69.00,
+            description TEXT,  -- ДОБАВЛЕНО ОПИСАНИЕ
+            status TEXT DEFAULT 'pending',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            paid_at TIMESTAMP,
+            is_processed BOOLEAN DEFAULT FALSE,
+            FOREIGN KEY (telegram_id) REFERENCES users (telegram_id) ON DELETE CASCADE
+        )
+        ''')
+
+    def _migration_subscription_purchased(self, cursor):
+        """Флаг покупки подписки (в старых базах колонка могла быть добавлена вручную)"""
+        cursor.execute("PRAGMA table_info(users)")
+        if 'subscription_purchased' not in {column[1] for column in cursor.fetchall()}:
+            cursor.execute('''
+            ALTER TABLE users 
+            ADD COLUMN subscription_purchased BOOLEAN DEFAULT FALSE
+            ''')
+
+    def _migration_quiz_progress(self, cursor):
+        """Прогресс викторины: ключи вопросов (QuestionBank.key) упакованы в BLOB"""
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS quiz_progress (
+            telegram_id INTEGER NOT NULL,
+            topic TEXT NOT NULL,
+            answered_keys BLOB,  -- правильно отвеченные вопросы темы
+            wrong_keys BLOB,     -- неправильно отвеченные в текущей сессии
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (telegram_id, topic)
+        )
+        ''')
+
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS quiz_state (
+            telegram_id INTEGER PRIMARY KEY,
+            current_topic TEXT,
+            session_total INTEGER DEFAULT 0,
+            session_correct INTEGER DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+
+    def _add_epoch_columns(self, cursor):
+        """Целочисленные колонки дат: добавление, заполнение, индексы и триггеры синхронизации"""
+        for table, columns in EPOCH_COLUMNS.items():
+            cursor.execute(f"PRAGMA table_info({table})")
+            existing = {column[1] for column in cursor.fetchall()}
+
+            for ts_column, text_column in columns.items():
+                if ts_column not in existing:
+                    cursor.execute(f"ALTER TABLE {table} ADD COLUMN {ts_column} INTEGER")
+                    cursor.execute(f'''
+                    UPDATE {table} SET {ts_column} = {epoch_sql(text_column, ts_column in EPOCH_END_OF_DAY)}
+                    WHERE {text_column} IS NOT NULL
+                    ''')
+                    logger.info(f"✅ Колонка {table}.{ts_column} добавлена и заполнена")
+                cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_{ts_column} ON {table}({ts_column})")
+
+            self._create_epoch_triggers(cursor, table)
+
+    @staticmethod
+    def _create_epoch_triggers(cursor, table: str):
+        """Триггеры, пересчитывающие *_ts при вставке и изменении TEXT-дат"""
+        columns = EPOCH_COLUMNS[table]
+        key = EPOCH_TABLE_KEYS[table]
+        assignments = ', '.join(
+            f"{ts_column} = {epoch_sql('NEW.' + text_column, ts_column in EPOCH_END_OF_DAY)}"
+            for ts_column, text_column in columns.items()
+        )
+        watched = ', '.join(columns.values())
+        cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_epoch_insert AFTER INSERT ON {table}
+        BEGIN
+            UPDATE {table} SET {assignments} WHERE {key} = NEW.{key};
+        END
+        ''')
+        cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_epoch_update AFTER UPDATE OF {watched} ON {table}
+        BEGIN
+            UPDATE {table} SET {assignments} WHERE {key} = NEW.{key};
+        END
+        ''')
+
+    def _migration_hot_query_indexes(self, cursor):
+        """Вторичные и частичные индексы под запросы синхронизации, очистки и проверок"""
+        # Необработанные платежи: синхронизация (status = 'succeeded') и очистка старых
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_payments_unprocessed
+        ON payments(status, paid_ts, created_ts) WHERE is_processed = FALSE
+        ''')
+        # Успешные платежи с JOIN/EXISTS к users по telegram_id
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_payments_status_user ON payments(status, telegram_id)")
+        # Последний платеж пользователя
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_payments_user_created ON payments(telegram_id, created_at)")
+
+        # Активные подписки и их истечение
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_paid_end ON users(subscription_paid, subscription_end_ts)")
+        # Администраторов единицы - частичный индекс почти ничего не весит;
+        # по is_admin, чтобы покрывать и условие выборки администраторов
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_admins ON users(is_admin) WHERE is_admin = TRUE")
+        # Список пользователей в админке отсортирован по дате регистрации
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_registration ON users(registration_date)")
+
+    def _migration_broadcast_jobs(self, cursor):
+        """Задания рассылки и статус доставки каждому получателю"""
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_chat_id INTEGER NOT NULL,
+            payload TEXT NOT NULL,           -- JSON: текст и file_id медиа
+            active_only BOOLEAN DEFAULT FALSE,
+            status TEXT DEFAULT 'running',   -- running / completed / failed
+            status_message_id INTEGER,
+            total INTEGER DEFAULT 0,
+            sent INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+        ''')
+
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_recipients (
+            job_id INTEGER NOT NULL,
+            telegram_id INTEGER NOT NULL,
+            status TEXT DEFAULT 'pending',   -- pending / retry / sent / failed
+            attempts INTEGER DEFAULT 0,
+            error TEXT,
+            updated_at TIMESTAMP,
+            PRIMARY KEY (job_id, telegram_id),
+            FOREIGN KEY (job_id) REFERENCES broadcast_jobs (job_id) ON DELETE CASCADE
+        )
+        ''')
+        # Неотправленные получатели задания - для постраничного обхода
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_broadcast_recipients_pending
+        ON broadcast_recipients(job_id, telegram_id) WHERE status IN ('pending', 'retry')
+        ''')
+
+    def create_data_directory(self):
+        """Создание директории для данных"""
+        data_dir = os.path.dirname(self.db_path)
+        if not os.path.exists(data_dir):
+            os.makedirs(data_dir, exist_ok=True)
+
+    def add_user(self, telegram_id: int, username=None, first_name=None, last_name=None, is_admin=False) -> bool:
+        """Добавление пользователя"""
+        try:
+            conn = self.get_connection()
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+
+            row = self.upsert_returning(cursor, '''
+            INSERT INTO users (telegram_id, username, first_name, last_name, is_admin, registration_date)
+            VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(telegram_id) DO UPDATE SET
+                username = excluded.username,
+                first_name = excluded.first_name,
+                last_name = excluded.last_name,
+                last_activity = CURRENT_TIMESTAMP
+            ''', (telegram_id, username, first_name, last_name, is_admin), 'users', '*', telegram_id)
+
+            conn.commit()
+            conn.close()
+            invalidate_user_state(telegram_id)
+            if row:
+                # Строка уже свежая - кладем ее в кеш вместо повторного чтения
+                cache.set(f"user_{telegram_id}", dict(row))
+            return True
+
+        except sqlite3.Error as e:
+            logger.info(f"❌ Ошибка при добавлении пользователя: {e}")
+            return False
+
+    def get_user(self, telegram_id: int) -> Optional[Dict]:
+        """Получение информации о пользователе с кешированием"""
+        cache_key = f"user_{telegram_id}"
+
+        # Пробуем получить из кеша (None - тоже закешированный ответ "нет такого")
+        cached = cache.get(cache_key, _CACHE_MISS)
+        if cached is not _CACHE_MISS:
+            return cached
+
+        try:
+            conn = self.get_connection()
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+
+            cursor.execute('SELECT * FROM users WHERE telegram_id = ?', (telegram_id,))
+            row = cursor.fetchone()
+            conn.close()
+
+            if row:
+                result = dict(row)
+                cache.set(cache_key, result)
+                return result
+
+            cache.set(cache_key, None)
+            return None
+
+        except sqlite3.Error as e:
+            logger.info(f"❌ Ошибка при получении пользователя: {e}")
+            return None
+
+    def check_subscription(self, telegram_id: int) -> bool:
+        """Проверка подписки с корректной обработкой временных зон"""
+        try:
+            verdict = subscription_cache.get(telegram_id)
+            if verdict is None:
+                # ВСЕГДА ХРАНИМ В UTC И РАБОТАЕМ С UTC
+                verdict = subscription_cache.remember(telegram_id, self.get_user(telegram_id))
+
+            is_active, is_admin = verdict
+            return is_active or is_admin
+
+        except Exception as e:
             logger.error(f"❌ Ошибка при проверке подписки: {e}")
             return False
 
@@ -677,9 +1769,7 @@ class Database:
                 conn.close()
 
             if updated:  # ✅ Логируем ТОЛЬКО если было обновление
-                # Инвалидация кеша - удаляем оба ключа по одному разу
-                cache.delete(f"user_{telegram_id}")
-                cache.delete(f"subscription_{telegram_id}")
+                invalidate_user_state(telegram_id)
                 logger.info(f"✅ Подписка пользователя {telegram_id} обновлена")
 
             return True
@@ -702,119 +1792,78 @@ class Database:
             return False
 
     def update_activity(self, telegram_id: int) -> bool:
-        """Обновление времени последней активности"""
-        try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-
-            cursor.execute('''
-            UPDATE users 
-            SET last_activity = CURRENT_TIMESTAMP
-            WHERE telegram_id = ?
-            ''', (telegram_id,))
-
-            conn.commit()
-            conn.close()
-            return True
-
-        except sqlite3.Error as e:
-            logger.info(f"❌ Ошибка при обновлении активности: {e}")
-            return False
+        """Обновление времени последней активности (запись в БД пачкой, см. WriteBehindBuffer)"""
+        self.write_buffer.touch_activity(telegram_id)
+        return True
 
     def get_user_statistics(self, telegram_id: int) -> Optional[Dict]:
-        """Получение статистики пользователя"""
+        """Получение статистики пользователя (с учетом еще не записанных ответов)"""
         try:
-            conn = self.get_connection()
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-
-            cursor.execute('SELECT * FROM statistics WHERE telegram_id = ?', (telegram_id,))
-            row = cursor.fetchone()
+            # Строка БД и хвост буфера согласованы без ожидания сброса буфера
+            row, pending_total, pending_correct = self.write_buffer.snapshot(
+                telegram_id, self._load_statistics_row
+            )
 
             if row:
                 stats = dict(row)
-                conn.close()
-                return stats
-
-            # Создаем запись если её нет
-            self.init_user_statistics(telegram_id)
-
-            # Получаем созданную запись
-            cursor.execute('SELECT * FROM statistics WHERE telegram_id = ?', (telegram_id,))
-            row = cursor.fetchone()
-            conn.close()
-
-            if row:
-                return dict(row)
+            else:
+                stats = {
+                    'telegram_id': telegram_id,
+                    'total_answers': 0,
+                    'correct_answers': 0,
+                    'last_updated': datetime.now(pytz.UTC).strftime('%Y-%m-%d %H:%M:%S')
+                }
 
-            return {
-                'telegram_id': telegram_id,
-                'total_answers': 0,
-                'correct_answers': 0,
-                'last_updated': datetime.now(pytz.UTC).strftime('%Y-%m-%d %H:%M:%S')
-            }
+            stats['total_answers'] += pending_total
+            stats['correct_answers'] += pending_correct
+            return stats
 
         except sqlite3.Error as e:
             logger.info(f"❌ Ошибка при получении статистики: {e}")
             return None
 
-    def init_user_statistics(self, telegram_id: int) -> bool:
-        """Инициализация статистики пользователя"""
+    def _load_statistics_row(self, telegram_id: int) -> Optional[Dict]:
+        """Строка statistics из БД (создается, если ее нет)"""
+        conn = self.get_connection()
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+
+        cursor.execute('SELECT * FROM statistics WHERE telegram_id = ?', (telegram_id,))
+        row = cursor.fetchone()
+        conn.close()
+
+        # Создаем запись если её нет (UPSERT сразу вернет ее)
+        return dict(row) if row else self.init_user_statistics(telegram_id)
+
+    def init_user_statistics(self, telegram_id: int) -> Optional[Dict]:
+        """Инициализация статистики пользователя; возвращает строку статистики"""
         try:
             conn = self.get_connection()
+            conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
 
-            # Проверяем, существует ли уже запись
-            cursor.execute('SELECT telegram_id FROM statistics WHERE telegram_id = ?', (telegram_id,))
-            if cursor.fetchone():
-                conn.close()
-                return True
-
-            # Создаем новую запись
-            cursor.execute('''
+            # Существующую запись не трогаем, но все равно получаем ее в ответ
+            row = self.upsert_returning(cursor, '''
             INSERT INTO statistics (telegram_id, total_answers, correct_answers, last_updated)
             VALUES (?, 0, 0, CURRENT_TIMESTAMP)
-            ''', (telegram_id,))
+            ON CONFLICT(telegram_id) DO UPDATE SET last_updated = statistics.last_updated
+            ''', (telegram_id,), 'statistics', '*', telegram_id)
 
             conn.commit()
             conn.close()
-            return True
+            return dict(row) if row else None
 
         except sqlite3.Error as e:
             logger.info(f"❌ Ошибка при инициализации статистики: {e}")
-            return False
-
-    def update_statistics(self, telegram_id: int, is_correct: bool) -> bool:
-        """Обновление статистики"""
-        try:
-            self.init_user_statistics(telegram_id)
-
-            conn = self.get_connection()
-            cursor = conn.cursor()
-
-            if is_correct:
-                cursor.execute('''
-                UPDATE statistics 
-                SET total_answers = total_answers + 1,
-                    correct_answers = correct_answers + 1,
-                    last_updated = CURRENT_TIMESTAMP
-                WHERE telegram_id = ?
-                ''', (telegram_id,))
-            else:
-                cursor.execute('''
-                UPDATE statistics 
-                SET total_answers = total_answers + 1,
-                    last_updated = CURRENT_TIMESTAMP
-                WHERE telegram_id = ?
-                ''', (telegram_id,))
+            return None
 
-            conn.commit()
-            conn.close()
-            return True
+    def update_statistics(self, telegram_id: int, is_correct: bool) -> Optional[Dict]:
+        """Обновление статистики (запись в БД пачкой, см. WriteBehindBuffer).
 
-        except sqlite3.Error as e:
-            logger.info(f"❌ Ошибка при обновлении статистики: {e}")
-            return False
+        Возвращает итоги пользователя с учетом этого ответа.
+        """
+        self.write_buffer.add_answer(telegram_id, is_correct)
+        return self.get_user_statistics(telegram_id)
 
     def get_admin_ids(self) -> List[int]:
         """Получение ID администраторов"""
@@ -822,7 +1871,7 @@ class Database:
             conn = self.get_connection()
             cursor = conn.cursor()
 
-            cursor.execute('SELECT telegram_id FROM users WHERE is_admin = TRUE')
+            cursor.execute(self.ADMIN_IDS_SQL)
             admin_ids = [row[0] for row in cursor.fetchall()]
             conn.close()
 
@@ -849,9 +1898,56 @@ class Database:
             logger.info(f"❌ Ошибка при получении списка пользователей: {e}")
             return []
 
+    # Активный получатель: администратор или оплаченная неистекшая подписка (как в check_subscription).
+    # Обе ветки UNION идут по индексам idx_users_paid_end и idx_users_admins.
+    ACTIVE_RECIPIENTS_SQL = '''
+    SELECT telegram_id FROM users WHERE subscription_paid = TRUE AND subscription_end_ts > :now
+    UNION
+    SELECT telegram_id FROM users WHERE is_admin = TRUE
+    '''
+    ADMIN_IDS_SQL = 'SELECT telegram_id FROM users WHERE is_admin = TRUE'
+
+    def iter_recipient_ids(self, active_only=False, batch_size=1000):
+        """Потоковый обход id получателей рассылки: отбор в SQL, в памяти не больше batch_size строк"""
+        if active_only:
+            sql, params = self.ACTIVE_RECIPIENTS_SQL, {'now': int(time.time())}
+        else:
+            sql, params = "SELECT telegram_id FROM users", {}
+
+        conn = self.get_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row[0]
+        finally:
+            conn.close()
+
+    def count_recipients(self, active_only=False) -> int:
+        """Число получателей рассылки без загрузки строк пользователей"""
+        try:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            if active_only:
+                cursor.execute(f"SELECT COUNT(*) FROM ({self.ACTIVE_RECIPIENTS_SQL})", {'now': int(time.time())})
+            else:
+                cursor.execute("SELECT COUNT(*) FROM users")
+            count = cursor.fetchone()[0]
+            conn.close()
+            return count
+
+        except sqlite3.Error as e:
+            logger.error(f"❌ Ошибка при подсчете получателей рассылки: {e}")
+            return 0
+
     def get_all_statistics(self) -> List[Dict]:
         """Получение статистики всех пользователей"""
         try:
+            self.write_buffer.flush()
             conn = self.get_connection()
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
@@ -876,6 +1972,7 @@ class Database:
     def get_top_users(self, limit=10) -> List[Dict]:
         """Получение топа пользователей"""
         try:
+            self.write_buffer.flush()
             conn = self.get_connection()
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
@@ -913,29 +2010,27 @@ class Database:
     def reset_user_statistics(self, telegram_id: int) -> bool:
         """Сброс статистики пользователя"""
         try:
+            # Неотправленные ответы не должны «воскресить» статистику после сброса
+            self.write_buffer.discard_statistics(telegram_id)
+
             conn = self.get_connection()
+            conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
 
-            # Сначала проверяем существование записи
-            cursor.execute('SELECT telegram_id FROM statistics WHERE telegram_id = ?', (telegram_id,))
-            if not cursor.fetchone():
-                # Создаем запись если её нет
-                cursor.execute('''
-                INSERT INTO statistics (telegram_id, total_answers, correct_answers, last_updated)
-                VALUES (?, 0, 0, CURRENT_TIMESTAMP)
-                ''', (telegram_id,))
-            else:
-                # Обновляем существующую
-                cursor.execute('''
-                UPDATE statistics 
-                SET total_answers = 0,
-                    correct_answers = 0,
-                    last_updated = CURRENT_TIMESTAMP
-                WHERE telegram_id = ?
-                ''', (telegram_id,))
+            # Создаем запись или обнуляем существующую одним оператором
+            row = self.upsert_returning(cursor, '''
+            INSERT INTO statistics (telegram_id, total_answers, correct_answers, last_updated)
+            VALUES (?, 0, 0, CURRENT_TIMESTAMP)
+            ON CONFLICT(telegram_id) DO UPDATE SET
+                total_answers = 0,
+                correct_answers = 0,
+                last_updated = CURRENT_TIMESTAMP
+            ''', (telegram_id,), 'statistics', '*', telegram_id)
 
             conn.commit()
             conn.close()
+            if row:
+                self.write_buffer.remember_statistics(dict(row))
             logger.info(f"✅ Статистика пользователя {telegram_id} сброшена")
             return True
 
@@ -995,6 +2090,7 @@ class Database:
 
             conn.commit()
             conn.close()
+            invalidate_user_state(telegram_id)
 
             status = "назначен" if is_admin else "снят"
             logger.info(f"✅ Пользователь {telegram_id} {status} администратором")
@@ -1031,8 +2127,7 @@ class Database:
             conn.close()
 
             # ✅ Очищаем кэш
-            cache.delete(f"user_{telegram_id}")
-            cache.delete(f"subscription_{telegram_id}")
+            invalidate_user_state(telegram_id)
 
             logger.info(f"✅ Пользователю {telegram_id} выдана подписка до {end_str}")
             return True
@@ -1100,8 +2195,7 @@ class Database:
             conn.commit()
             conn.close()
 
-            cache_key = f"user_{telegram_id}"
-            cache.delete(cache_key)
+            invalidate_user_state(telegram_id)
 
             logger.info(
                 f"✅ Подписка пользователя {telegram_id} продлена до {new_end_str} (+{days} дней, +{hours} часов)")
@@ -1112,8 +2206,12 @@ class Database:
             logger.error(traceback.format_exc())
             return False
 
-    def extend_all_active_subscriptions(self, hours: int = 0, days: int = 0) -> dict:
-        """Продление подписки всем пользователям - ИСПРАВЛЕНО: ВСЕ В UTC"""
+    def extend_all_active_subscriptions(self, hours: int = 0, days: int = 0, on_progress=None) -> dict:
+        """Продление подписки всем пользователям - ИСПРАВЛЕНО: ВСЕ В UTC
+
+        on_progress(обработано, всего, успешно, ошибок) вызывается после уведомления каждого
+        продленного пользователя (долгая часть операции) и еще раз по завершении - с обработано = всего.
+        """
         try:
             logger.info(f"🔄 Начинаю массовое продление подписок: +{days} дней, +{hours} часов")
 
@@ -1126,7 +2224,7 @@ class Database:
 
             # Получаем всех пользователей с активными подписками
             cursor.execute('''
-            SELECT telegram_id, subscription_end_date, username, first_name
+            SELECT telegram_id, subscription_end_date, subscription_end_ts, username, first_name
             FROM users 
             WHERE subscription_paid = TRUE 
             AND subscription_end_date IS NOT NULL
@@ -1141,29 +2239,26 @@ class Database:
                 'failed': 0,
                 'errors': []
             }
+            # Уведомления - только после commit: отправка идет минутами, а транзакция
+            # держала бы блокировку записи SQLite для всех остальных
+            notifications = []
 
             for user_data in users:
                 try:
                     telegram_id = user_data[0]
                     current_end_date_str = user_data[1]
+                    current_end_ts = user_data[2]
 
                     logger.info(f"🔄 Обработка пользователя {telegram_id}, текущая дата: {current_end_date_str}")
 
-                    # Парсим дату из БД (она ВСЕГДА naive, но мы ЗНАЕМ что это UTC)
-                    try:
-                        current_end_naive = datetime.strptime(current_end_date_str, '%Y-%m-%d %H:%M:%S')
-                    except ValueError:
-                        try:
-                            current_end_naive = datetime.strptime(current_end_date_str, '%Y-%m-%d')
-                            current_end_naive = current_end_naive.replace(hour=23, minute=59, second=59)
-                        except ValueError as e:
-                            logger.error(f"   ❌ Ошибка парсинга даты: {e}")
-                            results['failed'] += 1
-                            results['errors'].append(f"{telegram_id}: неверный формат даты")
-                            continue
-
-                    # ДЕЛАЕМ naive -> aware (UTC) ДЛЯ СРАВНЕНИЯ
-                    current_end_aware = pytz.UTC.localize(current_end_naive)
+                    # Дата уже разобрана в БД (subscription_end_ts, UTC)
+                    if current_end_ts is None:
+                        logger.error(f"   ❌ Ошибка парсинга даты: {current_end_date_str!r}")
+                        results['failed'] += 1
+                        results['errors'].append(f"{telegram_id}: неверный формат даты")
+                        continue
+
+                    current_end_aware = datetime.fromtimestamp(current_end_ts, pytz.UTC)
 
                     # ТЕПЕРЬ СРАВНИВАЕМ aware С aware
                     if current_end_aware > now_utc:
@@ -1191,27 +2286,7 @@ class Database:
                     if cursor.rowcount > 0:
                         logger.info(f"   ✅ Успешно обновлено для пользователя {telegram_id}")
                         results['success'] += 1
-
-                        # Отправляем уведомление пользователю
-                        try:
-                            # Конвертируем UTC в локальное время для уведомления
-                            local_tz = pytz_timezone('Asia/Novosibirsk')
-                            new_end_local = new_end_aware.astimezone(local_tz)
-                            end_str_local = new_end_local.strftime('%d.%m.%Y в %H:%M')
-
-                            notification = f"🎉 <b>Ваша подписка продлена!</b>\n\n"
-                            if days > 0 and hours > 0:
-                                notification += f"⏱️ Срок: +{days} дн. {hours} ч.\n"
-                            elif days > 0:
-                                notification += f"⏱️ Срок: +{days} дн.\n"
-                            elif hours > 0:
-                                notification += f"⏱️ Срок: +{hours} ч.\n"
-                            notification += f"📅 Действует до: {end_str_local}"
-
-                            bot.send_message(telegram_id, notification, parse_mode='HTML')
-                            logger.info(f"   ✅ Уведомление отправлено пользователю {telegram_id}")
-                        except Exception as e:
-                            logger.warning(f"   ⚠️ Не удалось отправить уведомление {telegram_id}: {e}")
+                        notifications.append((telegram_id, new_end_aware))
 
                     else:
                         logger.error(f"   ❌ Нет обновленных строк для пользователя {telegram_id}")
@@ -1225,127 +2300,1391 @@ class Database:
                     logger.error(f"❌ Ошибка при продлении подписки пользователя {telegram_id}: {e}")
                     logger.error(traceback.format_exc())
 
-            conn.commit()
-            logger.info(f"💾 Изменения сохранены в БД")
+            conn.commit()
+            logger.info(f"💾 Изменения сохранены в БД")
+            conn.close()
+            # Даты окончания изменились массово - сбрасываем все вердикты и кучу окончаний
+            subscription_cache.clear()
+            expiry_scheduler.rebuild()
+
+            # Отправляем уведомления пользователям в полосе рассылки, не мешая интерактивным ответам
+            local_tz = pytz_timezone('Asia/Novosibirsk')
+            for notified, (telegram_id, new_end_aware) in enumerate(notifications, 1):
+                try:
+                    # Конвертируем UTC в локальное время для уведомления
+                    end_str_local = new_end_aware.astimezone(local_tz).strftime('%d.%m.%Y в %H:%M')
+
+                    notification = f"🎉 <b>Ваша подписка продлена!</b>\n\n"
+                    if days > 0 and hours > 0:
+                        notification += f"⏱️ Срок: +{days} дн. {hours} ч.\n"
+                    elif days > 0:
+                        notification += f"⏱️ Срок: +{days} дн.\n"
+                    elif hours > 0:
+                        notification += f"⏱️ Срок: +{hours} ч.\n"
+                    notification += f"📅 Действует до: {end_str_local}"
+
+                    with outbound.broadcast():
+                        bot.send_message(telegram_id, notification, parse_mode='HTML')
+                    logger.info(f"   ✅ Уведомление отправлено пользователю {telegram_id}")
+                except Exception as e:
+                    logger.warning(f"   ⚠️ Не удалось отправить уведомление {telegram_id}: {e}")
+                if on_progress is not None:
+                    # Пользователи с ошибкой обновления уже обработаны - уведомлять их не нужно
+                    on_progress(results['failed'] + notified, results['total'], results['success'], results['failed'])
+
+            if on_progress is not None:
+                on_progress(results['total'], results['total'], results['success'], results['failed'])
+
+            logger.info(f"✅ Массовое продление завершено: успешно {results['success']}, ошибок {results['failed']}")
+            return results
+
+        except Exception as e:
+            logger.error(f"❌ Критическая ошибка при массовом продлении подписок: {e}")
+            logger.error(traceback.format_exc())
+            return {'total': 0, 'success': 0, 'failed': 0, 'errors': [str(e)]}
+
+    def create_payment(self, payment_id: str, telegram_id: int, amount: float, description: str) -> bool:
+        """Создание записи о платеже"""
+        try:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+
+            cursor.execute('''
+            INSERT INTO payments (payment_id, telegram_id, amount, description, status)
+            VALUES (?, ?, ?, ?, 'pending')
+            ''', (payment_id, telegram_id, amount, description))
+
+            conn.commit()
+            conn.close()
+            return True
+        except sqlite3.Error as e:
+            logger.info(f"❌ Ошибка при создании платежа: {e}")
+            return False
+
+    def update_payment_status(self, payment_id: str, status: str) -> bool:
+        """Обновление статуса платежа"""
+        try:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+
+            if status == 'succeeded':
+                cursor.execute('''
+                UPDATE payments 
+                SET status = ?, paid_at = CURRENT_TIMESTAMP
+                WHERE payment_id = ?
+                ''', (status, payment_id))
+            else:
+                cursor.execute('''
+                UPDATE payments 
+                SET status = ?
+                WHERE payment_id = ?
+                ''', (status, payment_id))
+
+            conn.commit()
+            conn.close()
+            return True
+        except sqlite3.Error as e:
+            logger.info(f"❌ Ошибка при обновлении статуса платежа: {e}")
+            return False
+
+    def mark_payment_processed(self, payment_id: str) -> bool:
+        """Отметка платежа как обработанного"""
+        try:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+
+            cursor.execute('''
+            UPDATE payments 
+            SET is_processed = TRUE
+            WHERE payment_id = ?
+            ''', (payment_id,))
+
+            conn.commit()
+            conn.close()
+            return True
+        except sqlite3.Error as e:
+            logger.info(f"❌ Ошибка при отметке платежа: {e}")
+            return False
+
+    def activate_purchased_payment(self, payment_id: str, days: int = SUBSCRIPTION_DAYS,
+                                   start_from: Optional[datetime] = None) -> Optional[Tuple[int, datetime]]:
+        """Идемпотентная активация подписки по успешному платежу.
+
+        Платеж помечается обработанным условным UPDATE в той же транзакции,
+        что и продление подписки, поэтому вебхук, кнопка "проверить оплату"
+        и стартовая синхронизация не продлят подписку дважды. Действующая
+        подписка продлевается от даты окончания, иначе срок отсчитывается от
+        start_from (aware UTC, например время платежа) или от текущего момента.
+        Возвращает (telegram_id, дата окончания) или None, если платеж уже
+        обработан, еще не успешен или не найден.
+        """
+        conn = self.get_connection()
+        try:
+            cursor = conn.cursor()
+
+            cursor.execute('''
+            UPDATE payments
+            SET is_processed = TRUE
+            WHERE payment_id = ? AND status = 'succeeded' AND is_processed = FALSE
+            ''', (payment_id,))
+            if cursor.rowcount != 1:
+                conn.rollback()
+                return None
+
+            cursor.execute('SELECT telegram_id FROM payments WHERE payment_id = ?', (payment_id,))
+            telegram_id = cursor.fetchone()[0]
+
+            cursor.execute('SELECT subscription_end_ts FROM users WHERE telegram_id = ?', (telegram_id,))
+            row = cursor.fetchone()
+            now_utc = datetime.now(pytz.UTC)
+            # Продлеваем от текущей даты окончания, если она в будущем
+            if row and row[0] and row[0] > int(now_utc.timestamp()):
+                end_datetime = datetime.fromtimestamp(row[0], pytz.UTC) + timedelta(days=days)
+            else:
+                end_datetime = (start_from or now_utc) + timedelta(days=days)
+
+            if not self.update_subscription(telegram_id, paid_status=True, end_datetime=end_datetime,
+                                            is_trial=False, is_purchased=True, conn=conn):
+                conn.rollback()
+                return None
+
+            conn.commit()
+        except sqlite3.Error as e:
+            conn.rollback()
+            logger.error(f"❌ Ошибка активации по платежу {payment_id}: {e}")
+            logger.error(traceback.format_exc())
+            return None
+        finally:
+            conn.close()
+
+        # Кеши сбрасываем после commit, чтобы их не заполнили старой строкой
+        invalidate_user_state(telegram_id)
+        logger.info(f"✅ Платеж {payment_id}: подписка {telegram_id} активна до {end_datetime}")
+        return telegram_id, end_datetime
+
+# ============================================================================
+# ОТЛОЖЕННАЯ ЗАПИСЬ СТАТИСТИКИ И АКТИВНОСТИ
+# ============================================================================
+class WriteBehindBuffer:
+    """Буфер счетчиков статистики и last_activity с записью в БД пачками.
+
+    Приращения ответов и отметки активности копятся в памяти по пользователям
+    и сбрасываются фоновым потоком одной транзакцией раз в flush_interval_ms
+    или сразу по накоплении max_pending записей. Чтение статистики идет
+    через snapshot(): строка БД плюс еще не записанные приращения, включая
+    пачку, которую сейчас пишет flush(), - читатели не ждут сброса буфера.
+    """
+
+    READ_CHUNK = 500  # Пользователей в одном операторе - с запасом до лимита параметров SQLite
+    STATS_UPSERT_SQL = '''
+    INSERT INTO statistics (telegram_id, total_answers, correct_answers, last_updated)
+    VALUES {values}
+    ON CONFLICT(telegram_id) DO UPDATE SET
+        total_answers = total_answers + excluded.total_answers,
+        correct_answers = correct_answers + excluded.correct_answers,
+        last_updated = CURRENT_TIMESTAMP
+    '''
+
+    def __init__(self, database: 'Database', flush_interval_ms=2000, max_pending=100):
+        self.db = database
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_pending = max_pending
+        self._stats = {}  # telegram_id -> [приращение total, приращение correct]
+        self._inflight = {}  # приращения, которые flush() пишет, но еще не зафиксировал
+        self._flush_seq = 0  # номер последнего зафиксированного сброса
+        self._activity = {}  # telegram_id -> время последней активности (UTC)
+        self._pending = 0
+        self._lock = Lock()
+        self._flush_lock = threading.RLock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _ensure_worker(self):
+        if self._thread is None and not self._stopped.is_set():
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(
+                        target=self._run, name='write-behind', daemon=True
+                    )
+                    self._thread.start()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def _record(self):
+        self._pending += 1
+        if self._pending >= self.max_pending:
+            self._wakeup.set()
+
+    def add_answer(self, telegram_id: int, is_correct: bool):
+        """Учет ответа пользователя"""
+        self._ensure_worker()
+        with self._lock:
+            deltas = self._stats.setdefault(telegram_id, [0, 0])
+            deltas[0] += 1
+            if is_correct:
+                deltas[1] += 1
+            self._record()
+
+    def touch_activity(self, telegram_id: int):
+        """Отметка активности пользователя"""
+        self._ensure_worker()
+        with self._lock:
+            self._activity[telegram_id] = datetime.now(pytz.UTC).strftime('%Y-%m-%d %H:%M:%S')
+            self._record()
+
+    @staticmethod
+    def stored_statistics(telegram_id: int) -> Optional[Dict]:
+        """Последняя известная строка statistics из БД (без учета буфера)"""
+        row = cache.get(f"stats_{telegram_id}")
+        return dict(row) if row else None
+
+    @staticmethod
+    def remember_statistics(row: Dict):
+        """Запоминание строки statistics, полученной из БД"""
+        cache.set(f"stats_{row['telegram_id']}", dict(row))
+
+    def _pending_locked(self, telegram_id: int) -> Tuple[int, int]:
+        total, correct = self._stats.get(telegram_id, (0, 0))
+        inflight_total, inflight_correct = self._inflight.get(telegram_id, (0, 0))
+        return total + inflight_total, correct + inflight_correct
+
+    def snapshot(self, telegram_id: int, load_row) -> Tuple[Optional[Dict], int, int]:
+        """Строка statistics и согласованные с ней незаписанные приращения (total, correct).
+
+        Фиксация сброса, обновление кеша строк и очистка _inflight происходят
+        под _lock одновременно. Строку, прочитанную из БД через load_row вне
+        блокировки, принимаем, только если за время чтения ни один сброс не
+        зафиксировался, иначе перечитываем.
+        """
+        while True:
+            with self._lock:
+                row = self.stored_statistics(telegram_id)
+                total, correct = self._pending_locked(telegram_id)
+                seq = self._flush_seq
+            if row is not None:
+                return row, total, correct
+
+            row = load_row(telegram_id)
+            with self._lock:
+                if seq == self._flush_seq:
+                    if row:
+                        self.remember_statistics(row)
+                    return row, total, correct
+
+    def discard_statistics(self, telegram_id: int):
+        """Отбросить незаписанные приращения пользователя"""
+        with self._flush_lock, self._lock:
+            self._stats.pop(telegram_id, None)
+            cache.delete(f"stats_{telegram_id}")
+
+    def flush(self) -> int:
+        """Запись накопленных изменений одной транзакцией, возвращает число пользователей"""
+        with self._flush_lock:
+            with self._lock:
+                stats, self._stats = self._stats, {}
+                self._inflight = stats
+                activity, self._activity = self._activity, {}
+                self._pending = 0
+
+            if not stats and not activity:
+                return 0
+
+            try:
+                conn = self.db.get_connection()
+                conn.row_factory = sqlite3.Row
+                cursor = conn.cursor()
+
+                deltas = [(telegram_id, total, correct) for telegram_id, (total, correct) in stats.items()]
+                fresh_rows = []
+                if SQLITE_HAS_RETURNING:
+                    # Запись и итоговые строки - одним оператором на пачку пользователей
+                    for start in range(0, len(deltas), self.READ_CHUNK):
+                        chunk = deltas[start:start + self.READ_CHUNK]
+                        values = ', '.join(['(?, ?, ?, CURRENT_TIMESTAMP)'] * len(chunk))
+                        cursor.execute(self.STATS_UPSERT_SQL.format(values=values) + ' RETURNING *',
+                                       [value for delta in chunk for value in delta])
+                        fresh_rows.extend(dict(row) for row in cursor.fetchall())
+                else:
+                    cursor.executemany(self.STATS_UPSERT_SQL.format(values='(?, ?, ?, CURRENT_TIMESTAMP)'), deltas)
+                    # Итоговые строки дочитываем в той же транзакции, пачками по IN (...)
+                    user_ids = list(stats)
+                    for start in range(0, len(user_ids), self.READ_CHUNK):
+                        chunk = user_ids[start:start + self.READ_CHUNK]
+                        cursor.execute(
+                            f"SELECT * FROM statistics WHERE telegram_id IN ({','.join('?' * len(chunk))})",
+                            chunk
+                        )
+                        fresh_rows.extend(dict(row) for row in cursor.fetchall())
+
+                if activity:
+                    cursor.executemany('''
+                    UPDATE users SET last_activity = ? WHERE telegram_id = ?
+                    ''', [(touched_at, telegram_id) for telegram_id, touched_at in activity.items()])
+
+                # Фиксация и подмена приращений строками БД - атомарно для snapshot()
+                with self._lock:
+                    conn.commit()
+                    # Итоги после записи уже известны - следующему чтению БД не нужна
+                    for row in fresh_rows:
+                        self.remember_statistics(row)
+                    self._inflight = {}
+                    self._flush_seq += 1
+                conn.close()
+                return len(stats.keys() | activity.keys())
+
+            except sqlite3.Error as e:
+                logger.error(f"❌ Ошибка записи буфера статистики: {e}")
+                # Возвращаем данные в буфер, чтобы не потерять ответы
+                with self._lock:
+                    self._inflight = {}
+                    for telegram_id, (total, correct) in stats.items():
+                        deltas = self._stats.setdefault(telegram_id, [0, 0])
+                        deltas[0] += total
+                        deltas[1] += correct
+                    for telegram_id, touched_at in activity.items():
+                        self._activity.setdefault(telegram_id, touched_at)
+                return 0
+
+    def stop(self):
+        """Остановка фонового потока с финальной записью"""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=5)
+        self.flush()
+
+# ============================================================================
+# ХРАНИЛИЩЕ ПРОГРЕССА ВИКТОРИНЫ
+# ============================================================================
+class ProgressStore:
+    """Долговременное хранение прогресса викторины в таблицах quiz_progress/quiz_state.
+
+    Вопросы сохраняются стабильными ключами QuestionBank (uint32, little-endian),
+    поэтому прогресс переживает и перезапуск бота, и перезагрузку файла вопросов.
+    """
+
+    def __init__(self, database: 'Database'):
+        self.db = database
+
+    @staticmethod
+    def pack_keys(keys) -> bytes:
+        packed = array('I', keys)
+        if sys.byteorder == 'big':
+            packed.byteswap()
+        return packed.tobytes()
+
+    @staticmethod
+    def unpack_keys(blob) -> array:
+        keys = array('I')
+        if blob:
+            keys.frombytes(blob)
+            if sys.byteorder == 'big':
+                keys.byteswap()
+        return keys
+
+    def load(self, telegram_id: int) -> Optional[Dict]:
+        """Сохраненный прогресс: {'state': (тема, всего, верно) | None, 'topics': {тема: (ключи, ключи)}}"""
+        try:
+            conn = self.db.get_connection()
+            cursor = conn.cursor()
+
+            cursor.execute('''
+            SELECT current_topic, session_total, session_correct
+            FROM quiz_state WHERE telegram_id = ?
+            ''', (telegram_id,))
+            state = cursor.fetchone()
+
+            cursor.execute('''
+            SELECT topic, answered_keys, wrong_keys
+            FROM quiz_progress WHERE telegram_id = ?
+            ''', (telegram_id,))
+            topics = {
+                topic: (self.unpack_keys(answered), self.unpack_keys(wrong))
+                for topic, answered, wrong in cursor.fetchall()
+            }
+            conn.close()
+
+            if state is None and not topics:
+                return None
+            return {'state': tuple(state) if state else None, 'topics': topics}
+
+        except sqlite3.Error as e:
+            logger.error(f"❌ Ошибка загрузки прогресса пользователя {telegram_id}: {e}")
+            return None
+
+    def save(self, state_rows: List[tuple], progress_rows: List[tuple]) -> bool:
+        """Запись пачки изменений одной транзакцией"""
+        try:
+            conn = self.db.get_connection()
+            cursor = conn.cursor()
+
+            cursor.executemany('''
+            INSERT OR REPLACE INTO quiz_state
+                (telegram_id, current_topic, session_total, session_correct, updated_at)
+            VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ''', state_rows)
+
+            cursor.executemany('''
+            INSERT OR REPLACE INTO quiz_progress
+                (telegram_id, topic, answered_keys, wrong_keys, updated_at)
+            VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ''', [
+                (telegram_id, topic, self.pack_keys(answered_keys), self.pack_keys(wrong_keys))
+                for telegram_id, topic, answered_keys, wrong_keys in progress_rows
+            ])
+
+            conn.commit()
+            conn.close()
+            return True
+
+        except sqlite3.Error as e:
+            logger.error(f"❌ Ошибка сохранения прогресса: {e}")
+            return False
+
+    def delete(self, telegram_id: int) -> bool:
+        """Удаление сохраненного прогресса пользователя"""
+        try:
+            conn = self.db.get_connection()
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM quiz_progress WHERE telegram_id = ?', (telegram_id,))
+            cursor.execute('DELETE FROM quiz_state WHERE telegram_id = ?', (telegram_id,))
+            conn.commit()
+            conn.close()
+            return True
+
+        except sqlite3.Error as e:
+            logger.error(f"❌ Ошибка удаления прогресса пользователя {telegram_id}: {e}")
+            return False
+
+
+
+class ThreadSafeDict:
+    """Потокобезопасный словарь"""
+
+    def __init__(self):
+        self._data = {}
+        self._lock = Lock()
+
+    def __getitem__(self, key):
+        with self._lock:
+            return self._data.get(key)
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._data[key] = value
+
+    def __delitem__(self, key):
+        with self._lock:
+            if key in self._data:
+                del self._data[key]
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self._data.get(key, default)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+# ============================================================================
+# СКОМПИЛИРОВАННЫЙ ИНДЕКС ВОПРОСОВ
+# ============================================================================
+class QuestionBank:
+    """Индекс вопросов: плотные ID, массивы ID по темам и стабильные ключи.
+
+    id  - позиция вопроса в self.questions (меняется при перезагрузке файла);
+    key - crc32 от темы и текста, не меняется, пока не меняется сам вопрос.
+    Все пользовательские структуры хранят id, а при перезагрузке
+    переводятся на новый индекс через key (см. id_map_from).
+    """
+
+    def __init__(self):
+        self.questions = []  # id -> словарь вопроса
+        self.topic_ids = {}  # тема -> array('I') с ID вопросов темы
+        self.all_ids = array('I')
+        self.id_by_key = {}
+
+    @staticmethod
+    def stable_key(topic: str, question_text: str) -> int:
+        return zlib.crc32(f"{topic}\n{question_text}".encode('utf-8'))
+
+    @classmethod
+    def compile(cls, questions_by_topic: Dict[str, List[Dict]]) -> 'QuestionBank':
+        """Построение индекса; в словари вопросов дописываются id, key, topic, topic_pos"""
+        bank = cls()
+        for topic, questions in questions_by_topic.items():
+            ids = array('I')
+            for position, question in enumerate(questions):
+                question_id = len(bank.questions)
+                key = cls.stable_key(topic, question['question'])
+                while key in bank.id_by_key:
+                    # Дубликаты текста в теме - детерминированно сдвигаем ключ
+                    key = (key + 1) & 0xFFFFFFFF
+
+                question['id'] = question_id
+                question['key'] = key
+                question['topic'] = topic
+                question['topic_pos'] = position
+
+                bank.questions.append(question)
+                bank.id_by_key[key] = question_id
+                ids.append(question_id)
+            bank.topic_ids[topic] = ids
+        bank.all_ids = array('I', range(len(bank.questions)))
+        return bank
+
+    def get(self, question_id) -> Optional[Dict]:
+        """Вопрос по ID за O(1)"""
+        if question_id is None or not 0 <= question_id < len(self.questions):
+            return None
+        return self.questions[question_id]
+
+    def range_for(self, topic: str) -> Tuple[int, int]:
+        """Диапазон ID темы (offset, size): вопросы темы занимают ID подряд"""
+        ids = self.ids_for(topic)
+        if not ids:
+            return 0, 0
+        return ids[0], len(ids)
+
+    def ids_for(self, topic: str) -> array:
+        """ID вопросов темы (для RANDOM_TOPIC - все вопросы)"""
+        if topic == RANDOM_TOPIC:
+            return self.all_ids
+        return self.topic_ids.get(topic, array('I'))
+
+    def count(self, topic: str) -> int:
+        """Количество вопросов в теме"""
+        return len(self.ids_for(topic))
+
+    def id_map_from(self, old_bank: 'QuestionBank') -> Dict[int, int]:
+        """Соответствие ID старого индекса ID этого индекса (по стабильным ключам)"""
+        id_map = {}
+        for question in old_bank.questions:
+            new_id = self.id_by_key.get(question['key'])
+            if new_id is not None:
+                id_map[question['id']] = new_id
+        return id_map
+
+    def __len__(self):
+        return len(self.questions)
+
+
+class QuestionBitset:
+    """Множество отвеченных вопросов темы: бит на вопрос и счетчик единиц.
+
+    Покрывает ID [offset, offset + size) - вопросы одной темы идут подряд,
+    для RANDOM_TOPIC это весь банк. Счетчик единиц ведется при установке бита,
+    поэтому len() (прогресс по теме) не требует обхода.
+    """
+
+    __slots__ = ('offset', 'size', 'bits', 'count')
+
+    def __init__(self, offset: int, size: int):
+        self.offset = offset
+        self.size = size
+        self.bits = bytearray((size + 7) // 8)
+        self.count = 0
+
+    def __contains__(self, question_id) -> bool:
+        position = question_id - self.offset
+        if not 0 <= position < self.size:
+            return False
+        return bool(self.bits[position >> 3] & (1 << (position & 7)))
+
+    def add(self, question_id) -> bool:
+        """Установка бита; True, если вопрос отмечен впервые"""
+        position = question_id - self.offset
+        if not 0 <= position < self.size:
+            return False
+        mask = 1 << (position & 7)
+        if self.bits[position >> 3] & mask:
+            return False
+        self.bits[position >> 3] |= mask
+        self.count += 1
+        return True
+
+    def __iter__(self):
+        for index, byte in enumerate(self.bits):
+            while byte:
+                low = byte & -byte
+                yield self.offset + (index << 3) + low.bit_length() - 1
+                byte ^= low
+
+    def __len__(self):
+        return self.count
+
+
+class TopicSampler:
+    """Выдача вопросов темы за O(1): сначала новые, затем отвеченные неправильно.
+
+    Новые вопросы перемешиваются один раз при построении и выдаются курсором.
+    Выданные, но оставленные без ответа вопросы возвращаются в оборот, когда
+    перестановка исчерпана. Неправильные хранятся в списке с индексом позиций,
+    чтобы удаление после правильного ответа тоже было O(1).
+    """
+
+    __slots__ = ('order', 'cursor', 'skipped', 'wrong', 'wrong_pos')
+
+    def __init__(self, topic_ids, answered, session_questions):
+        self.order = array('I', (
+            question_id for question_id in topic_ids
+            if question_id not in answered and question_id not in session_questions
+        ))
+        random.shuffle(self.order)
+        self.cursor = 0
+        self.skipped = set()
+        self.wrong = []
+        self.wrong_pos = {}
+        for question_id, answered_correctly in session_questions.items():
+            if not answered_correctly and question_id not in answered:
+                self._add_wrong(question_id)
+
+    def _add_wrong(self, question_id):
+        if question_id not in self.wrong_pos:
+            self.wrong_pos[question_id] = len(self.wrong)
+            self.wrong.append(question_id)
+
+    def _discard_wrong(self, question_id):
+        position = self.wrong_pos.pop(question_id, None)
+        if position is None:
+            return
+        last = self.wrong.pop()
+        if position < len(self.wrong):
+            self.wrong[position] = last
+            self.wrong_pos[last] = position
+
+    def next_id(self, answered) -> Optional[int]:
+        """ID следующего вопроса или None, если тема пройдена"""
+        if self.cursor >= len(self.order) and self.skipped:
+            # Перестановка закончилась - повторяем пропущенные без ответа
+            self.order = array('I', self.skipped)
+            random.shuffle(self.order)
+            self.cursor = 0
+            self.skipped = set()
+
+        while self.cursor < len(self.order):
+            question_id = self.order[self.cursor]
+            self.cursor += 1
+            if question_id in answered:
+                continue
+            self.skipped.add(question_id)
+            return question_id
+
+        if self.wrong:
+            return random.choice(self.wrong)
+        return None
+
+    def record(self, question_id, is_correct):
+        """Учет ответа на вопрос"""
+        self.skipped.discard(question_id)
+        if is_correct:
+            self._discard_wrong(question_id)
+        else:
+            self._add_wrong(question_id)
+
+# ============================================================================
+# МАССОВАЯ РАССЫЛКА: ФОНОВЫЕ ЗАДАНИЯ
+# ============================================================================
+BROADCAST_MEDIA_TYPES = ('photo', 'document', 'video', 'audio')
+BROADCAST_TEXT_LIMIT = 4096     # длина текстового сообщения Telegram
+BROADCAST_CAPTION_LIMIT = 1024  # длина подписи к медиа
+BROADCAST_NO_CAPTION = "📎 [Медиафайл без подписи]"
+
+
+class BroadcastEngine:
+    """Рассылки как задания в БД (broadcast_jobs + broadcast_recipients).
+
+    Получатели обходятся страницами по telegram_id, страница отправляется пулом потоков
+    в полосе рассылки outbound, результаты страницы записываются одной транзакцией -
+    это и есть контрольная точка. Задание в статусе 'running' после перезапуска
+    продолжается с неотправленных получателей. Временные ошибки (сеть, 429, 5xx)
+    ставятся в очередь повтора, постоянные (бот заблокирован, чат не найден) - нет.
+    """
+
+    def __init__(self, database: 'Database', workers=8, page_size=200, max_attempts=3, retry_delay_seconds=30):
+        self.db = database
+        self.workers = workers
+        self.page_size = page_size
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay_seconds
+        self._threads = {}  # job_id -> поток-координатор
+        self._lock = Lock()
+        self._stop = threading.Event()
+
+    def create_job(self, admin_chat_id: int, broadcast_data: Dict, recipient_ids, active_only=False) -> int:
+        """Сохранение задания и списка получателей одной транзакцией"""
+        payload = broadcast_data.get('payload') or self.prepare_payload(broadcast_data)
+
+        conn = self.db.get_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+            INSERT INTO broadcast_jobs (admin_chat_id, payload, active_only)
+            VALUES (?, ?, ?)
+            ''', (admin_chat_id, json.dumps(payload, ensure_ascii=False), bool(active_only)))
+            job_id = cursor.lastrowid
+
+            cursor.executemany('''
+            INSERT OR IGNORE INTO broadcast_recipients (job_id, telegram_id) VALUES (?, ?)
+            ''', ((job_id, telegram_id) for telegram_id in recipient_ids))
+
+            cursor.execute('''
+            UPDATE broadcast_jobs
+            SET total = (SELECT COUNT(*) FROM broadcast_recipients WHERE job_id = ?)
+            WHERE job_id = ?
+            ''', (job_id, job_id))
+            conn.commit()
+            return job_id
+        finally:
+            conn.close()
+
+    @staticmethod
+    def visible_length(text: str) -> int:
+        """Длина текста так, как ее считает Telegram: без HTML-тегов, в единицах UTF-16"""
+        plain = html.unescape(re.sub(r'<[^>]+>', '', text or ''))
+        return len(plain.encode('utf-16-le')) // 2
+
+    @classmethod
+    def prepare_payload(cls, broadcast_data: Dict) -> Dict:
+        """Сообщение рассылки: текст или подпись + не более одного медиа; ValueError при превышении лимитов"""
+        payload = {}
+        for kind in BROADCAST_MEDIA_TYPES:
+            if broadcast_data.get(kind):
+                payload[kind] = broadcast_data[kind]
+                break
+
+        text = broadcast_data.get('message')
+        if payload and text == BROADCAST_NO_CAPTION:
+            text = None  # подпись-заглушка нужна только для предпросмотра
+        if text:
+            payload['message'] = text
+        elif not payload:
+            raise ValueError("Пустое сообщение")
+
+        has_media = any(kind in payload for kind in BROADCAST_MEDIA_TYPES)
+        limit = BROADCAST_CAPTION_LIMIT if has_media else BROADCAST_TEXT_LIMIT
+        length = cls.visible_length(text)
+        if length > limit:
+            what = "подписи к медиа" if has_media else "сообщения"
+            raise ValueError(f"Длина {what} {length} символов, Telegram допускает не больше {limit}")
+        return payload
+
+    @staticmethod
+    def capture_file_id(payload: Dict, sent_message) -> Dict:
+        """file_id из ответа на отправку ботом: получатели получают ссылку на уже загруженный файл"""
+        for kind in BROADCAST_MEDIA_TYPES:
+            if kind not in payload:
+                continue
+            media = getattr(sent_message, kind, None)
+            if isinstance(media, list):
+                media = media[-1] if media else None  # фото: самый крупный размер
+            if media is not None and getattr(media, 'file_id', None):
+                payload[kind] = media.file_id
+        return payload
+
+    def start(self, job_id: int, resumed=False) -> bool:
+        """Запуск координатора задания в фоновом потоке.
+
+        После stop() (завершение работы) новые координаторы не запускаются: пул БД
+        вот-вот закроется, задание останется 'running' и продолжится при следующем запуске.
+        """
+        with self._lock:
+            if self._stop.is_set():
+                logger.info(f"⏸️ Рассылка #{job_id} не запущена: идет завершение работы")
+                return False
+            thread = self._threads.get(job_id)
+            if thread is not None and thread.is_alive():
+                return False
+            thread = threading.Thread(target=self._run, args=(job_id, resumed),
+                                      name=f'broadcast-{job_id}', daemon=True)
+            self._threads[job_id] = thread
+        thread.start()
+        return True
+
+    def resume_unfinished(self) -> int:
+        """Продолжение заданий, прерванных перезапуском бота"""
+        conn = self.db.get_connection()
+        try:
+            job_ids = [row[0] for row in conn.execute(
+                "SELECT job_id FROM broadcast_jobs WHERE status = 'running' ORDER BY job_id")]
+        finally:
+            conn.close()
+
+        for job_id in job_ids:
+            logger.info(f"♻️ Возобновление рассылки #{job_id}")
+            self.start(job_id, resumed=True)
+        return len(job_ids)
+
+    def stop(self, timeout=10.0):
+        """Остановка после текущей страницы (задания останутся 'running' и продолжатся при запуске)"""
+        with self._lock:
+            # Под той же блокировкой, что и start(): запуск не проскочит между флагом и списком потоков
+            self._stop.set()
+            threads = list(self._threads.values())
+        for thread in threads:
+            thread.join(timeout)
+
+    def _load_job(self, job_id: int) -> Optional[Dict]:
+        conn = self.db.get_connection()
+        try:
+            conn.row_factory = sqlite3.Row
+            row = conn.execute("SELECT * FROM broadcast_jobs WHERE job_id = ?", (job_id,)).fetchone()
+            return dict(row) if row else None
+        finally:
             conn.close()
 
-            logger.info(f"✅ Массовое продление завершено: успешно {results['success']}, ошибок {results['failed']}")
-            return results
+    def _next_page(self, job_id: int, after_id: int) -> List[tuple]:
+        """Следующая страница неотправленных получателей: [(telegram_id, attempts)]"""
+        conn = self.db.get_connection()
+        try:
+            return conn.execute('''
+            SELECT telegram_id, attempts FROM broadcast_recipients
+            WHERE job_id = ? AND status IN ('pending', 'retry') AND telegram_id > ?
+            ORDER BY telegram_id
+            LIMIT ?
+            ''', (job_id, after_id, self.page_size)).fetchall()
+        finally:
+            conn.close()
 
-        except Exception as e:
-            logger.error(f"❌ Критическая ошибка при массовом продлении подписок: {e}")
-            logger.error(traceback.format_exc())
-            return {'total': 0, 'success': 0, 'failed': 0, 'errors': [str(e)]}
+    def _has_retries(self, job_id: int) -> bool:
+        conn = self.db.get_connection()
+        try:
+            return conn.execute('''
+            SELECT 1 FROM broadcast_recipients
+            WHERE job_id = ? AND status IN ('pending', 'retry')
+            LIMIT 1
+            ''', (job_id,)).fetchone() is not None
+        finally:
+            conn.close()
 
-    def create_payment(self, payment_id: str, telegram_id: int, amount: float, description: str) -> bool:
-        """Создание записи о платеже"""
+    def _checkpoint(self, job_id: int, results: List[tuple]) -> Tuple[int, int]:
+        """Запись результатов страницы, last_activity получателей и счетчиков задания одной транзакцией"""
+        sent_ids = [(telegram_id,) for status, _, telegram_id, _ in results if status == 'sent']
+        failed = sum(1 for status, _, _, _ in results if status == 'failed')
+
+        conn = self.db.get_connection()
         try:
-            conn = self.get_connection()
             cursor = conn.cursor()
-
+            cursor.executemany('''
+            UPDATE broadcast_recipients
+            SET status = ?, error = ?, attempts = attempts + 1, updated_at = CURRENT_TIMESTAMP
+            WHERE job_id = ? AND telegram_id = ?
+            ''', [(status, error, job_id, telegram_id) for status, error, telegram_id, _ in results])
+            # Активность получателей - пачкой на страницу, а не отдельной записью на каждую отправку
+            cursor.executemany('''
+            UPDATE users SET last_activity = CURRENT_TIMESTAMP WHERE telegram_id = ?
+            ''', sent_ids)
             cursor.execute('''
-            INSERT INTO payments (payment_id, telegram_id, amount, description, status)
-            VALUES (?, ?, ?, ?, 'pending')
-            ''', (payment_id, telegram_id, amount, description))
+            UPDATE broadcast_jobs SET sent = sent + ?, failed = failed + ? WHERE job_id = ?
+            ''', (len(sent_ids), failed, job_id))
+            conn.commit()
+        finally:
+            conn.close()
+        return len(sent_ids), failed
 
+    def _finish(self, job_id: int, status: str):
+        conn = self.db.get_connection()
+        try:
+            conn.execute('''
+            UPDATE broadcast_jobs SET status = ?, finished_at = CURRENT_TIMESTAMP WHERE job_id = ?
+            ''', (status, job_id))
             conn.commit()
+        finally:
             conn.close()
-            return True
-        except sqlite3.Error as e:
-            logger.info(f"❌ Ошибка при создании платежа: {e}")
-            return False
 
-    def update_payment_status(self, payment_id: str, status: str) -> bool:
-        """Обновление статуса платежа"""
+    def _set_status_message(self, job_id: int, message_id: int):
+        conn = self.db.get_connection()
         try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
+            conn.execute("UPDATE broadcast_jobs SET status_message_id = ? WHERE job_id = ?", (message_id, job_id))
+            conn.commit()
+        finally:
+            conn.close()
 
-            if status == 'succeeded':
-                cursor.execute('''
-                UPDATE payments 
-                SET status = ?, paid_at = CURRENT_TIMESTAMP
-                WHERE payment_id = ?
-                ''', (status, payment_id))
-            else:
-                cursor.execute('''
-                UPDATE payments 
-                SET status = ?
-                WHERE payment_id = ?
-                ''', (status, payment_id))
+    @staticmethod
+    def send_payload(chat_id: int, payload: Dict):
+        """Отправка сообщения рассылки одному получателю в зависимости от типа"""
+        caption = payload.get('message')
+        if 'photo' in payload:
+            bot.send_photo(chat_id, photo=payload['photo'], caption=caption, parse_mode='HTML')
+        elif 'document' in payload:
+            bot.send_document(chat_id, document=payload['document'], caption=caption, parse_mode='HTML')
+        elif 'video' in payload:
+            bot.send_video(chat_id, video=payload['video'], caption=caption, parse_mode='HTML')
+        elif 'audio' in payload:
+            bot.send_audio(chat_id, audio=payload['audio'], caption=caption, parse_mode='HTML')
+        else:
+            bot.send_message(chat_id, caption, parse_mode='HTML')
 
-            conn.commit()
+    def _deliver(self, telegram_id: int, attempts: int, payload: Dict) -> tuple:
+        """Отправка одному получателю в потоке пула: (статус, ошибка, telegram_id, attempts)"""
+        try:
+            with outbound.broadcast():
+                self.send_payload(telegram_id, payload)
+            return 'sent', None, telegram_id, attempts
+        except Exception as e:
+            # 400/403 - чат недоступен навсегда, повтор не поможет
+            permanent = isinstance(e, telebot.apihelper.ApiTelegramException) and e.error_code in (400, 403)
+            if permanent or attempts + 1 >= self.max_attempts:
+                return 'failed', str(e)[:200], telegram_id, attempts
+            return 'retry', str(e)[:200], telegram_id, attempts
+
+    def _render_progress(self, job: Dict, title: str) -> str:
+        total = job['total']
+        return (f"📤 <b>{title}</b>\n\n"
+                f"👥 Всего получателей: {total}\n"
+                f"✅ Успешно отправлено: {job['sent']}/{total}\n"
+                f"❌ Ошибок: {job['failed']}\n"
+                f"⏳ Ожидание: {total - job['sent'] - job['failed']}")
+
+    def _report(self, job: Dict) -> str:
+        """Итоговый отчет с первыми ошибками"""
+        conn = self.db.get_connection()
+        try:
+            failed_rows = conn.execute('''
+            SELECT r.telegram_id, u.username FROM broadcast_recipients r
+            LEFT JOIN users u ON u.telegram_id = r.telegram_id
+            WHERE r.job_id = ? AND r.status = 'failed'
+            ORDER BY r.telegram_id
+            LIMIT 10
+            ''', (job['job_id'],)).fetchall()
+        finally:
             conn.close()
-            return True
-        except sqlite3.Error as e:
-            logger.info(f"❌ Ошибка при обновлении статуса платежа: {e}")
-            return False
 
-    def mark_payment_processed(self, payment_id: str) -> bool:
-        """Отметка платежа как обработанного"""
+        report_text = f"📊 <b>ИТОГ РАССЫЛКИ #{job['job_id']}</b>\n\n"
+        report_text += f"✅ <b>Успешно отправлено:</b> {job['sent']}/{job['total']}\n"
+        report_text += f"❌ <b>Ошибок:</b> {job['failed']}\n"
+
+        if job['active_only']:
+            report_text += f"🎯 <b>Фильтр:</b> Только активные пользователи\n"
+        else:
+            report_text += f"🎯 <b>Фильтр:</b> Все пользователи\n"
+
+        if failed_rows:
+            report_text += f"\n📝 <b>Список ошибок (первые 10):</b>\n"
+            for telegram_id, username in failed_rows:
+                report_text += f"• {telegram_id} ({username or 'нет username'})\n"
+
+            if job['failed'] > len(failed_rows):
+                report_text += f"... и еще {job['failed'] - len(failed_rows)} пользователей\n"
+        return report_text
+
+    def _run(self, job_id: int, resumed: bool):
+        """Координатор задания: страницы -> пул потоков -> контрольная точка"""
+        reporter = None
         try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
+            job = self._load_job(job_id)
+            if job is None or job['status'] != 'running':
+                return
+            payload = json.loads(job['payload'])
+
+            title = "Рассылка возобновлена" if resumed else "Рассылка в процессе..."
+            # После перезапуска статус выводится новым сообщением: старое могло уйти далеко вверх
+            reporter = ProgressReporter(job['admin_chat_id'], None if resumed else job['status_message_id'])
+            message_id = reporter.start(self._render_progress(job, title))
+            if message_id is not None and message_id != job['status_message_id']:
+                self._set_status_message(job_id, message_id)
+
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f'broadcast-{job_id}') as pool:
+                round_number = 0
+                while not self._stop.is_set():
+                    # Полный проход по неотправленным, затем пауза перед повтором временных ошибок
+                    after_id = 0
+                    while not self._stop.is_set():
+                        page = self._next_page(job_id, after_id)
+                        if not page:
+                            break
+                        results = list(pool.map(lambda row: self._deliver(row[0], row[1], payload), page))
+                        sent, failed = self._checkpoint(job_id, results)
+                        after_id = page[-1][0]
+
+                        job['sent'] += sent
+                        job['failed'] += failed
+                        reporter.update(self._render_progress(job, title))
+
+                    if self._stop.is_set() or not self._has_retries(job_id):
+                        break
+                    round_number += 1
+                    logger.info(f"🔁 Рассылка #{job_id}: повтор временных ошибок (круг {round_number})")
+                    self._stop.wait(self.retry_delay * round_number)
+
+            if self._stop.is_set():
+                reporter.finish(self._render_progress(job, "Рассылка приостановлена до перезапуска бота"))
+                logger.info(f"⏸️ Рассылка #{job_id} приостановлена до перезапуска")
+                return
 
-            cursor.execute('''
-            UPDATE payments 
-            SET is_processed = TRUE
-            WHERE payment_id = ?
-            ''', (payment_id,))
+            self._finish(job_id, 'completed')
+            job = self._load_job(job_id)
+            reporter.finish(self._report(job))
+            logger.info(f"📢 Администратор {job['admin_chat_id']} провел рассылку #{job_id}\n"
+                        f"✅ Успешно: {job['sent']}, ❌ Ошибок: {job['failed']}")
 
-            conn.commit()
+        except Exception as e:
+            logger.error(f"❌ Ошибка рассылки #{job_id}: {e}")
+            logger.error(traceback.format_exc())
+            try:
+                self._finish(job_id, 'failed')
+                error_text = f"❌ <b>Критическая ошибка при рассылке #{job_id}:</b>\n{e}"
+                if reporter is not None:
+                    reporter.finish(error_text)
+                else:
+                    job = self._load_job(job_id)
+                    if job:
+                        bot.send_message(job['admin_chat_id'], error_text, parse_mode='HTML')
+            except Exception:
+                pass
+        finally:
+            with self._lock:
+                self._threads.pop(job_id, None)
+
+# ============================================================================
+# ПЛАНИРОВЩИК ИСТЕЧЕНИЯ ПОДПИСОК
+# ============================================================================
+class ExpiryScheduler:
+    """Деактивация подписок в момент окончания вместо ежечасного обхода.
+
+    Min-heap (subscription_end_ts, telegram_id) строится при запуске одним запросом
+    по индексу idx_users_paid_end. Об изменениях подписок сообщает touch() (вызывается
+    из invalidate_user_state): id копятся в наборе и дочитываются из БД пачкой в потоке
+    планировщика. Устаревшие записи кучи не удаляются, а пропускаются при извлечении
+    сверкой с self._due. В момент окончания вызывается on_expire - индексный UPDATE
+    всех истекших подписок. Если on_expire вернул False или упал, сработавшие
+    окончания возвращаются в кучу и повторяются с нарастающей задержкой.
+    """
+
+    REFRESH_CHUNK = 500
+    REBUILD_SQL = '''
+    SELECT telegram_id, subscription_end_ts FROM users
+    WHERE subscription_paid = TRUE AND subscription_end_ts IS NOT NULL
+    '''
+    MAX_SLEEP_SECONDS = 3600  # страховка от перевода системных часов
+    RETRY_BASE_SECONDS = 5
+    RETRY_MAX_SECONDS = 300
+
+    def __init__(self, database: 'Database', on_expire):
+        self.db = database
+        self.on_expire = on_expire
+        self._heap = []  # (subscription_end_ts, telegram_id)
+        self._due = {}  # telegram_id -> актуальный subscription_end_ts
+        self._dirty = set()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._failures = 0  # неудачных вызовов on_expire подряд
+
+    def start(self):
+        """Построение кучи и запуск потока (повторный вызов только перестраивает кучу)"""
+        self.rebuild()
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._loop, name='subscription-expiry', daemon=True)
+            self._thread.start()
+
+    def rebuild(self):
+        """Полное построение кучи из БД (при запуске и после массовых изменений)"""
+        conn = self.db.get_connection()
+        try:
+            rows = conn.execute(self.REBUILD_SQL).fetchall()
+        finally:
             conn.close()
-            return True
-        except sqlite3.Error as e:
-            logger.info(f"❌ Ошибка при отметке платежа: {e}")
-            return False
 
+        heap = [(end_ts, telegram_id) for telegram_id, end_ts in rows]
+        heapq.heapify(heap)
+        with self._cond:
+            self._heap = heap
+            self._due = {telegram_id: end_ts for telegram_id, end_ts in rows}
+            self._dirty.clear()
+            self._cond.notify()
+        logger.info(f"⏳ Планировщик истечения подписок: {len(rows)} активных")
+
+    def touch(self, telegram_id: int):
+        """Подписка пользователя могла измениться - перечитать ее в потоке планировщика"""
+        with self._cond:
+            self._dirty.add(telegram_id)
+            self._cond.notify()
+
+    def size(self) -> int:
+        with self._cond:
+            return len(self._due)
+
+    def _refresh_dirty(self):
+        with self._cond:
+            if not self._dirty:
+                return
+            dirty, self._dirty = list(self._dirty), set()
 
+        rows = []
+        conn = self.db.get_connection()
+        try:
+            for start in range(0, len(dirty), self.REFRESH_CHUNK):
+                chunk = dirty[start:start + self.REFRESH_CHUNK]
+                rows.extend(conn.execute(f'''
+                SELECT telegram_id, subscription_end_ts FROM users
+                WHERE subscription_paid = TRUE AND subscription_end_ts IS NOT NULL
+                AND telegram_id IN ({','.join('?' * len(chunk))})
+                ''', chunk).fetchall())
+        finally:
+            conn.close()
 
-class ThreadSafeDict:
-    """Потокобезопасный словарь"""
+        with self._cond:
+            for telegram_id in dirty:
+                self._due.pop(telegram_id, None)
+            for telegram_id, end_ts in rows:
+                self._due[telegram_id] = end_ts
+                heapq.heappush(self._heap, (end_ts, telegram_id))
+
+            # Устаревших записей стало больше актуальных - пересобираем кучу из self._due
+            if len(self._heap) > 2 * len(self._due) + 64:
+                self._heap = [(end_ts, telegram_id) for telegram_id, end_ts in self._due.items()]
+                heapq.heapify(self._heap)
+
+    def _pop_expired(self, now: float) -> List[int]:
+        """Извлечение наступивших окончаний (под self._cond), возвращает id пользователей"""
+        fired = []
+        while self._heap and self._heap[0][0] <= now:
+            end_ts, telegram_id = heapq.heappop(self._heap)
+            if self._due.get(telegram_id) == end_ts:
+                del self._due[telegram_id]
+                fired.append(telegram_id)
+        return fired
+
+    def _retry_later(self, fired: List[int]):
+        """Возврат окончаний в кучу после неудачного on_expire (с нарастающей задержкой)"""
+        self._failures += 1
+        delay = min(self.RETRY_BASE_SECONDS * 2 ** (self._failures - 1), self.RETRY_MAX_SECONDS)
+        retry_at = time.time() + delay
+        with self._cond:
+            for telegram_id in fired:
+                # Подписку успели перечитать (touch) - актуальна уже новая запись
+                if telegram_id not in self._due:
+                    self._due[telegram_id] = retry_at
+                    heapq.heappush(self._heap, (retry_at, telegram_id))
+        logger.warning(f"⚠️ Деактивация {len(fired)} подписок не удалась, повтор через {delay} с")
+
+    def _next_wait(self, now: float) -> float:
+        """Время до ближайшего актуального окончания (под self._cond)"""
+        while self._heap and self._due.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        if not self._heap:
+            return self.MAX_SLEEP_SECONDS
+        return min(self._heap[0][0] - now, self.MAX_SLEEP_SECONDS)
+
+    def _loop(self):
+        while True:
+            try:
+                self._refresh_dirty()
+                with self._cond:
+                    now = time.time()
+                    fired = self._pop_expired(now)
+                    if not fired:
+                        if not self._dirty:
+                            self._cond.wait(max(self._next_wait(now), 0.0))
+                        continue
 
-    def __init__(self):
-        self._data = {}
+                try:
+                    succeeded = self.on_expire() is not False
+                except Exception as e:
+                    logger.error(f"❌ Ошибка деактивации истекших подписок: {e}")
+                    logger.error(traceback.format_exc())
+                    succeeded = False
+                if succeeded:
+                    self._failures = 0
+                else:
+                    self._retry_later(fired)
+            except Exception as e:
+                logger.error(f"❌ Ошибка планировщика истечения подписок: {e}")
+                logger.error(traceback.format_exc())
+                time.sleep(5)
+
+# ============================================================================
+# МЕТАДАННЫЕ БОТА
+# ============================================================================
+class BotMetadata:
+    """Данные бота из get_me() и состояние меню команд.
+
+    get_me() запрашивается один раз при запуске и затем раз в refresh_hours
+    (плановое обновление), а не на каждом платеже. Меню команд запоминается
+    по областям видимости: повторная установка того же меню не делает
+    запроса к Telegram.
+    """
+
+    def __init__(self, bot, refresh_hours=24):
+        self._bot = bot
+        self.refresh_seconds = refresh_hours * 3600
+        self._me = None
+        self._loaded_at = 0.0
+        self._menus = {}  # None (все чаты) или chat_id -> ((команда, описание), ...)
         self._lock = Lock()
 
-    def __getitem__(self, key):
+    def load(self) -> bool:
+        """Запрос get_me(); при ошибке остаются прежние данные"""
+        try:
+            me = self._bot.get_me()
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось получить данные бота: {e}")
+            return False
         with self._lock:
-            return self._data.get(key)
+            self._me = me
+            self._loaded_at = time.time()
+        logger.info(f"🤖 Бот @{me.username} (id {me.id})")
+        return True
 
-    def __setitem__(self, key, value):
-        with self._lock:
-            self._data[key] = value
+    def refresh_if_stale(self) -> bool:
+        """Обновление данных, если они старше refresh_hours"""
+        if time.time() - self._loaded_at >= self.refresh_seconds:
+            return self.load()
+        return True
 
-    def __delitem__(self, key):
-        with self._lock:
-            if key in self._data:
-                del self._data[key]
+    def _get_me(self):
+        if self._me is None:
+            # Запуск без run_startup_tasks (или неудачная первая загрузка)
+            self.load()
+        return self._me
 
-    def get(self, key, default=None):
-        with self._lock:
-            return self._data.get(key, default)
+    @property
+    def id(self) -> Optional[int]:
+        me = self._get_me()
+        return me.id if me else None
 
-    def pop(self, key, default=None):
+    @property
+    def username(self) -> Optional[str]:
+        me = self._get_me()
+        return me.username if me else None
+
+    def link(self) -> str:
+        """Ссылка t.me на бота"""
+        username = self.username
+        return f"https://t.me/{username}" if username else "https://t.me"
+
+    def set_commands(self, commands, chat_id: Optional[int] = None) -> bool:
+        """Установка меню команд для всех чатов или одного chat_id.
+
+        Возвращает True, если меню было отправлено в Telegram, и False, если
+        такое же меню уже установлено.
+        """
+        signature = tuple((command.command, command.description) for command in commands)
+        if self._menus.get(chat_id) == signature:
+            return False
+        if chat_id is None:
+            self._bot.set_my_commands(commands)
+        else:
+            self._bot.set_my_commands(commands, scope=types.BotCommandScopeChat(chat_id))
         with self._lock:
-            return self._data.pop(key, default)
+            self._menus[chat_id] = signature
+        return True
 
-    def clear(self):
+    def reset_commands(self, chat_id: int):
+        """Удаление персонального меню чата (вернется общее меню)"""
+        if chat_id not in self._menus:
+            return
+        self._bot.delete_my_commands(scope=types.BotCommandScopeChat(chat_id))
         with self._lock:
-            self._data.clear()
+            self._menus.pop(chat_id, None)
+
+    def menu_for(self, chat_id: Optional[int] = None) -> Optional[Tuple]:
+        """Установленное меню области видимости или None"""
+        return self._menus.get(chat_id)
 
 # ============================================================================
 # ГЛОБАЛЬНЫЕ ПЕРЕМЕННЫЕ
 # ============================================================================
 questions_by_topic = {}
 topics_list = []
+question_bank = QuestionBank()
 questions_loaded = False
 scheduler = None
 user_data_manager = UserDataManager(ttl_minutes=120, cleanup_interval_minutes=10)
 # Создаем глобальный кеш-менеджер
-cache = CacheManager(ttl_seconds=300)  # 5 минут
-rate_limiter = RateLimiter(max_requests=60, per_seconds=60)  # 30 запросов в минуту
+cache = CacheManager(ttl_seconds=300, max_entries=10000)  # 5 минут
+_CACHE_MISS = object()
+subscription_cache = SubscriptionStatusCache(negative_ttl_seconds=60)
+rate_limiter = RateLimiter()
+outbound = OutboundDispatcher(global_per_second=25, chat_per_second=1.0)
+outbound.install(bot)
 db = Database()
+payment_status_cache = PaymentStatusCache(fetch=Payment.find_one, local_lookup=db.get_payment_by_external_id, ttl_seconds=5)
+user_data_manager.attach_progress_store(ProgressStore(db))
+broadcast_engine = BroadcastEngine(db, workers=8)
+expiry_scheduler = ExpiryScheduler(db, on_expire=lambda: check_and_update_subscriptions())
+bot_metadata = BotMetadata(bot, refresh_hours=24)
+
+# ============================================================================
+# КОНТЕКСТ ОБРАБОТКИ ОДНОГО ОБНОВЛЕНИЯ TELEGRAM
+# ============================================================================
+class RequestContext:
+    """Данные пользователя, загружаемые один раз на одно обновление Telegram"""
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self._user = None
+        self._user_loaded = False
+        self.subscription_active = None  # Вердикт ensure_subscription_status
+        self.activity_touched = False
+
+    def get_user(self) -> Optional[Dict]:
+        """Строка пользователя: читается из БД в обход кеша, но только один раз"""
+        if not self._user_loaded:
+            cache.delete(f"user_{self.user_id}")
+            self._user = db.get_user(self.user_id)
+            self._user_loaded = True
+        return self._user
+
+    def invalidate(self):
+        """Сброс запомненных данных после изменения подписки или прав"""
+        self._user = None
+        self._user_loaded = False
+        self.subscription_active = None
+
+
+_request_local = threading.local()
+
+
+@contextmanager
+def request_scope(user_id: int):
+    """Контекст обработки одного обновления в текущем потоке"""
+    previous = getattr(_request_local, 'context', None)
+    _request_local.context = RequestContext(user_id)
+    try:
+        yield _request_local.context
+    finally:
+        _request_local.context = previous
+
+
+def get_request_context(user_id: int) -> Optional[RequestContext]:
+    """Текущий контекст, если он относится к этому пользователю"""
+    ctx = getattr(_request_local, 'context', None)
+    if ctx is not None and ctx.user_id == user_id:
+        return ctx
+    return None
+
+
+def request_scoped(handler):
+    """Декоратор обработчика: одно обновление - один RequestContext"""
+    @functools.wraps(handler)
+    def wrapper(update, *args, **kwargs):
+        # У сообщения есть chat, у callback-запроса - только from_user
+        user_id = update.chat.id if hasattr(update, 'chat') else update.from_user.id
+        with request_scope(user_id):
+            return handler(update, *args, **kwargs)
+    return wrapper
+
+
+def invalidate_user_state(telegram_id: int):
+    """Инвалидация всех закешированных данных пользователя после записи в БД"""
+    cache.delete(f"user_{telegram_id}")
+    cache.delete(f"subscription_{telegram_id}")
+    subscription_cache.invalidate(telegram_id)
+    expiry_scheduler.touch(telegram_id)
+
+    ctx = get_request_context(telegram_id)
+    if ctx is not None:
+        ctx.invalidate()
 
 # ============================================================================
 # ФУНКЦИИ ДЛЯ РАБОТЫ С ВОПРОСАМИ
@@ -1373,13 +3712,13 @@ def check_database_health():
         cursor.execute("SELECT COUNT(*) FROM users")
         total_users = cursor.fetchone()[0]
 
-        cursor.execute("SELECT COUNT(*) FROM users WHERE subscription_paid = TRUE")
+        cursor.execute(ACTIVE_SUBSCRIPTIONS_COUNT_SQL)
         active_subscriptions = cursor.fetchone()[0]
 
         cursor.execute("SELECT COUNT(*) FROM payments")
         total_payments = cursor.fetchone()[0]
 
-        cursor.execute("SELECT COUNT(*) FROM payments WHERE status = 'succeeded' AND is_processed = FALSE")
+        cursor.execute(UNPROCESSED_PAYMENTS_COUNT_SQL)
         unprocessed_payments = cursor.fetchone()[0]
 
         logger.info(f"👥 Всего пользователей: {total_users}")
@@ -1402,9 +3741,151 @@ def check_database_health():
         return None
 
 
+# SQL горячих запросов. Функции выполняют ровно эти тексты, а check_query_plans
+# проверяет их планы - копии запросов не расходятся с кодом.
+ACTIVE_SUBSCRIPTIONS_COUNT_SQL = "SELECT COUNT(*) FROM users WHERE subscription_paid = TRUE"
+UNPROCESSED_PAYMENTS_COUNT_SQL = "SELECT COUNT(*) FROM payments WHERE status = 'succeeded' AND is_processed = FALSE"
+
+# Истекшие подписки (check_and_update_subscriptions)
+EXPIRED_SUBSCRIPTIONS_WHERE = "WHERE subscription_paid = TRUE AND subscription_end_ts <= ?"
+EXPIRE_SUBSCRIPTIONS_SQL = f'''
+UPDATE users
+SET subscription_paid = FALSE,
+    subscription_start_date = NULL,
+    subscription_end_date = NULL
+{EXPIRED_SUBSCRIPTIONS_WHERE}
+'''
+EXPIRED_SUBSCRIPTIONS_SQL = f"SELECT telegram_id FROM users {EXPIRED_SUBSCRIPTIONS_WHERE}"
+
+# Свежие необработанные успешные платежи (sync_paid_subscriptions_on_startup)
+PAYMENT_SYNC_SQL = '''
+SELECT
+    p.payment_id,
+    p.telegram_id,
+    p.amount,
+    p.created_at,
+    p.paid_at,
+    p.paid_ts,
+    u.subscription_paid,
+    u.subscription_end_date,
+    u.subscription_end_ts,
+    u.subscription_purchased,
+    u.subscription_start_date,
+    u.username
+FROM payments p
+LEFT JOIN users u ON p.telegram_id = u.telegram_id
+WHERE p.status = 'succeeded'
+AND p.is_processed = FALSE
+AND (
+    p.paid_ts >= :since
+    OR
+    (p.paid_ts IS NULL AND p.created_ts >= :since)
+)
+ORDER BY p.paid_ts ASC, p.created_ts ASC
+'''
+
+# Старые необработанные платежи (cleanup_old_payments): по *_ts из индекса idx_payments_unprocessed
+OLD_PAYMENTS_WHERE = '''
+WHERE is_processed = FALSE
+AND (
+    (paid_ts IS NOT NULL AND paid_ts < :cutoff)
+    OR
+    (paid_ts IS NULL AND created_ts < :cutoff)
+)
+'''
+OLD_PAYMENTS_COUNT_SQL = f"SELECT COUNT(*) as count FROM payments {OLD_PAYMENTS_WHERE}"
+EXPIRE_OLD_PAYMENTS_SQL = f'''
+UPDATE payments
+SET is_processed = TRUE,
+    status = CASE
+        WHEN status = 'pending' THEN 'expired'
+        ELSE status
+    END
+{OLD_PAYMENTS_WHERE}
+'''
+
+# Успешные платежи без отметки о покупке (check_subscription_consistency)
+PAID_WITHOUT_PURCHASE_SQL = '''
+SELECT p.telegram_id, u.username, p.payment_id, p.paid_at,
+       u.subscription_purchased
+FROM payments p
+JOIN users u ON p.telegram_id = u.telegram_id
+WHERE p.status = 'succeeded'
+AND u.subscription_purchased = FALSE
+'''
+
+# Страница напоминаний об окончании подписки (send_expiry_reminders)
+EXPIRY_REMINDERS_PAGE_SQL = '''
+SELECT telegram_id, subscription_end_ts FROM users
+WHERE subscription_paid = TRUE
+AND subscription_end_ts > :now AND subscription_end_ts <= :until
+AND is_admin = FALSE
+AND (last_warning_date IS NULL OR last_warning_date < :warned_before)
+AND telegram_id > :after_id
+ORDER BY telegram_id
+LIMIT :limit
+'''
+
+# Последний платеж пользователя (/checkmypayment)
+LAST_PAYMENT_SQL = '''
+SELECT payment_id, status, created_at
+FROM payments
+WHERE telegram_id = ?
+ORDER BY created_at DESC
+LIMIT 1
+'''
+
+# Горячие запросы для самопроверки планов: (название, SQL, параметры).
+# Полный список пользователей (get_all_users) сюда не входит: он по смыслу читает всю таблицу.
+HOT_QUERY_PLANS = [
+    ('Активные подписки', ACTIVE_SUBSCRIPTIONS_COUNT_SQL, ()),
+    ('Построение кучи окончаний подписок', ExpiryScheduler.REBUILD_SQL, ()),
+    ('Истекшие подписки', EXPIRE_SUBSCRIPTIONS_SQL, (0,)),
+    ('Администраторы', Database.ADMIN_IDS_SQL, ()),
+    ('Необработанные успешные платежи', UNPROCESSED_PAYMENTS_COUNT_SQL, ()),
+    ('Синхронизация оплаченных подписок', PAYMENT_SYNC_SQL, {'since': 0}),
+    ('Очистка старых платежей', OLD_PAYMENTS_COUNT_SQL, {'cutoff': 0}),
+    ('Пометка старых платежей', EXPIRE_OLD_PAYMENTS_SQL, {'cutoff': 0}),
+    ('Согласованность платежей и подписок', PAID_WITHOUT_PURCHASE_SQL, ()),
+    ('Активные получатели рассылки', Database.ACTIVE_RECIPIENTS_SQL, {'now': 0}),
+    ('Напоминания об окончании подписки', EXPIRY_REMINDERS_PAGE_SQL,
+     {'now': 0, 'until': 0, 'warned_before': '', 'after_id': 0, 'limit': 1}),
+    ('Последний платеж пользователя', LAST_PAYMENT_SQL, (0,)),
+]
+
+
+def check_query_plans() -> List[str]:
+    """Самопроверка EXPLAIN QUERY PLAN: предупреждение, если горячий запрос сканирует таблицу"""
+    warnings = []
+    try:
+        conn = db.get_connection()
+        cursor = conn.cursor()
+
+        for name, sql, params in HOT_QUERY_PLANS:
+            cursor.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+            # detail: "SCAN users" (или "SCAN TABLE users" в старых SQLite) - полный проход таблицы,
+            # "SCAN users USING INDEX ..." - полный проход индекса с чтением строк; допустим
+            # только проход покрывающего индекса (частичные индексы ограничивают его объем)
+            scans = [row[3] for row in cursor.fetchall()
+                     if row[3].startswith('SCAN') and 'COVERING INDEX' not in row[3]]
+            if scans:
+                warnings.append(name)
+                logger.warning(f"⚠️ Запрос «{name}» выполняется без индекса: {'; '.join(scans)}")
+
+        conn.close()
+
+        if not warnings:
+            logger.info(f"✅ Планы горячих запросов используют индексы ({len(HOT_QUERY_PLANS)})")
+
+    except Exception as e:
+        logger.error(f"❌ Ошибка при проверке планов запросов: {e}")
+
+    return warnings
+
+
 def load_and_parse_questions(filename: str) -> bool:
     """Оптимизированная загрузка вопросов"""
-    global questions_by_topic, topics_list, questions_loaded
+    global questions_by_topic, topics_list, questions_loaded, question_bank
 
     try:
         if not os.path.exists(filename):
@@ -1494,16 +3975,22 @@ def load_and_parse_questions(filename: str) -> bool:
                 'answers': current_answers
             })
 
+        # Компилируем индекс и переводим прогресс пользователей на новые ID
+        new_bank = QuestionBank.compile(temp_topics)
+        if len(question_bank):
+            user_data_manager.remap_question_ids(new_bank.id_map_from(question_bank), new_bank)
+        question_bank = new_bank
+
         # Копируем в глобальные переменные
         questions_by_topic.update(temp_topics)
         topics_list = list(temp_topics.keys())
 
         if topics_list:
-            topics_list.append("🎲 Все темы (рандом)")
+            topics_list.append(RANDOM_TOPIC)
             questions_loaded = True
 
         # Подсчитываем общее количество вопросов
-        total_questions = sum(len(q) for q in questions_by_topic.values())
+        total_questions = len(question_bank)
         logger.info(f"✅ Загружено тем: {len(topics_list) - 1}, вопросов: {total_questions}")
 
         # Выводим пример для проверки
@@ -1528,68 +4015,13 @@ def load_and_parse_questions(filename: str) -> bool:
 def get_random_question_from_topic(user_id, topic_name: str) -> Optional[Dict]:
     """Получение случайного вопроса из темы с учетом уже отвеченных"""
     try:
-        # Получаем все вопросы для темы
-        if topic_name == "🎲 Все темы (рандом)":
-            all_questions = []
-            for topic in questions_by_topic.keys():
-                for question in questions_by_topic[topic]:
-                    question_copy = question.copy()
-                    question_copy['source_topic'] = topic  # Сохраняем исходную тему
-                    all_questions.append(question_copy)
-        elif topic_name in questions_by_topic:
-            all_questions = questions_by_topic[topic_name].copy()
-            for question in all_questions:
-                question['source_topic'] = topic_name  # Добавляем исходную тему
-        else:
+        if not question_bank.ids_for(topic_name):
             return None
 
-        if not all_questions:
-            return None
-
-        # Получаем данные пользователя
-        user_data = user_data_manager.get_user_data(user_id)
-
-        # Получаем отвеченные вопросы для этой темы
-        answered_questions = []
-        if 'answered_questions' in user_data and topic_name in user_data['answered_questions']:
-            answered_questions = user_data['answered_questions'][topic_name]
-
-        # Получаем вопросы текущей сессии
-        session_questions = {}
-        if 'session_questions' in user_data and topic_name in user_data['session_questions']:
-            session_questions = user_data['session_questions'][topic_name]
-
-        # Фильтруем вопросы
-        available_questions = []
-        incorrect_questions = []
-
-        for question in all_questions:
-            question_text = question['question']
-
-            # Если вопрос уже правильно отвечен в этой теме, пропускаем
-            if question_text in answered_questions:
-                continue
-
-            # Если вопрос в текущей сессии
-            if question_text in session_questions:
-                if session_questions[question_text] == True:
-                    # Уже правильно отвечен в этой сессии
-                    continue
-                else:
-                    # Неправильно отвечен - добавляем в список неправильных
-                    incorrect_questions.append(question)
-            else:
-                # Новый вопрос
-                available_questions.append(question)
-
-        # Сначала используем новые вопросы, потом неправильно отвеченные
-        if available_questions:
-            return random.choice(available_questions)
-        elif incorrect_questions:
-            return random.choice(incorrect_questions)
-        else:
-            # Все вопросы отвечены правильно
-            return None
+        # Сначала новые вопросы, потом неправильно отвеченные; None - все отвечены правильно
+        sampler = user_data_manager.get_topic_sampler(user_id, topic_name)
+        answered_questions = user_data_manager.get_answered_questions(user_id, topic_name)
+        return question_bank.get(sampler.next_id(answered_questions))
 
     except Exception as e:
         logger.error(f"❌ Ошибка при получении вопроса: {e}")
@@ -1627,45 +4059,20 @@ def sync_paid_subscriptions_on_startup():
     logger.info("🔄 Запуск синхронизации оплаченных подписок...")
 
     try:
-        conn = db.get_connection()
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-
         MAX_DAYS_FOR_PAYMENT_CHECK = 3
         ACTIVATION_WINDOW_HOURS = 24
 
         # Текущее время в UTC
         now_utc = datetime.now(pytz.UTC)
 
-        cursor.execute(f'''
-            SELECT 
-                p.payment_id,
-                p.telegram_id,
-                p.amount,
-                p.created_at,
-                p.paid_at,
-                u.subscription_paid,
-                u.subscription_end_date,
-                u.subscription_purchased,
-                u.subscription_start_date,
-                u.username
-            FROM payments p
-            LEFT JOIN users u ON p.telegram_id = u.telegram_id
-            WHERE p.status = 'succeeded' 
-            AND p.is_processed = FALSE
-            AND (
-                p.paid_at >= datetime('now', '-{MAX_DAYS_FOR_PAYMENT_CHECK} days')
-                OR 
-                (p.paid_at IS NULL AND p.created_at >= datetime('now', '-{MAX_DAYS_FOR_PAYMENT_CHECK} days'))
-            )
-            ORDER BY p.paid_at ASC, p.created_at ASC
-        ''')
-
-        payments = cursor.fetchall()
+        with db.connection() as conn:
+            conn.row_factory = sqlite3.Row
+            payments = conn.execute(PAYMENT_SYNC_SQL, {
+                'since': int(now_utc.timestamp()) - MAX_DAYS_FOR_PAYMENT_CHECK * 86400
+            }).fetchall()
 
         if not payments:
             logger.info(f"✅ Нет свежих необработанных платежей")
-            conn.close()
             # ВОЗВРАЩАЕМ max_days
             return {
                 'total': 0,
@@ -1686,40 +4093,22 @@ def sync_paid_subscriptions_on_startup():
                 payment_id = payment['payment_id']
                 telegram_id = payment['telegram_id']
                 username = payment['username'] or f"user_{telegram_id}"
-                paid_at = payment['paid_at']
+                paid_ts = payment['paid_ts']
 
                 logger.info(f"\n🔍 Обработка платежа {payment_id} для {username}")
 
-                # Определяем время платежа
-                payment_datetime = None
-                if paid_at:
-                    try:
-                        payment_naive = datetime.strptime(paid_at, '%Y-%m-%d %H:%M:%S')
-                        payment_datetime = pytz.UTC.localize(payment_naive)
-                    except:
-                        pass
-
-                if not payment_datetime:
+                # Время платежа уже разобрано в БД (UTC)
+                if not paid_ts:
                     continue
+                payment_datetime = datetime.fromtimestamp(paid_ts, pytz.UTC)
 
                 # Проверяем текущую подписку
-                subscription_end_date = payment['subscription_end_date']
                 subscription_end_datetime = None
-                if subscription_end_date:
-                    try:
-                        end_naive = datetime.strptime(subscription_end_date, '%Y-%m-%d %H:%M:%S')
-                        subscription_end_datetime = pytz.UTC.localize(end_naive)
-                    except:
-                        pass
-                user_has_active_subscription = False
-                if subscription_end_datetime:
-                    user_has_active_subscription = subscription_end_datetime > now_utc
-                if (payment['subscription_paid'] == 1 and subscription_end_date):
-                    try:
-                        subscription_end_datetime = datetime.strptime(subscription_end_date, '%Y-%m-%d %H:%M:%S')
-                        user_has_active_subscription = subscription_end_datetime > datetime.now(pytz.UTC)
-                    except:
-                        pass
+                if payment['subscription_end_ts']:
+                    subscription_end_datetime = datetime.fromtimestamp(payment['subscription_end_ts'], pytz.UTC)
+                user_has_active_subscription = bool(
+                    subscription_end_datetime and subscription_end_datetime > now_utc
+                )
 
                 user_has_purchased_subscription = payment['subscription_purchased'] == 1
 
@@ -1737,77 +4126,55 @@ def sync_paid_subscriptions_on_startup():
                             should_activate = True
 
                 if should_activate:
-                    # Определяем дату окончания
-                    if user_has_active_subscription and subscription_end_datetime:
-                        if subscription_end_datetime > datetime.now(pytz.UTC):
-                            end_datetime = subscription_end_datetime + timedelta(days=30)
+                    # Та же идемпотентная активация, что у вебхука и кнопки "проверить оплату":
+                    # условный UPDATE is_processed в одной транзакции с продлением.
+                    # Без действующей подписки срок идет от времени платежа, если он свежий
+                    hours_since_payment = (now_utc - payment_datetime).total_seconds() / 3600
+                    start_from = payment_datetime if hours_since_payment <= ACTIVATION_WINDOW_HOURS else None
+                    activation = db.activate_purchased_payment(payment_id, start_from=start_from)
+                    if activation is None:
+                        if db.is_payment_processed(payment_id):
+                            skipped_count += 1
+                            logger.info(f"   ⏩ Платеж уже обработан другим путем")
                         else:
-                            end_datetime = datetime.now(pytz.UTC) + timedelta(days=30)
-                    else:
-                        end_datetime = payment_datetime + timedelta(days=30)
+                            errors_count += 1
+                            logger.error(f"   ❌ Не удалось активировать подписку по платежу {payment_id}")
+                        continue
 
-                    # Корректируем если платеж был давно
-                    hours_since_payment = (datetime.now(pytz.UTC) - payment_datetime).total_seconds() / 3600
-                    if hours_since_payment > 24:
-                        end_datetime = datetime.now(pytz.UTC) + timedelta(days=30)
+                    _, end_datetime = activation
+                    activated_count += 1
+                    logger.info(f"   ✅ Подписка активирована до {end_datetime.strftime('%Y-%m-%d %H:%M:%S')}")
 
-                    # ОБНОВЛЯЕМ ПОДПИСКУ используя СУЩЕСТВУЮЩЕЕ соединение!
+                    # Уведомляем только если платеж забрали мы
                     try:
-                        # Обновляем users
-                        end_str = end_datetime.strftime('%Y-%m-%d %H:%M:%S')
-                        start_str = datetime.now(pytz.UTC).strftime('%Y-%m-%d %H:%M:%S')
-
-                        cursor.execute('''
-                            UPDATE users 
-                            SET subscription_paid = ?,
-                                subscription_start_date = ?,
-                                subscription_end_date = ?,
-                                is_trial_used = ?,
-                                subscription_purchased = ?,
-                                last_activity = CURRENT_TIMESTAMP
-                            WHERE telegram_id = ?
-                            ''', (True,  # 1 - subscription_paid
-                                  start_str,  # 2 - subscription_start_date
-                                  end_str,  # 3 - subscription_end_date
-                                  False,  # 4 - is_trial_used
-                                  True,  # 5 - subscription_purchased ← ВАЖНО!
-                                  telegram_id))  # 6 - telegram_id
-
-                        # Помечаем платеж как обработанный
-                        cursor.execute('UPDATE payments SET is_processed = TRUE WHERE payment_id = ?', (payment_id,))
-
-                        activated_count += 1
-                        logger.info(f"   ✅ Подписка активирована до {end_str}")
-
-                        # Отправляем уведомление
-                        try:
-                            bot.send_message(
-                                telegram_id,
-                                f"🎉 <b>Ваша подписка активирована!</b>\n\n"
-                                f"Подписка действует до: {end_datetime.strftime('%d.%m.%Y %H:%M')}",
-                                parse_mode='HTML'
-                            )
-                        except Exception as e:
-                            logger.warning(f"   ⚠️ Не удалось отправить уведомление: {e}")
-
+                        bot.send_message(
+                            telegram_id,
+                            f"🎉 <b>Ваша подписка активирована!</b>\n\n"
+                            f"Подписка действует до: {end_datetime.strftime('%d.%m.%Y %H:%M')}",
+                            parse_mode='HTML'
+                        )
                     except Exception as e:
-                        errors_count += 1
-                        logger.error(f"   ❌ Ошибка обновления: {e}")
+                        logger.warning(f"   ⚠️ Не удалось отправить уведомление: {e}")
 
                 else:
-                    # Не активируем, но помечаем как обработанный
-                    cursor.execute('UPDATE payments SET is_processed = TRUE WHERE payment_id = ?', (payment_id,))
+                    # Не активируем, но помечаем как обработанный (если его не забрали параллельно)
+                    with db.connection() as conn:
+                        claimed = conn.execute(
+                            'UPDATE payments SET is_processed = TRUE WHERE payment_id = ? AND is_processed = FALSE',
+                            (payment_id,)
+                        ).rowcount
+                        conn.commit()
                     skipped_count += 1
-                    logger.info(f"   ⏩ Пропущен платеж")
+                    if claimed != 1:
+                        logger.info(f"   ⏩ Платеж уже обработан другим путем")
+                    else:
+                        logger.info(f"   ⏩ Пропущен платеж")
 
             except Exception as e:
                 errors_count += 1
                 logger.error(f"❌ Ошибка при обработке платежа: {e}")
                 logger.error(traceback.format_exc())
 
-        conn.commit()
-        conn.close()
-
         logger.info(f"📊 Итоги: активировано {activated_count}, пропущено {skipped_count}, ошибок {errors_count}")
 
         # ВОЗВРАЩАЕМ max_days
@@ -1839,35 +4206,14 @@ def cleanup_old_payments():
         cursor = conn.cursor()
 
         # Находим старые необработанные платежи (старше 7 дней)
-        cursor.execute('''
-        SELECT COUNT(*) as count
-        FROM payments 
-        WHERE is_processed = FALSE
-        AND (
-            (paid_at IS NOT NULL AND paid_at < datetime('now', '-7 days'))
-            OR 
-            (paid_at IS NULL AND created_at < datetime('now', '-7 days'))
-        )
-        ''')
+        params = {'cutoff': int(time.time()) - 7 * 86400}
+        cursor.execute(OLD_PAYMENTS_COUNT_SQL, params)
 
         old_payments_count = cursor.fetchone()[0]
 
         if old_payments_count > 0:
             # Помечаем старые платежи как обработанные
-            cursor.execute('''
-            UPDATE payments 
-            SET is_processed = TRUE,
-                status = CASE 
-                    WHEN status = 'pending' THEN 'expired' 
-                    ELSE status 
-                END
-            WHERE is_processed = FALSE
-            AND (
-                (paid_at IS NOT NULL AND paid_at < datetime('now', '-7 days'))
-                OR 
-                (paid_at IS NULL AND created_at < datetime('now', '-7 days'))
-            )
-            ''')
+            cursor.execute(EXPIRE_OLD_PAYMENTS_SQL, params)
 
             conn.commit()
             logger.info(f"🧹 Очищено {old_payments_count} старых необработанных платежей (старше 7 дней)")
@@ -1911,14 +4257,7 @@ def check_subscription_consistency():
             logger.warning(problem)
 
         # 2. Проверяем успешные платежи без subscription_purchased
-        cursor.execute('''
-        SELECT p.telegram_id, u.username, p.payment_id, p.paid_at,
-               u.subscription_purchased
-        FROM payments p
-        JOIN users u ON p.telegram_id = u.telegram_id
-        WHERE p.status = 'succeeded'
-        AND u.subscription_purchased = FALSE
-        ''')
+        cursor.execute(PAID_WITHOUT_PURCHASE_SQL)
 
         successful_payments_without_purchase = cursor.fetchall()
         for payment in successful_payments_without_purchase:
@@ -1999,7 +4338,7 @@ def create_yookassa_payment(telegram_id: int) -> Optional[Dict]:
             },
             "confirmation": {
                 "type": "redirect",
-                "return_url": f"https://t.me/{bot.get_me().username}"
+                "return_url": bot_metadata.link()
             },
             "capture": True,
             "description": description,
@@ -2030,12 +4369,37 @@ def create_yookassa_payment(telegram_id: int) -> Optional[Dict]:
 
 def ensure_subscription_status(user_id):
     """Гарантированная проверка статуса подписки при каждом действии"""
-    logger.info(f"🔍 ПРОВЕРКА ПОДПИСКИ для пользователя {user_id}")
-    try:
-        cache_key = f"user_{user_id}"
-        cache.delete(cache_key)
+    ctx = get_request_context(user_id)
+    if ctx is not None and ctx.subscription_active is not None:
+        # В рамках одного обновления проверяем подписку только один раз
+        return ctx.subscription_active
+
+    verdict = subscription_cache.get(user_id)
+    if verdict is not None:
+        # Вердикт действителен до окончания подписки - в БД не ходим
+        has_active = verdict[0] or verdict[1]
+        if ctx is not None:
+            ctx.subscription_active = has_active
+        return has_active
 
+    logger.info(f"🔍 ПРОВЕРКА ПОДПИСКИ для пользователя {user_id}")
+    if ctx is not None:
+        user = ctx.get_user()
+    else:
+        cache.delete(f"user_{user_id}")
         user = db.get_user(user_id)
+
+    has_active = _resolve_subscription_status(user_id, user)
+    # Истекшая подписка уже деактивирована - строка даст отрицательный вердикт
+    subscription_cache.remember(user_id, user)
+    if ctx is not None:
+        ctx.subscription_active = has_active
+    return has_active
+
+
+def _resolve_subscription_status(user_id, user):
+    """Вердикт по строке пользователя с деактивацией истекшей подписки"""
+    try:
         logger.info(f"   Данные пользователя: {user}")
 
         if not user:
@@ -2052,21 +4416,15 @@ def ensure_subscription_status(user_id):
 
         end_date_str = user.get('subscription_end_date')
 
-        if not end_date_str:
-            logger.info(f"   ❌ Нет даты окончания")
-            return False
-
-        try:
-            end_naive = datetime.strptime(end_date_str, '%Y-%m-%d %H:%M:%S')
-        except ValueError:
-            try:
-                end_naive = datetime.strptime(end_date_str, '%Y-%m-%d')
-                end_naive = end_naive.replace(hour=23, minute=59, second=59)
-            except ValueError:
-                logger.info(f"   ❌ Неверный формат даты")
-                return False
+        if not end_date_str:
+            logger.info(f"   ❌ Нет даты окончания")
+            return False
+
+        end_aware = parse_db_datetime(end_date_str)
+        if end_aware is None:
+            logger.info(f"   ❌ Неверный формат даты")
+            return False
 
-        end_aware = pytz.UTC.localize(end_naive)
         now_aware = datetime.now(pytz.UTC)
         logger.info(f"   Подписка активна: {end_aware > now_aware}")
 
@@ -2083,6 +4441,7 @@ def ensure_subscription_status(user_id):
             ''', (user_id,))
             conn.commit()
             conn.close()
+            invalidate_user_state(user_id)
             logger.info(f"   ✅ Подписка деактивирована")
             return False
 
@@ -2097,11 +4456,24 @@ def check_user_access(chat_id: int, send_message: bool = True) -> bool:
     """Проверка доступа пользователя с автоматической деактивацией истекших подписок"""
     logger.info(f"🔐 check_user_access для {chat_id}, send_message={send_message}")
 
-    cache.delete(f"user_{chat_id}")
+    ctx = get_request_context(chat_id)
 
-    user = db.get_user(chat_id)
-    logger.info(f"   Пользователь: {user.get('username') if user else 'None'}")
-    if user and user.get('is_admin'):
+    def load_user():
+        if ctx is not None:
+            return ctx.get_user()
+        cache.delete(f"user_{chat_id}")
+        return db.get_user(chat_id)
+
+    verdict = subscription_cache.get(chat_id)
+    if verdict is not None:
+        # Строка пользователя понадобится только для текста отказа
+        user = None
+        is_admin = verdict[1]
+    else:
+        user = load_user()
+        logger.info(f"   Пользователь: {user.get('username') if user else 'None'}")
+        is_admin = bool(user and user.get('is_admin'))
+    if is_admin:
         logger.info(f"   ✅ Админ, доступ разрешен")
         return True
 
@@ -2121,8 +4493,9 @@ def check_user_access(chat_id: int, send_message: bool = True) -> bool:
 
     if not has_active:
         if send_message:
-            user_info = db.get_user(chat_id)
-            if user_info:
+            if user is None:
+                user = load_user()
+            if user:
                 markup = types.InlineKeyboardMarkup()
                 markup.add(types.InlineKeyboardButton("💳 Оформить подписку", callback_data="subscribe"))
                 markup.add(types.InlineKeyboardButton("🎁 Получить пробный доступ", callback_data="trial"))
@@ -2147,8 +4520,11 @@ def check_user_access(chat_id: int, send_message: bool = True) -> bool:
                     reply_markup=markup
                 )
         return False
-    logger.info(f"   ✅ Доступ разрешен, обновляю активность")
-    db.update_activity(chat_id)
+    if ctx is None or not ctx.activity_touched:
+        logger.info(f"   ✅ Доступ разрешен, обновляю активность")
+        db.update_activity(chat_id)
+        if ctx is not None:
+            ctx.activity_touched = True
     return True
 
 
@@ -2180,49 +4556,47 @@ def create_back_button(target: str = "main_menu") -> types.InlineKeyboardMarkup:
 # ============================================================================
 # НАСТРОЙКА КОМАНД БОТА
 # ============================================================================
+# Основные команды для всех пользователей
+BOT_COMMANDS = [
+    types.BotCommand("start", "Главное меню"),
+    types.BotCommand("help", "Справка по командам"),
+    types.BotCommand("stats", "Ваша статистика"),
+    types.BotCommand("myinfo", "Информация о вас"),
+    types.BotCommand("checkmypayment", "Проверить мой платеж"),
+]
+
+# Команды для администраторов
+ADMIN_BOT_COMMANDS = [
+    types.BotCommand("start", "Главное меню"),
+    types.BotCommand("help", "Помощь"),
+    types.BotCommand("stats", "Статистика"),
+    types.BotCommand("myinfo", "Моя информация"),
+    types.BotCommand("admin", "Панель администратора"),
+    types.BotCommand("reload", "Перезагрузить вопросы"),
+    types.BotCommand("check_subs", "Проверить подписки"),
+    types.BotCommand("all_stats", "Вся статистика"),
+    types.BotCommand("scheduler_status", "Статус планировщика"),
+    types.BotCommand("reset_stats", "Сбросить статистику"),
+    types.BotCommand("grant_sub", "Выдать подписку"),
+    types.BotCommand("extend_sub", "Продлить подписку"),  # НОВАЯ КОМАНДА
+    types.BotCommand("set_admin", "Назначить админа"),
+    types.BotCommand("check_sub_sync", "Синхронизация подписок"),
+    types.BotCommand("send_all_users", "Массовая рассылка"),
+]
+
+
 def setup_bot_commands():
     """Настройка меню команд бота"""
     try:
-        # Основные команды для всех пользователей
-        commands = [
-            types.BotCommand("start", "Главное меню"),
-            types.BotCommand("help", "Справка по командам"),
-            types.BotCommand("stats", "Ваша статистика"),
-            types.BotCommand("myinfo", "Информация о вас"),
-            types.BotCommand("checkmypayment", "Проверить мой платеж"),
-        ]
-
-        bot.set_my_commands(commands)
+        bot_metadata.set_commands(BOT_COMMANDS)
         logger.info("✅ Основные команды бота настроены")
 
-        # Команды для администраторов
-        admin_commands = [
-            types.BotCommand("start", "Главное меню"),
-            types.BotCommand("help", "Помощь"),
-            types.BotCommand("stats", "Статистика"),
-            types.BotCommand("myinfo", "Моя информация"),
-            types.BotCommand("admin", "Панель администратора"),
-            types.BotCommand("reload", "Перезагрузить вопросы"),
-            types.BotCommand("check_subs", "Проверить подписки"),
-            types.BotCommand("all_stats", "Вся статистика"),
-            types.BotCommand("scheduler_status", "Статус планировщика"),
-            types.BotCommand("reset_stats", "Сбросить статистику"),
-            types.BotCommand("grant_sub", "Выдать подписку"),
-            types.BotCommand("extend_sub", "Продлить подписку"),  # НОВАЯ КОМАНДА
-            types.BotCommand("set_admin", "Назначить админа"),
-            types.BotCommand("check_sub_sync", "Синхронизация подписок"),
-            types.BotCommand("send_all_users", "Массовая рассылка"),
-        ]
-
         # Настраиваем команды для администраторов
         admin_ids = db.get_admin_ids()
         for admin_id in admin_ids:
             try:
-                bot.set_my_commands(
-                    admin_commands,
-                    scope=types.BotCommandScopeChat(admin_id)
-                )
-                logger.info(f"✅ Админские команды настроены для {admin_id}")
+                if bot_metadata.set_commands(ADMIN_BOT_COMMANDS, chat_id=admin_id):
+                    logger.info(f"✅ Админские команды настроены для {admin_id}")
             except Exception as e:
                 logger.info(f"⚠️ Ошибка настройки админских команд для {admin_id}: {e}")
 
@@ -2344,10 +4718,7 @@ def send_question_inline(chat_id, message_id=None):
         topic_num = topics_list.index(topic) if topic in topics_list else 0
 
         # Получаем общее количество вопросов
-        if topic == "🎲 Все темы (рандом)":
-            total_questions = sum(len(q) for q in questions_by_topic.values())
-        else:
-            total_questions = len(questions_by_topic.get(topic, []))
+        total_questions = question_bank.count(topic)
 
         # Формируем сообщение о завершении темы
         completion_text = f"""
@@ -2407,9 +4778,7 @@ def send_question_inline(chat_id, message_id=None):
     # Обновляем данные пользователя
     user_data_manager.update_user_data(
         chat_id,
-        current_question=question_data['question'],
-        current_question_full=question_data.get('full_question', ''),  # Полная строка с номером
-        current_question_number=question_data.get('number', ''),  # Номер вопроса
+        current_question_id=question_data['id'],
         correct_answer=correct_answers,
         numbered_answers=numbered_answers,
         answers_list=answers_list,
@@ -2422,12 +4791,9 @@ def send_question_inline(chat_id, message_id=None):
 
     # Добавляем информацию о прогрессе
     user_data = user_data_manager.get_user_data(chat_id)
-    answered_questions = user_data.get('answered_questions', {}).get(topic, [])
+    answered_questions = user_data.get('answered_questions', {}).get(topic, ())
 
-    if topic == "🎲 Все темы (рандом)":
-        total_questions = sum(len(q) for q in questions_by_topic.values())
-    else:
-        total_questions = len(questions_by_topic.get(topic, []))
+    total_questions = question_bank.count(topic)
 
     answered_count = len(answered_questions)
     progress_percentage = (answered_count / total_questions * 100) if total_questions > 0 else 0
@@ -2511,6 +4877,7 @@ def send_question_inline(chat_id, message_id=None):
 
 
 @bot.message_handler(commands=['stats'])
+@request_scoped
 def handle_stats(message):
     """Обработчик команды /stats"""
     chat_id = message.chat.id
@@ -2799,6 +5166,7 @@ def handle_grant_sub(message):
         bot.send_message(chat_id, f"❌ Ошибка: {e}")
 
 @bot.message_handler(commands=['checkmypayment'])
+@request_scoped
 def handle_check_my_payment(message):
     """Проверка последнего платежа пользователя"""
     chat_id = message.chat.id
@@ -2809,13 +5177,7 @@ def handle_check_my_payment(message):
         conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
 
-        cursor.execute('''
-        SELECT payment_id, status, created_at 
-        FROM payments 
-        WHERE telegram_id = ? 
-        ORDER BY created_at DESC 
-        LIMIT 1
-        ''', (chat_id,))
+        cursor.execute(LAST_PAYMENT_SQL, (chat_id,))
 
         payment = cursor.fetchone()
         conn.close()
@@ -2956,6 +5318,14 @@ def handle_set_admin(message):
 
         if db.set_admin(target_id, is_admin):
             status = "назначен" if is_admin else "снят"
+            # Меню команд меняется сразу, без перезапуска бота
+            try:
+                if is_admin:
+                    bot_metadata.set_commands(ADMIN_BOT_COMMANDS, chat_id=target_id)
+                else:
+                    bot_metadata.reset_commands(target_id)
+            except Exception as e:
+                logger.info(f"⚠️ Не удалось обновить меню команд для {target_id}: {e}")
             bot.send_message(chat_id, f"✅ Пользователь {target_id} {status} администратором")
         else:
             bot.send_message(chat_id, f"❌ Не удалось изменить права пользователя {target_id}")
@@ -2976,16 +5346,20 @@ def handle_check_sub_sync(message):
         bot.send_message(chat_id, "❌ У вас нет прав для этой команды.")
         return
 
-    bot.send_message(chat_id, "🔄 Запускаю ПОЛНУЮ синхронизацию подписок...")
+    reporter = ProgressReporter(chat_id, parse_mode=None)
+    reporter.start("🔄 Запускаю ПОЛНУЮ синхронизацию подписок...")
 
     try:
         # 1. Сначала проверяем согласованность
+        reporter.update("🔄 Синхронизация подписок: 1/3 - проверка согласованности...")
         problems = check_subscription_consistency()
 
         # 2. ЗАПУСКАЕМ ПОЛНУЮ СИНХРОНИЗАЦИЮ (обновляет subscription_purchased)
+        reporter.update("🔄 Синхронизация подписок: 2/3 - исправление subscription_purchased...")
         full_result = full_sync_subscriptions()
 
         # 3. Старая синхронизация (только новые платежи)
+        reporter.update("🔄 Синхронизация подписок: 3/3 - обработка новых платежей...")
         old_result = sync_paid_subscriptions_on_startup()
 
         # Формируем отчет
@@ -3010,11 +5384,12 @@ def handle_check_sub_sync(message):
         else:
             report += "✅ <b>Проблем с согласованностью не найдено</b>"
 
+        reporter.finish("✅ Синхронизация подписок завершена")
         bot.send_message(chat_id, report, parse_mode='HTML')
 
     except Exception as e:
         error_msg = f"❌ Ошибка выполнения команды /check_sub_sync: {e}"
-        bot.send_message(chat_id, error_msg)
+        reporter.finish(error_msg)
         logger.error(error_msg)
         logger.error(traceback.format_exc())
 
@@ -3051,8 +5426,8 @@ def random_question_callback(call):
     # Устанавливаем тему "Все темы" через менеджер
     user_data_manager.update_user_data(
         chat_id,
-        current_topic="🎲 Все темы (рандом)",
-        current_question=None,
+        current_topic=RANDOM_TOPIC,
+        current_question_id=None,
         correct_answer=None,
         numbered_answers={},
         answers_list=[]
@@ -3094,10 +5469,7 @@ def change_topic_callback(call):
 
     for i, topic in enumerate(topics_list, 1):
         # Определяем общее количество вопросов
-        if topic == "🎲 Все темы (рандом)":
-            total_questions = sum(len(q) for q in questions_by_topic.values())
-        else:
-            total_questions = len(questions_by_topic.get(topic, []))
+        total_questions = question_bank.count(topic)
 
         # Получаем количество отвеченных
         answered_count = len(user_answered.get(topic, []))
@@ -3420,7 +5792,7 @@ def info_callback(call):
 • Увеличение стабильности системы.
 📚 <b>Загружено:</b>
 • Тем: {len(topics_list) - 1 if topics_list else 0}
-• Вопросов: {sum(len(q) for q in questions_by_topic.values()) if questions_by_topic else 0}
+• Вопросов: {len(question_bank)}
 
 📞 <b>Поддержка:</b> @ZlotaR
     """
@@ -3540,10 +5912,7 @@ def show_stats_message(chat_id, message_id=None):
 
         # Добавляем прогресс по каждой теме
         for topic in topics_list:
-            if topic == "🎲 Все темы (рандом)":
-                total_questions = sum(len(q) for q in questions_by_topic.values())
-            else:
-                total_questions = len(questions_by_topic.get(topic, []))
+            total_questions = question_bank.count(topic)
 
             if total_questions > 0:
                 answered_count = len(user_answered.get(topic, []))
@@ -3869,6 +6238,7 @@ def handle_confirm_extend_callback(call):
     """Подтверждение и выполнение продления"""
     chat_id = call.message.chat.id
     message_id = call.message.message_id
+    reporter = None
 
     try:
         if call.data.startswith("confirm_extend_all_"):
@@ -3881,7 +6251,17 @@ def handle_confirm_extend_callback(call):
             answer_callback_safe(bot, call.id, "⏳ Продлеваю подписки...")
             logger.info(f"🚀 ЗАПУСК ПРОДЛЕНИЯ ВСЕМ: +{days} дней, +{hours} часов")
 
-            result = db.extend_all_active_subscriptions(hours=hours, days=days)
+            reporter = ProgressReporter(chat_id, message_id)
+            reporter.start("⏳ <b>Продлеваю подписки...</b>")
+            result = db.extend_all_active_subscriptions(
+                hours=hours, days=days,
+                on_progress=lambda done, total, success, failed: reporter.update(
+                    f"⏳ <b>Продлеваю подписки...</b>\n\n"
+                    f"👥 Обработано: {done}/{total}\n"
+                    f"✅ Успешно: {success}\n"
+                    f"❌ Ошибок: {failed}"
+                )
+            )
 
             time_text = f"{days} дн. {hours} ч." if days > 0 or hours > 0 else "0 часов 0 дней"
 
@@ -3938,6 +6318,10 @@ def handle_confirm_extend_callback(call):
         markup.add(types.InlineKeyboardButton("↩️ Назад к продлению", callback_data="admin_extend_sub"))
         markup.add(types.InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu"))
 
+        if reporter is not None:
+            reporter.finish(report, reply_markup=markup)
+            return
+
         bot.edit_message_text(
             chat_id=chat_id,
             message_id=message_id,
@@ -3947,6 +6331,8 @@ def handle_confirm_extend_callback(call):
         )
 
     except Exception as e:
+        if reporter is not None:
+            reporter.finish("❌ <b>Ошибка при продлении</b>")
         logger.error(f"❌ Ошибка в handle_confirm_extend_callback: {e}")
         logger.error(traceback.format_exc())
         answer_callback_safe(bot, call.id, "❌ Ошибка при продлении")
@@ -4312,6 +6698,7 @@ def full_sync_subscriptions():
 
         if not users_to_fix:
             logger.info("✅ Нет пользователей для исправления")
+            conn.close()
             return {'fixed': 0, 'total': 0}
 
         fixed_count = 0
@@ -4360,6 +6747,9 @@ def full_sync_subscriptions():
         conn.commit()
         conn.close()
 
+        for user_data in users_to_fix:
+            invalidate_user_state(user_data[0])
+
         logger.info(f"✅ Полная синхронизация: исправлено {fixed_count} пользователей")
         return {'fixed': fixed_count, 'total': len(users_to_fix)}
 
@@ -4396,8 +6786,8 @@ def check_payment_callback(call):
         # Проверяем статус платежа с таймаутом и обработкой ошибок
         payment = None
         try:
-            # Пробуем получить статус платежа с таймаутом
-            payment = Payment.find_one(payment_id)  # Таймаут 10 секунд
+            # Финальный статус - из БД, иначе один общий запрос к ЮKassa на все нажатия
+            payment = payment_status_cache.get(payment_id)
         except yookassa.errors.ApiError as api_error:
             logger.error(f"❌ Ошибка API ЮKassa: {api_error}")
             # Показываем пользователю сообщение об ошибке API
@@ -4483,25 +6873,34 @@ def check_payment_callback(call):
             )
             return
 
-        # Обновляем статус в базе данных
-        db.update_payment_status(payment_id, payment.status)
+        # Обновляем статус в базе данных (статус из БД записывать не нужно)
+        if not PaymentStatusCache.is_local(payment):
+            db.update_payment_status(payment_id, payment.status)
 
         if payment.status == 'succeeded':
-            # Проверяем, не был ли платеж уже обработан
-            conn = db.get_connection()
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
+            # Активация идемпотентна: платеж мог уже обработать вебхук или синхронизация
+            activation = db.activate_purchased_payment(payment_id)
 
-            cursor.execute('''
-            SELECT is_processed, telegram_id 
-            FROM payments 
-            WHERE payment_id = ?
-            ''', (payment_id,))
+            if activation is None and not db.is_payment_processed(payment_id):
+                # Платеж не обработан - активация упала (ошибка БД), а не повторное нажатие
+                logger.error(f"❌ Не удалось активировать подписку по платежу {payment_id}")
+                markup = types.InlineKeyboardMarkup()
+                markup.add(types.InlineKeyboardButton("🔄 Попробовать снова",
+                                                      callback_data=f"check_payment_{payment_id}"))
+                markup.add(types.InlineKeyboardButton("📞 Поддержка", url="https://t.me/ZlotaR"))
 
-            payment_data = cursor.fetchone()
-            conn.close()
+                bot.edit_message_text(
+                    chat_id=chat_id,
+                    message_id=message_id,
+                    text="⚠️ <b>Не удалось активировать подписку</b>\n\n"
+                         "Платеж прошел, но при активации произошла ошибка.\n"
+                         "Попробуйте проверить статус еще раз или обратитесь в поддержку.",
+                    parse_mode='HTML',
+                    reply_markup=markup
+                )
+                return
 
-            if payment_data and payment_data['is_processed']:
+            if activation is None:
                 # Платеж уже был обработан ранее
                 answer_callback_safe(bot, call.id, "✅ Платеж уже был обработан ранее")
                 user = db.get_user(chat_id)
@@ -4516,6 +6915,7 @@ def check_payment_callback(call):
                             ''', (chat_id,))
                     conn.commit()
                     conn.close()
+                    invalidate_user_state(chat_id)
                     logger.info(f"✅ Исправлен subscription_purchased для {chat_id}")
                 # Просто показываем статус
                 user_info = db.get_user(chat_id)
@@ -4537,41 +6937,8 @@ def check_payment_callback(call):
                 )
                 return
 
-            # Платеж успешен и еще не обработан
-            telegram_id = payment.metadata.get('telegram_id') if hasattr(payment, 'metadata') else chat_id
-
-            # Улучшенная логика активации подписки
-            user = db.get_user(telegram_id)
-            if user and user.get('subscription_paid'):
-                # У пользователя уже есть активная подписка
-                if user.get('subscription_end_date'):
-                    try:
-                        current_end = datetime.strptime(user['subscription_end_date'], '%Y-%m-%d %H:%M:%S')
-                        # Продлеваем от текущей даты окончания, если она в будущем
-                        if current_end > datetime.now(pytz.UTC):
-                            end_datetime = current_end + timedelta(days=30)
-                        else:
-                            # Иначе начинаем с текущего момента + 1 день (буфер)
-                            end_datetime = datetime.now(pytz.UTC) + timedelta(days=30)
-                    except:
-                        end_datetime = datetime.now(pytz.UTC) + timedelta(days=30)
-                else:
-                    end_datetime = datetime.now(pytz.UTC) + timedelta(days=30)
-            else:
-                # Новая подписка
-                end_datetime = datetime.now(pytz.UTC) + timedelta(days=30)
-
-            # Активируем подписку с пометкой о покупке
-            db.update_subscription(
-                telegram_id=telegram_id,
-                paid_status=True,
-                end_datetime=end_datetime,
-                is_trial=False,
-                is_purchased=True  # Указываем, что это купленная подписка
-            )
-
-            # Помечаем платеж как обработанный
-            db.mark_payment_processed(payment_id)
+            # Платеж успешен и обработан только что
+            telegram_id, end_datetime = activation
 
             end_str = end_datetime.strftime("%d.%m.%Y в %H:%M")
 
@@ -4907,7 +7274,7 @@ def handle_broadcast_message(message):
         message_text = message.text
     else:
         # Для медиафайлов без подписи
-        message_text = "📎 [Медиафайл без подписи]"
+        message_text = BROADCAST_NO_CAPTION
 
     # Сохраняем сообщение
     user_state['state'] = 'waiting_for_confirmation'
@@ -4916,6 +7283,10 @@ def handle_broadcast_message(message):
     user_state['message_id'] = message.message_id
     user_state['timestamp'] = time.time()  # Добавляем timestamp для очистки
 
+    # Медиа прошлой версии сообщения (после "Редактировать") не должно попасть в рассылку
+    for kind in BROADCAST_MEDIA_TYPES + ('payload',):
+        user_state.pop(kind, None)
+
     # Если есть фото/документ/другие медиафайлы
     if message.photo:
         user_state['photo'] = message.photo[-1].file_id
@@ -4926,10 +7297,17 @@ def handle_broadcast_message(message):
     if message.audio:
         user_state['audio'] = message.audio.file_id
 
+    # Проверка лимитов Telegram до рассылки, а не на каждом получателе
+    try:
+        payload = BroadcastEngine.prepare_payload(user_state)
+    except ValueError as e:
+        user_state['state'] = 'waiting_for_message'
+        bot.send_message(chat_id, f"❌ {e}\n\nОтправьте исправленное сообщение для рассылки.")
+        return
+
     # Получаем информацию о пользователях
-    all_users = db.get_all_users()
-    active_users = [u for u in all_users if db.check_subscription(u['telegram_id'])]
-    total_users = len(all_users)
+    total_users = db.count_recipients()
+    active_users_count = db.count_recipients(active_only=True)
 
     # Предпросмотр сообщения
     preview_text = "📢 <b>ПРЕДПРОСМОТР РАССЫЛКИ</b>\n\n"
@@ -4939,7 +7317,7 @@ def handle_broadcast_message(message):
 
     preview_text += f"\n\n📊 <b>Статистика:</b>\n"
     preview_text += f"👥 Всего пользователей: {total_users}\n"
-    preview_text += f"✅ Активных подписок: {len(active_users)}\n\n"
+    preview_text += f"✅ Активных подписок: {active_users_count}\n\n"
     preview_text += "⚠️ <b>Внимание:</b> Это сообщение будет отправлено ВСЕМ пользователям бота."
 
     markup = types.InlineKeyboardMarkup(row_width=2)
@@ -4956,7 +7334,7 @@ def handle_broadcast_message(message):
     try:
         # Если есть фото
         if 'photo' in user_state:
-            bot.send_photo(
+            preview_message = bot.send_photo(
                 chat_id,
                 photo=user_state['photo'],
                 caption=preview_text,
@@ -4964,7 +7342,7 @@ def handle_broadcast_message(message):
                 reply_markup=markup
             )
         elif 'document' in user_state:
-            bot.send_document(
+            preview_message = bot.send_document(
                 chat_id,
                 document=user_state['document'],
                 caption=preview_text,
@@ -4972,7 +7350,7 @@ def handle_broadcast_message(message):
                 reply_markup=markup
             )
         elif 'video' in user_state:
-            bot.send_video(
+            preview_message = bot.send_video(
                 chat_id,
                 video=user_state['video'],
                 caption=preview_text,
@@ -4980,7 +7358,7 @@ def handle_broadcast_message(message):
                 reply_markup=markup
             )
         elif 'audio' in user_state:
-            bot.send_audio(
+            preview_message = bot.send_audio(
                 chat_id,
                 audio=user_state['audio'],
                 caption=preview_text,
@@ -4988,12 +7366,15 @@ def handle_broadcast_message(message):
                 reply_markup=markup
             )
         else:
-            bot.send_message(
+            preview_message = bot.send_message(
                 chat_id,
                 preview_text,
                 parse_mode='HTML',
                 reply_markup=markup
             )
+
+        # Предпросмотр - единственная загрузка медиа: дальше рассылается file_id из ответа
+        user_state['payload'] = BroadcastEngine.capture_file_id(payload, preview_message)
     except Exception as e:
         bot.send_message(
             chat_id,
@@ -5057,147 +7438,20 @@ def handle_broadcast_callback(call):
         )
 
 def send_broadcast_to_all(admin_chat_id, broadcast_data, message_id, active_only=False):
-    """Отправка рассылки всем пользователям"""
+    """Запуск рассылки фоновым заданием (прогресс и итог приходят отдельным сообщением)"""
     try:
-        # Получаем всех пользователей
-        all_users = db.get_all_users()
-
-        if active_only:
-            users_to_send = [u for u in all_users if db.check_subscription(u['telegram_id'])]
-            filter_text = "только активным пользователям"
-        else:
-            users_to_send = all_users
-            filter_text = "всем пользователям"
-
-        total_users = len(users_to_send)
-        success_count = 0
-        failed_count = 0
-        failed_users = []
-
-        # Отправляем статус
-        status_message = bot.send_message(
-            admin_chat_id,
-            f"📤 <b>Начинаю рассылку {filter_text}</b>\n\n"
-            f"👥 Всего получателей: {total_users}\n"
-            f"✅ Успешно отправлено: 0/{total_users}\n"
-            f"❌ Ошибок: 0\n"
-            f"⏳ Ожидание: {total_users}",
-            parse_mode='HTML'
-        )
-
-        # Отправляем сообщение каждому пользователю
-        for i, user in enumerate(users_to_send, 1):
-            try:
-                user_id = user['telegram_id']
-
-                # Пропускаем администратора, который отправляет рассылку
-                if user_id == admin_chat_id:
-                    success_count += 1
-                    continue
-
-                # Отправляем сообщение в зависимости от типа
-                if 'photo' in broadcast_data:
-                    bot.send_photo(
-                        user_id,
-                        photo=broadcast_data['photo'],
-                        caption=broadcast_data['message'],
-                        parse_mode='HTML'
-                    )
-                elif 'document' in broadcast_data:
-                    bot.send_document(
-                        user_id,
-                        document=broadcast_data['document'],
-                        caption=broadcast_data['message'],
-                        parse_mode='HTML'
-                    )
-                elif 'video' in broadcast_data:
-                    bot.send_video(
-                        user_id,
-                        video=broadcast_data['video'],
-                        caption=broadcast_data['message'],
-                        parse_mode='HTML'
-                    )
-                elif 'audio' in broadcast_data:
-                    bot.send_audio(
-                        user_id,
-                        audio=broadcast_data['audio'],
-                        caption=broadcast_data['message'],
-                        parse_mode='HTML'
-                    )
-                else:
-                    bot.send_message(
-                        user_id,
-                        broadcast_data['message'],
-                        parse_mode='HTML'
-                    )
-
-                success_count += 1
-
-                # Обновляем активность пользователя
-                db.update_activity(user_id)
-
-            except Exception as e:
-                failed_count += 1
-                failed_users.append(f"{user_id} ({user.get('username', 'нет username')})")
-                logger.error(f"Ошибка при отправке рассылки пользователю {user_id}: {e}")
-
-            # Обновляем статус каждые 10 сообщений или в конце
-            if i % 10 == 0 or i == total_users:
-                try:
-                    bot.edit_message_text(
-                        chat_id=admin_chat_id,
-                        message_id=status_message.message_id,
-                        text=f"📤 <b>Рассылка в процессе...</b>\n\n"
-                             f"👥 Всего получателей: {total_users}\n"
-                             f"✅ Успешно отправлено: {success_count}/{total_users}\n"
-                             f"❌ Ошибок: {failed_count}\n"
-                             f"⏳ Ожидание: {total_users - i}",
-                        parse_mode='HTML'
-                    )
-                except:
-                    pass
-
-            # Небольшая задержка, чтобы не превысить лимиты Telegram
-            time.sleep(0.1)
-
-        # Логируем результат
-        logger.info(
-            f"Администратор {admin_chat_id} отправил рассылку. Успешно: {success_count}, Ошибок: {failed_count}")
-
-        # Формируем итоговый отчет
-        report_text = f"📊 <b>ИТОГ РАССЫЛКИ</b>\n\n"
-        report_text += f"✅ <b>Успешно отправлено:</b> {success_count}/{total_users}\n"
-        report_text += f"❌ <b>Ошибок:</b> {failed_count}\n"
-
-        if active_only:
-            report_text += f"🎯 <b>Фильтр:</b> Только активные пользователи\n"
-        else:
-            report_text += f"🎯 <b>Фильтр:</b> Все пользователи\n"
-
-        if failed_count > 0 and len(failed_users) > 0:
-            report_text += f"\n📝 <b>Список ошибок (первые 10):</b>\n"
-            for failed in failed_users[:10]:
-                report_text += f"• {failed}\n"
-
-            if len(failed_users) > 10:
-                report_text += f"... и еще {len(failed_users) - 10} пользователей\n"
-
-        # Отправляем итоговый отчет
-        bot.edit_message_text(
-            chat_id=admin_chat_id,
-            message_id=status_message.message_id,
-            text=report_text,
-            parse_mode='HTML'
-        )
+        # Получатели отбираются в SQL и потоком пишутся в задание.
+        # Администратор, который отправляет рассылку, сообщение уже видел
+        recipient_ids = (telegram_id for telegram_id in db.iter_recipient_ids(active_only)
+                         if telegram_id != admin_chat_id)
+        job_id = broadcast_engine.create_job(admin_chat_id, broadcast_data, recipient_ids, active_only)
 
         # Очищаем состояние
         if admin_chat_id in user_data_manager.broadcast_states:
             del user_data_manager.broadcast_states[admin_chat_id]
 
-        # Отправляем уведомление в лог-чат
-        log_text = f"📢 Администратор {admin_chat_id} провел рассылку\n"
-        log_text += f"✅ Успешно: {success_count}, ❌ Ошибок: {failed_count}"
-        logger.info(log_text)
+        broadcast_engine.start(job_id)
+        logger.info(f"📢 Рассылка #{job_id} запущена администратором {admin_chat_id}")
 
     except Exception as e:
         logger.error(f"Ошибка при массовой рассылке: {e}")
@@ -5224,7 +7478,7 @@ def check_answer_callback(call):
 
     # Получаем данные пользователя
     user_data = user_data_manager.get_user_data(chat_id)
-    if not user_data.get('current_question'):
+    if user_data.get('current_question_id') is None:
         answer_callback_safe(bot, call.id, "⚠️ Нет активного вопроса!")
         return
 
@@ -5237,7 +7491,7 @@ def check_answer_callback(call):
 
         selected_answer = user_data['numbered_answers'][answer_number]
         correct_answers = user_data['correct_answer']
-        question_text = user_data['current_question']
+        question_id = user_data['current_question_id']
         topic = user_data.get('current_question_topic', user_data.get('current_topic'))
 
         if not topic:
@@ -5248,19 +7502,17 @@ def check_answer_callback(call):
         is_correct = selected_answer in correct_answers
 
         # Отмечаем вопрос как отвеченный в сессии
-        user_data_manager.mark_question_answered(chat_id, topic, question_text, is_correct)
+        user_data_manager.mark_question_answered(chat_id, topic, question_id, is_correct)
 
-        # Обновляем статистику в базе данных
-        db.update_statistics(chat_id, is_correct)
+        # Обновляем статистику (сразу получаем итоги с учетом этого ответа)
+        total_stats = db.update_statistics(chat_id, is_correct)
 
         # Обновляем статистику сессии
         session_stats_data = user_data_manager.get_session_stats(chat_id)
         session_stats_data['session_total'] += 1
         if is_correct:
             session_stats_data['session_correct'] += 1
-
-        # Получаем общую статистику
-        total_stats = db.get_user_statistics(chat_id)
+        user_data_manager.mark_progress_dirty(chat_id)
 
         # Получаем статистику текущей сессии
         session_total = session_stats_data['session_total']
@@ -5579,7 +7831,7 @@ def handle_topic_selection(call):
         user_data_manager.update_user_data(
             chat_id,
             current_topic=selected_topic,
-            current_question=None,
+            current_question_id=None,
             correct_answer=None,
             numbered_answers={},
             answers_list=[],
@@ -5587,13 +7839,10 @@ def handle_topic_selection(call):
         )
 
         # Получаем статистику
-        if selected_topic == "🎲 Все темы (рандом)":
-            topic_questions_count = sum(len(q) for q in questions_by_topic.values())
-        else:
-            topic_questions_count = len(questions_by_topic.get(selected_topic, []))
+        topic_questions_count = question_bank.count(selected_topic)
 
         user_data = user_data_manager.get_user_data(chat_id)
-        answered_questions = user_data.get('answered_questions', {}).get(selected_topic, [])
+        answered_questions = user_data.get('answered_questions', {}).get(selected_topic, ())
         answered_count = len(answered_questions)
         remaining_count = topic_questions_count - answered_count
 
@@ -5663,11 +7912,12 @@ def handle_topic_restart(call):
             session_stats = user_data_manager.get_session_stats(chat_id)
             session_stats['session_total'] = 0
             session_stats['session_correct'] = 0
+            user_data_manager.mark_progress_dirty(chat_id)
 
             user_data_manager.update_user_data(
                 chat_id,
                 current_topic=selected_topic,
-                current_question=None,
+                current_question_id=None,
                 correct_answer=None,
                 numbered_answers={},
                 answers_list=[],
@@ -5675,12 +7925,7 @@ def handle_topic_restart(call):
             )
 
             # Получаем обновленную информацию о теме
-            if selected_topic == "🎲 Все темы (рандом)":
-                topic_questions_count = sum(len(q) for q in questions_by_topic.values())
-            elif selected_topic in questions_by_topic:
-                topic_questions_count = len(questions_by_topic[selected_topic])
-            else:
-                topic_questions_count = 0
+            topic_questions_count = question_bank.count(selected_topic)
 
             # Формируем сообщение
             restart_text = f"""
@@ -5734,6 +7979,7 @@ def handle_topic_restart(call):
         answer_callback_safe(bot, call.id, "❌ Ошибка перезапуска")
 
 @bot.message_handler(commands=['start'])
+@request_scoped
 def handle_start(message):
     """Обработчик команды /start"""
     chat_id = message.chat.id
@@ -5757,7 +8003,7 @@ def handle_start(message):
     user_data_manager.update_user_data(
         chat_id,
         current_topic=None,
-        current_question=None,
+        current_question_id=None,
         correct_answer=None,
         numbered_answers={},
         answers_list=[]
@@ -5794,22 +8040,23 @@ def rate_limit_wrapper(message):
         bot.send_message(
             user_id,
             "⚠️ <b>Слишком много запросов!</b>\n\n"
-            "Пожалуйста, подождите 1 минуту перед следующим запросом.",
+            "Пожалуйста, подождите немного перед следующим запросом.",
             parse_mode='HTML'
         )
         return
 
 
 @bot.callback_query_handler(func=lambda call: True)
+@request_scoped
 def universal_callback_handler(call):
     user_id = call.from_user.id
 
     # Rate limiting для callback
-    if not rate_limiter.check_callback(user_id):
+    if not rate_limiter.check_callback(user_id, call.data):
         try:
             bot.answer_callback_query(
                 call.id,
-                "⚠️ Слишком много запросов! Подождите минуту.",
+                "⚠️ Слишком много запросов! Подождите немного.",
                 show_alert=True
             )
         except:
@@ -6035,6 +8282,208 @@ def universal_callback_handler(call):
             safe_answer("❌ Произошла ошибка. Попробуйте снова.", show_alert=False)
         except:
             pass
+# ============================================================================
+# ВЕБХУК ЮKASSA
+# ============================================================================
+# Адреса, с которых ЮKassa отправляет уведомления (документация ЮKassa, раздел "Входящие уведомления")
+YOOKASSA_NOTIFICATION_NETWORKS = (
+    '185.71.76.0/27',
+    '185.71.77.0/27',
+    '77.75.153.0/25',
+    '77.75.156.11/32',
+    '77.75.156.35/32',
+    '77.75.154.128/25',
+    '2a02:5180::/32',
+)
+
+YOOKASSA_PAYMENT_EVENTS = {
+    WebhookNotificationEventType.PAYMENT_SUCCEEDED: 'succeeded',
+    WebhookNotificationEventType.PAYMENT_WAITING_FOR_CAPTURE: 'waiting_for_capture',
+    WebhookNotificationEventType.PAYMENT_CANCELED: 'canceled',
+}
+
+
+def process_yookassa_notification(event_json: Dict) -> int:
+    """Обработка уведомления ЮKassa, возвращает HTTP-код ответа.
+
+    Уведомление сверяется с локальной записью платежа (сумма, валюта,
+    владелец), статус записывается в payments, успешный платеж активирует
+    подписку через db.activate_purchased_payment - повторная доставка того же
+    уведомления ничего не меняет. Код 500 просит ЮKassa повторить доставку.
+    """
+    try:
+        notification = WebhookNotificationFactory().create(event_json)
+    except Exception as e:
+        logger.warning(f"⚠️ Вебхук ЮKassa: некорректное уведомление: {e}")
+        return 400
+
+    status = YOOKASSA_PAYMENT_EVENTS.get(notification.event)
+    if status is None:
+        logger.info(f"ℹ️ Вебхук ЮKassa: событие {notification.event} пропущено")
+        return 200
+
+    payment = notification.object
+    payment_id = payment.id
+    if payment.status != status:
+        logger.warning(f"⚠️ Вебхук ЮKassa: событие {notification.event} со статусом {payment.status}")
+        return 400
+
+    local = db.get_payment_by_external_id(payment_id)
+    if local is None:
+        # Платеж создан не этим ботом - повторять доставку бессмысленно
+        logger.warning(f"⚠️ Вебхук ЮKassa: неизвестный платеж {payment_id}")
+        return 200
+
+    try:
+        amount_matches = (payment.amount.currency == 'RUB'
+                          and abs(float(payment.amount.value) - float(local['amount'])) < 0.01)
+    except (AttributeError, TypeError, ValueError):
+        amount_matches = False
+    metadata = payment.metadata or {}
+    owner = metadata.get('telegram_id')
+    if not amount_matches or (owner is not None and str(owner) != str(local['telegram_id'])):
+        logger.warning(f"⚠️ Вебхук ЮKassa: данные платежа {payment_id} не совпадают с записью в БД")
+        return 400
+
+    if local['status'] == 'succeeded' and status != 'succeeded':
+        # Поздно пришедшее уведомление не откатывает успешный платеж
+        return 200
+
+    if local['status'] != status and not db.update_payment_status(payment_id, status):
+        return 500
+    payment_status_cache.invalidate(payment_id)
+
+    if status != 'succeeded':
+        logger.info(f"💳 Вебхук ЮKassa: платеж {payment_id} -> {status}")
+        return 200
+
+    activation = db.activate_purchased_payment(payment_id)
+    if activation is None:
+        # None и при уже обработанном платеже, и при ошибке БД - различаем по отметке
+        return 200 if db.is_payment_processed(payment_id) else 500
+
+    telegram_id, end_datetime = activation
+    try:
+        markup = types.InlineKeyboardMarkup()
+        markup.add(types.InlineKeyboardButton("🚀 Начать обучение", callback_data="main_menu"))
+        bot.send_message(
+            telegram_id,
+            f"🎉 <b>Оплата получена, подписка активирована!</b>\n\n"
+            f"💰 Сумма: {SUBSCRIPTION_PRICE}₽\n"
+            f"📅 Подписка действует до: {end_datetime.strftime('%d.%m.%Y %H:%M')}",
+            parse_mode='HTML',
+            reply_markup=markup
+        )
+    except Exception as e:
+        logger.warning(f"⚠️ Не удалось уведомить {telegram_id} об оплате: {e}")
+    return 200
+
+
+class YooKassaWebhookServer:
+    """Встроенный HTTP-приемник уведомлений ЮKassa.
+
+    Принимает POST на path только с доверенных адресов и передает JSON
+    в handler (по умолчанию process_yookassa_notification). Каждый запрос
+    обрабатывается в своем потоке; port=0 - свободный порт (см. self.port).
+    """
+
+    MAX_BODY_BYTES = 64 * 1024
+
+    def __init__(self, host: str, port: int, path: str, handler=None,
+                 trusted: str = '', behind_proxy: bool = False):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.handler = handler or process_yookassa_notification
+        self.behind_proxy = behind_proxy
+        self.networks = [ipaddress.ip_network(net) for net in YOOKASSA_NOTIFICATION_NETWORKS]
+        self.networks += [ipaddress.ip_network(net.strip(), strict=False)
+                          for net in trusted.split(',') if net.strip()]
+        self._httpd = None
+        self._thread = None
+
+    def is_trusted(self, address: str) -> bool:
+        """Адрес отправителя входит в доверенные сети"""
+        try:
+            ip = ipaddress.ip_address(address.strip())
+        except ValueError:
+            return False
+        return any(ip in net for net in self.networks)
+
+    def _make_request_handler(self):
+        webhook = self
+
+        class _RequestHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path.split('?', 1)[0] != webhook.path:
+                    self._reply(404)
+                    return
+
+                address = self.client_address[0]
+                forwarded = self.headers.get('X-Forwarded-For')
+                if webhook.behind_proxy and forwarded:
+                    address = forwarded.split(',')[-1]
+                if not webhook.is_trusted(address):
+                    logger.warning(f"⚠️ Вебхук ЮKassa: запрос с недоверенного адреса {address}")
+                    self._reply(403)
+                    return
+
+                try:
+                    length = int(self.headers.get('Content-Length') or 0)
+                except ValueError:
+                    length = -1
+                if length <= 0 or length > webhook.MAX_BODY_BYTES:
+                    self._reply(400 if length <= 0 else 413)
+                    return
+
+                try:
+                    event_json = json.loads(self.rfile.read(length).decode('utf-8'))
+                except (UnicodeDecodeError, ValueError):
+                    self._reply(400)
+                    return
+
+                try:
+                    code = webhook.handler(event_json)
+                except Exception as e:
+                    logger.error(f"❌ Ошибка обработки вебхука ЮKassa: {e}")
+                    logger.error(traceback.format_exc())
+                    code = 500
+                self._reply(code)
+
+            def _reply(self, code: int):
+                self.send_response(code)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                logger.debug(f"🌐 Вебхук ЮKassa: {format % args}")
+
+        return _RequestHandler
+
+    def start(self) -> bool:
+        """Запуск приемника в фоновом потоке"""
+        try:
+            self._httpd = ThreadingHTTPServer((self.host, self.port), self._make_request_handler())
+        except OSError as e:
+            logger.error(f"❌ Не удалось запустить вебхук ЮKassa на {self.host}:{self.port}: {e}")
+            return False
+        self._httpd.daemon_threads = True
+        self.port = self._httpd.server_address[1]
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name='yookassa-webhook', daemon=True)
+        self._thread.start()
+        logger.info(f"✅ Вебхук ЮKassa слушает {self.host}:{self.port}{self.path}")
+        return True
+
+    def stop(self):
+        """Остановка приемника"""
+        if self._httpd is None:
+            return
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self._httpd = None
+        logger.info("🛑 Вебхук ЮKassa остановлен")
+
+
 # ============================================================================
 # ЗАПУСК БОТА
 # ============================================================================
@@ -6050,12 +8499,23 @@ def setup_scheduler():
             logger.info("⏰ Планировщик уже запущен, пропускаем...")
             return scheduler
 
-        # Ежедневная проверка подписок - КАЖДЫЙ ЧАС для надежности
+        # Истечение подписок обрабатывает expiry_scheduler в момент окончания;
+        # редкий обход таблицы - страховка на случай сбоев и повторов
         scheduler.add_job(
             check_and_update_subscriptions,
-            trigger=CronTrigger(minute=0),  # Каждый час в 0 минут
-            id='hourly_subscription_check',
-            name='Проверка подписок (каждый час)',
+            trigger='interval',
+            hours=6,
+            id='subscription_expiry_sweep',
+            name='Страховочная проверка истекших подписок',
+            replace_existing=True
+        )
+
+        # Напоминания об окончании подписки в ближайшие сутки (в 12:00)
+        scheduler.add_job(
+            send_expiry_reminders,
+            trigger=CronTrigger(hour=12, minute=0, timezone=NOVOSIBIRSK_TZ),
+            id='daily_expiry_reminders',
+            name='Напоминания об окончании подписки',
             replace_existing=True
         )
 
@@ -6078,6 +8538,54 @@ def setup_scheduler():
             replace_existing=True
         )
 
+        # Запись прогресса викторины в БД (каждые 30 секунд)
+        scheduler.add_job(
+            user_data_manager.flush_progress,
+            trigger='interval',
+            seconds=30,
+            id='progress_flush',
+            name='Сохранение прогресса',
+            replace_existing=True
+        )
+
+        # Активная очистка просроченных записей кеша (каждые 5 минут)
+        scheduler.add_job(
+            cache.sweep_expired,
+            trigger='interval',
+            minutes=5,
+            id='cache_sweep',
+            name='Очистка кеша',
+            replace_existing=True
+        )
+
+        # Удаление наполнившихся ведер лимитера и бюджетов чатов (каждые 5 минут)
+        scheduler.add_job(
+            rate_limiter.sweep_idle,
+            trigger='interval',
+            minutes=5,
+            id='rate_limit_sweep',
+            name='Очистка лимитера',
+            replace_existing=True
+        )
+        scheduler.add_job(
+            outbound.sweep_idle,
+            trigger='interval',
+            minutes=5,
+            id='outbound_sweep',
+            name='Очистка бюджетов отправки',
+            replace_existing=True
+        )
+
+        # Данные бота (get_me) обновляются раз в сутки
+        scheduler.add_job(
+            bot_metadata.refresh_if_stale,
+            trigger='interval',
+            hours=6,
+            id='bot_metadata_refresh',
+            name='Обновление данных бота',
+            replace_existing=True
+        )
+
         # Логирование использования памяти (каждый час)
         scheduler.add_job(
             log_memory_usage,
@@ -6123,8 +8631,24 @@ def setup_scheduler():
 
 
 
+def log_cache_stats():
+    """Логирование статистики кеша по пространствам имен"""
+    for namespace, stats in sorted(cache.get_stats().items()):
+        lookups = stats['hits'] + stats['misses']
+        hit_rate = stats['hits'] / lookups * 100 if lookups else 0.0
+        logger.info(
+            f"🗄️ Кеш [{namespace}]: записей {stats['size']}, попаданий {hit_rate:.1f}% "
+            f"({stats['hits']}/{lookups}), вытеснено {stats['evictions']}, истекло {stats['expired']}"
+        )
+
+
 def log_memory_usage():
     """Логирование использования памяти"""
+    try:
+        log_cache_stats()
+    except Exception as e:
+        logger.error(f"Ошибка логирования кеша: {e}")
+
     try:
         import psutil
         process = psutil.Process()
@@ -6144,80 +8668,158 @@ def log_memory_usage():
         logger.error(f"Ошибка логирования памяти: {e}")
 
 
-def check_and_update_subscriptions():
-    """Проверка и обновление подписок - ВСЕ В UTC"""
+def check_and_update_subscriptions() -> bool:
+    """Проверка и обновление подписок - ВСЕ В UTC (False - изменения не записаны)"""
+    conn = None
     try:
-        # ИСПОЛЬЗУЕМ UTC, А НЕ NOVOSIBIRSK_TZ!
-        current_datetime = datetime.now(pytz.UTC)
+        # Истекшие подписки ищем по индексу subscription_end_ts, без разбора дат в Python
+        now_ts = int(datetime.now(pytz.UTC).timestamp())
 
         conn = db.get_connection()
         cursor = conn.cursor()
 
-        # Находим истекшие подписки
-        cursor.execute('''
-        SELECT telegram_id, username, first_name, subscription_end_date 
-        FROM users 
-        WHERE subscription_paid = TRUE 
-        AND subscription_end_date IS NOT NULL
-        ''')
+        if SQLITE_HAS_RETURNING:
+            cursor.execute(EXPIRE_SUBSCRIPTIONS_SQL + ' RETURNING telegram_id', (now_ts,))
+            users_to_update = [row[0] for row in cursor.fetchall()]
+        else:
+            cursor.execute(EXPIRED_SUBSCRIPTIONS_SQL, (now_ts,))
+            users_to_update = [row[0] for row in cursor.fetchall()]
+            cursor.execute(EXPIRE_SUBSCRIPTIONS_SQL, (now_ts,))
 
-        expired_users = []
-        users_to_update = []
+        conn.commit()
+        conn.close()
 
-        for row in cursor.fetchall():
-            user_id, username, first_name, end_date_str = row
-            if not end_date_str:
-                continue
+        if users_to_update:
+            for user_id in users_to_update:
+                invalidate_user_state(user_id)
+            logger.info(f"✅ Обновлено {len(users_to_update)} истекших подписок")
+        return True
 
+    except Exception as e:
+        logger.error(f"❌ Ошибка при проверке подписок: {e}")
+        logger.error(traceback.format_exc())
+        if conn is not None:
+            # Соединение вернется в пул - незавершенная транзакция не должна уйти с ним
             try:
-                # Парсим дату из БД (предполагаем UTC)
-                try:
-                    end_naive = datetime.strptime(end_date_str, '%Y-%m-%d %H:%M:%S')
-                except ValueError:
-                    end_naive = datetime.strptime(end_date_str, '%Y-%m-%d')
-                    end_naive = end_naive.replace(hour=23, minute=59, second=59)
-
-                # Делаем aware (UTC)
-                end_aware = pytz.UTC.localize(end_naive)
-
-                # Сравниваем aware datetime
-                if end_aware < current_datetime:
-                    expired_users.append({
-                        'id': user_id,
-                        'username': username,
-                        'first_name': first_name,
-                        'end_date': end_date_str
-                    })
-                    users_to_update.append(user_id)
+                conn.rollback()
+            except sqlite3.Error:
+                pass
+            conn.close()
+        return False
 
-            except (ValueError, TypeError) as e:
-                logger.error(f"⚠️ Ошибка парсинга даты для пользователя {user_id}: {e}")
-                continue
 
-        # Обновляем истекшие подписки
-        if users_to_update:
-            placeholders = ','.join('?' * len(users_to_update))
-            cursor.execute(f'''
-            UPDATE users 
-            SET subscription_paid = FALSE,
-                subscription_start_date = NULL,
-                subscription_end_date = NULL
-            WHERE telegram_id IN ({placeholders})
-            ''', users_to_update)
+def send_expiry_reminders(hours_ahead: int = 24, page_size: int = 500, workers: int = 4,
+                          retry_rounds: int = 2, retry_delay: float = 5.0) -> int:
+    """Напоминания об окончании подписки в ближайшие hours_ahead часов.
+
+    Получатели отбираются страницами одним индексным запросом (idx_users_paid_end),
+    повтор исключает last_warning_date. Отправка идет пулом в полосе рассылки outbound,
+    поэтому не мешает интерактивным ответам; отметка last_warning_date - пачкой на страницу.
+    Временные сбои повторяются в этом же запуске (retry_rounds раундов с растущей паузой),
+    иначе до следующего суточного прогона подписка может успеть закончиться.
+    """
+    now_ts = int(time.time())
+    today = datetime.now(pytz.UTC).strftime('%Y-%m-%d')
+    # Напоминали в пределах того же окна - второй раз не шлем
+    warned_before = (datetime.now(pytz.UTC) - timedelta(hours=hours_ahead)).strftime('%Y-%m-%d')
+
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton("💳 Продлить подписку", callback_data="subscribe"))
 
+    def deliver(row):
+        telegram_id, end_ts = row
+        end_local = datetime.fromtimestamp(end_ts, pytz.UTC).astimezone(NOVOSIBIRSK_TZ)
+        try:
+            with outbound.broadcast():
+                bot.send_message(
+                    telegram_id,
+                    f"⏰ <b>Подписка скоро закончится</b>\n\n"
+                    f"📅 Действует до: {end_local.strftime('%d.%m.%Y в %H:%M')}\n\n"
+                    f"Продлите подписку, чтобы не прерывать подготовку.",
+                    parse_mode='HTML',
+                    reply_markup=markup
+                )
+            return telegram_id, 'sent'
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось отправить напоминание {telegram_id}: {e}")
+            # Бот заблокирован / чат не найден - повтор не поможет, отмечаем как обработанного
+            permanent = isinstance(e, telebot.apihelper.ApiTelegramException) and e.error_code in (400, 403)
+            return telegram_id, 'failed' if permanent else 'retry'
+
+    def mark_processed(results):
+        processed = [(today, telegram_id) for telegram_id, status in results if status != 'retry']
+        if not processed:
+            return
+        conn = db.get_connection()
+        try:
+            conn.executemany("UPDATE users SET last_warning_date = ? WHERE telegram_id = ?", processed)
             conn.commit()
-            logger.info(f"✅ Обновлено {len(users_to_update)} истекших подписок")
+        finally:
+            conn.close()
 
-        conn.close()
+    sent_total = 0
+    after_id = 0
+    retry_rows = []
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='expiry-reminder') as pool:
+            while True:
+                conn = db.get_connection()
+                try:
+                    page = conn.execute(EXPIRY_REMINDERS_PAGE_SQL, {
+                        'now': now_ts, 'until': now_ts + hours_ahead * 3600,
+                        'warned_before': warned_before, 'after_id': after_id,
+                        'limit': page_size
+                    }).fetchall()
+                finally:
+                    conn.close()
+
+                if not page:
+                    break
+                after_id = page[-1][0]
+
+                results = list(pool.map(deliver, page))
+                mark_processed(results)
+                sent_total += sum(1 for _, status in results if status == 'sent')
+                retry_rows.extend(row for row, (_, status) in zip(page, results) if status == 'retry')
+
+            # Пул отработал все страницы - повторяем временные сбои, пока подписка еще активна
+            for attempt in range(retry_rounds):
+                if not retry_rows:
+                    break
+                time.sleep(retry_delay * (attempt + 1))
+                rows = [row for row in retry_rows if row[1] > int(time.time())]
+                results = list(pool.map(deliver, rows))
+                mark_processed(results)
+                sent_total += sum(1 for _, status in results if status == 'sent')
+                retry_rows = [row for row, (_, status) in zip(rows, results) if status == 'retry']
+
+        if retry_rows:
+            logger.warning(f"⚠️ Напоминания не доставлены после повторов: {len(retry_rows)}")
+        if sent_total:
+            logger.info(f"⏰ Напоминаний об окончании подписки: {sent_total}")
+        return sent_total
 
     except Exception as e:
-        logger.error(f"❌ Ошибка при проверке подписок: {e}")
+        logger.error(f"❌ Ошибка при отправке напоминаний: {e}")
         logger.error(traceback.format_exc())
+        return sent_total
 
 
 def shutdown_handler(signum=None, frame=None):
     """Обработчик завершения работы"""
     logger.info("⚠️ Получен сигнал завершения работы...")
+    try:
+        db.write_buffer.flush()
+    except Exception as e:
+        logger.error(f"❌ Ошибка записи буфера статистики при завершении: {e}")
+
+    try:
+        saved = user_data_manager.flush_progress()
+        if saved:
+            logger.info(f"💾 Сохранен прогресс {saved} пользователей")
+    except Exception as e:
+        logger.error(f"❌ Ошибка сохранения прогресса при завершении: {e}")
+
     try:
         # Проверяем состояние планировщика более надежно
         if scheduler:
@@ -6270,17 +8872,12 @@ def setup_admin_from_env():
 
         logger.info(f"👑 Настройка администраторов из переменных окружения: {admin_ids}")
 
-        # Подключаемся к базе данных
-        db_path = 'data/users.db'
-        if not os.path.exists(db_path):
-            logger.info(f"❌ База данных не найдена: {db_path}")
-            return False
-
-        conn = sqlite3.connect(db_path)
+        # Через пул, как и остальные записи прав и подписок
+        conn = db.get_connection()
         cursor = conn.cursor()
 
         # Обновляем статус администратора для указанных ID
-        updated_count = 0
+        updated_ids = []
         for admin_id in admin_ids:
             try:
                 # Сначала проверяем, существует ли пользователь
@@ -6304,7 +8901,7 @@ def setup_admin_from_env():
                     ''', (admin_id,))
                     logger.info(f"✅ Создан новый пользователь {admin_id} с правами администратора")
 
-                updated_count += 1
+                updated_ids.append(admin_id)
 
             except sqlite3.Error as e:
                 logger.info(f"❌ Ошибка при назначении администратора {admin_id}: {e}")
@@ -6312,7 +8909,11 @@ def setup_admin_from_env():
         conn.commit()
         conn.close()
 
-        logger.info(f"✅ Успешно настроено {updated_count} администраторов")
+        # Закешированный вердикт "не администратор" больше неверен
+        for admin_id in updated_ids:
+            invalidate_user_state(admin_id)
+
+        logger.info(f"✅ Успешно настроено {len(updated_ids)} администраторов")
         return True
 
     except Exception as e:
@@ -6327,9 +8928,10 @@ def setup_admin_from_env():
 def run_startup_tasks():
     """Задачи, выполняемые один раз при запуске бота"""
     check_database_health()
-    # Обновление схемы БД (добавление новой колонки)
-    logger.info("🔄 Обновление схемы базы данных...")
-    db.upgrade_database()
+    check_query_plans()
+
+    # Имя и ID бота нужны при создании платежей - загружаем один раз
+    bot_metadata.load()
 
     # Очистка старых платежей
     logger.info("🧹 Очистка старых платежей...")
@@ -6360,6 +8962,11 @@ def run_startup_tasks():
     else:
         logger.info("⚠️ Не удалось настроить меню команд бота")
 
+    # Рассылки, прерванные перезапуском
+    resumed = broadcast_engine.resume_unfinished()
+    if resumed:
+        logger.info(f"♻️ Возобновлено рассылок: {resumed}")
+
 
 def safe_polling():
     """Безопасный запуск бота с восстановлением после сбоев"""
@@ -6440,10 +9047,25 @@ if __name__ == "__main__":
     else:
         logger.error("❌ Не удалось запустить планировщик!")
 
+    # Точная деактивация подписок в момент окончания (сразу обработает уже истекшие)
+    expiry_scheduler.start()
+
     # Настраиваем обработчики сигналов
     signal.signal(signal.SIGINT, shutdown_handler)
     signal.signal(signal.SIGTERM, shutdown_handler)
     atexit.register(shutdown_handler)
+    atexit.register(db.close)
+    # Выполняется до db.close (atexit - в обратном порядке): текущая страница рассылки
+    # дописывается, остальное продолжится после следующего запуска
+    atexit.register(broadcast_engine.stop)
+
+    # Уведомления ЮKassa активируют подписку сразу после оплаты
+    if YOOKASSA_WEBHOOK_ENABLED:
+        yookassa_webhook = YooKassaWebhookServer(YOOKASSA_WEBHOOK_HOST, YOOKASSA_WEBHOOK_PORT,
+                                                 YOOKASSA_WEBHOOK_PATH, trusted=YOOKASSA_WEBHOOK_TRUSTED,
+                                                 behind_proxy=YOOKASSA_WEBHOOK_BEHIND_PROXY)
+        if yookassa_webhook.start():
+            atexit.register(yookassa_webhook.stop)
 
     # Запускаем бота в безопасном режиме
     safe_polling()
@@ -6451,6 +9073,9 @@ if __name__ == "__main__":
     # Финальная очистка
     logger.info("🧹 Завершение работы...")
     user_data_manager.cleanup_old_data()
+    # Рассылка дописывает контрольную точку, пока пул и буфер записи еще работают
+    broadcast_engine.stop()
     shutdown_handler()
+    db.close()
 
     logger.info("👋 Бот завершил работу")
\ No newline at end of file
@@ -0,0 +1,165 @@
+"""Вебхук ЮKassa против локального фейкового отправителя уведомлений.
+
+Приемник поднимается на свободном порту (port=0), уведомления отправляются
+обычным HTTP POST. Проверяется, что повторная доставка, отмена и запрос с
+недоверенного адреса не продлевают подписку второй раз.
+"""
+import json
+import os
+import sys
+import urllib.error
+import urllib.request
+from collections import Counter
+from pathlib import Path
+
+import pytest
+
+for module in ('telebot', 'pytz', 'yookassa', 'apscheduler', 'dotenv'):
+    pytest.importorskip(module)
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+
+WEBHOOK_PATH = '/yookassa/webhook'
+
+
+@pytest.fixture(scope='module')
+def main(tmp_path_factory):
+    """Модуль бота, импортированный во временном каталоге (data/ создается там)"""
+    workdir = tmp_path_factory.mktemp('bot')
+    previous = os.getcwd()
+    os.chdir(workdir)
+    os.environ.setdefault('BOT_TOKEN', '123456:TEST-TOKEN')
+    try:
+        import main as bot_module
+        yield bot_module
+    finally:
+        os.chdir(previous)
+
+
+class FakeBot:
+    """Вместо Telegram: запоминает отправленные сообщения"""
+
+    def __init__(self):
+        self.sent = []
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.sent.append(chat_id)
+
+
+@pytest.fixture
+def env(main, tmp_path, monkeypatch):
+    """Чистая БД, фейковый бот и счетчик активаций"""
+    db = main.Database(str(tmp_path / 'data' / 'users.db'))
+    monkeypatch.setattr(main, 'db', db)
+    fake_bot = FakeBot()
+    monkeypatch.setattr(main, 'bot', fake_bot)
+
+    activations = Counter()
+    activate = db.activate_purchased_payment
+
+    def counting_activate(payment_id, *args, **kwargs):
+        result = activate(payment_id, *args, **kwargs)
+        if result is not None:
+            activations[payment_id] += 1
+        return result
+
+    monkeypatch.setattr(db, 'activate_purchased_payment', counting_activate)
+
+    for telegram_id, payment_id in ((1001, 'pay-succeeded-0001'), (1002, 'pay-canceled-0002')):
+        db.add_user(telegram_id, username=f"user_{telegram_id}")
+        db.create_payment(payment_id, telegram_id, main.SUBSCRIPTION_PRICE, 'Подписка')
+
+    yield main, db, fake_bot, activations
+    db.close()
+
+
+def start_server(main, trusted):
+    """Приемник на свободном порту; handler подменяется, чтобы видеть дошедшие запросы"""
+    received = []
+
+    def handler(event_json):
+        received.append(event_json['object']['id'])
+        return main.process_yookassa_notification(event_json)
+
+    server = main.YooKassaWebhookServer('127.0.0.1', 0, WEBHOOK_PATH, handler=handler, trusted=trusted)
+    assert server.start()
+    return server, received
+
+
+def notification(event, payment_id, status, telegram_id, amount):
+    """Тело уведомления в формате ЮKassa"""
+    return {
+        'type': 'notification',
+        'event': event,
+        'object': {
+            'id': payment_id,
+            'status': status,
+            'paid': status == 'succeeded',
+            'amount': {'value': f"{amount:.2f}", 'currency': 'RUB'},
+            'created_at': '2026-01-01T00:00:00.000Z',
+            'description': 'Подписка',
+            'metadata': {'telegram_id': str(telegram_id)},
+            'recipient': {'account_id': '100500', 'gateway_id': '100700'},
+            'refundable': False,
+            'test': True,
+        },
+    }
+
+
+def post(server, body):
+    """POST уведомления, возвращает HTTP-код"""
+    request = urllib.request.Request(
+        f"http://127.0.0.1:{server.port}{WEBHOOK_PATH}",
+        data=json.dumps(body).encode('utf-8'),
+        headers={'Content-Type': 'application/json'},
+        method='POST'
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def test_succeeded_duplicate_and_canceled(env):
+    main, db, fake_bot, activations = env
+    server, received = start_server(main, trusted='127.0.0.1')
+    try:
+        succeeded = notification('payment.succeeded', 'pay-succeeded-0001', 'succeeded',
+                                 1001, main.SUBSCRIPTION_PRICE)
+        canceled = notification('payment.canceled', 'pay-canceled-0002', 'canceled',
+                                1002, main.SUBSCRIPTION_PRICE)
+
+        assert post(server, succeeded) == 200
+        # Повторная доставка того же уведомления
+        assert post(server, succeeded) == 200
+        assert post(server, canceled) == 200
+    finally:
+        server.stop()
+
+    assert received == ['pay-succeeded-0001', 'pay-succeeded-0001', 'pay-canceled-0002']
+    assert activations == Counter({'pay-succeeded-0001': 1})
+    assert fake_bot.sent == [1001]
+
+    assert db.is_payment_processed('pay-succeeded-0001')
+    assert db.get_payment_by_external_id('pay-canceled-0002')['status'] == 'canceled'
+    assert db.get_user(1001)['subscription_purchased']
+    assert not db.get_user(1002)['subscription_purchased']
+
+
+def test_untrusted_address_is_rejected(env):
+    main, db, fake_bot, activations = env
+    # 127.0.0.1 не входит в сети ЮKassa и не добавлен в доверенные
+    server, received = start_server(main, trusted='')
+    try:
+        body = notification('payment.succeeded', 'pay-succeeded-0001', 'succeeded',
+                            1001, main.SUBSCRIPTION_PRICE)
+        assert post(server, body) == 403
+    finally:
+        server.stop()
+
+    assert received == []
+    assert activations == Counter()
+    assert fake_bot.sent == []
+    assert not db.is_payment_processed('pay-succeeded-0001')